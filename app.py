@@ -102,6 +102,22 @@ def get_database_path():
 
 db.init_app(app)
 
+# On-demand request profiling (?_profile=1 or a time window), reports in logs/profiles
+# Registered first so the other request hooks are part of the profile
+from request_profiler import init_request_profiler
+init_request_profiler(app, os.path.join(DATA_DIR, 'logs'))
+
+# Per-request SQL statement count/time headers and slow-query log (logs/slow_queries.log)
+from sql_instrumentation import init_sql_instrumentation
+init_sql_instrumentation(app, os.path.join(DATA_DIR, 'logs'))
+
+# Request latency / SQL time histograms for /metrics (after the SQL hooks, see metrics.py)
+from metrics import init_request_metrics
+init_request_metrics(app)
+
+# Report PDFs are generated in a background pool; routes return a job id to poll
+import report_jobs
+
 # Custom Jinja2 filter for hashing strings to integers
 @app.template_filter('hash')
 def hash_filter(s):
@@ -109,89 +125,46 @@ def hash_filter(s):
     return hash(str(s))
 
 # --- Database Migration Logic ---
+# Set when the schema upgrade at startup failed: every page shows it instead of
+# running on a half-migrated database (see block_on_migration_error)
+MIGRATION_ERROR = None
+
 def run_migrations():
-    """Ensure all required columns exist for the multi-profile upgrade"""
-    import sqlite3
+    """
+    Bring the database schema up to date (see migrations.py).
+    Warm startups only read the stored schema version and skip all schema work.
+    Raises when a step fails; user_version stays at the last completed step.
+    """
+    from migrations import has_pending_migrations, apply_migrations
     db_path = get_database_path()
-    if not os.path.exists(db_path):
+    if not has_pending_migrations(db_path):
         return
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # List of tables and columns to check/add
-    # Format: (table_name, column_name, column_definition)
-    migrations = [
-        ('gestiune', 'default_fuel_type', "TEXT DEFAULT 'Motorină'"),
-        ('gestiune', 'logo_path', "TEXT"),
-        ('company', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('app_settings', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('vehicle_category', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('vehicle_category', 'icon', "TEXT DEFAULT 'bi-tag-fill'"),
-        ('vehicle', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('stock_operation', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('transaction', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('history_log', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
-        ('history_log', 'pre_update_snapshot', "TEXT"),
-        ('company', 'last_report_start', "TIMESTAMP"),
-        ('company', 'last_report_end', "TIMESTAMP"),
-    ]
-    
-    try:
-        # 1. Create app_settings if it doesn't exist
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='app_settings'")
-        if not cursor.fetchone():
-            cursor.execute("""
-                CREATE TABLE app_settings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key VARCHAR(50) NOT NULL,
-                    value VARCHAR(200),
-                    gestiune_id INTEGER REFERENCES gestiune(id),
-                    UNIQUE(key, gestiune_id)
-                )
-            """)
-            conn.commit()
-            print("Migration: Created app_settings table with composite unique constraint")
-        else:
-            # Table exists, check if it has the old single-column unique constraint on 'key'
-            cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='app_settings'")
-            create_sql = cursor.fetchone()[0]
-            if 'key" UNIQUE' in create_sql or 'key VARCHAR(50) UNIQUE' in create_sql:
-                print("Migration: Detected old UNIQUE constraint on app_settings. Performing table migration...")
-                # SQLite doesn't support ALTER TABLE DROP CONSTRAINT, so we must recreate
-                cursor.executescript("""
-                    BEGIN;
-                    ALTER TABLE app_settings RENAME TO app_settings_old;
-                    CREATE TABLE app_settings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        key VARCHAR(50) NOT NULL,
-                        value VARCHAR(200),
-                        gestiune_id INTEGER REFERENCES gestiune(id),
-                        UNIQUE(key, gestiune_id)
-                    );
-                    INSERT INTO app_settings (id, key, value, gestiune_id)
-                    SELECT id, key, value, gestiune_id FROM app_settings_old;
-                    DROP TABLE app_settings_old;
-                    COMMIT;
-                """)
-                print("Migration: app_settings table migration complete.")
-
-        # 2. Add columns if missing
-        for table, column, definition in migrations:
-            cursor.execute(f"PRAGMA table_info([{table}])")
-            columns = [info[1] for info in cursor.fetchall()]
-            if columns and column not in columns:
-                try:
-                    cursor.execute(f"ALTER TABLE [{table}] ADD COLUMN [{column}] {definition}")
-                    conn.commit()
-                    print(f"Migration: Added {column} to {table}")
-                except Exception as e:
-                    print(f"Migration Error on {table}.{column}: {e}")
-                    
-    except Exception as e:
-        print(f"Migration fatal error: {e}")
-    finally:
-        conn.close()
+    # Create missing tables first so steps can backfill/index them
+    import models
+    db.create_all()
+    applied = apply_migrations(db_path)
+    if applied:
+        print(f"Migration: Schema upgraded to v{applied[-1]}")
+
+@app.before_request
+def block_on_migration_error():
+    if MIGRATION_ERROR is None or request.endpoint in ('static', 'favicon', 'shutdown', 'heartbeat'):
+        return None
+    from markupsafe import escape
+    return f"""
+    <html>
+        <body style="font-family: monospace; background: #fff0f0; padding: 20px;">
+            <h1 style="color: #d32f2f;">Actualizarea bazei de date a eșuat</h1>
+            <p>Aplicația nu poate porni cu baza de date în starea actuală. Datele nu au fost modificate
+               după ultimul pas reușit. Trimiteți acest mesaj dezvoltatorului.</p>
+            <div style="background: #fff; border: 1px solid #ffcdd2; padding: 15px; border-radius: 5px; overflow: auto;">
+                <pre>{escape(MIGRATION_ERROR)}</pre>
+            </div>
+            <p>Baza de date: {escape(get_database_path())}</p>
+        </body>
+    </html>
+    """, 503
 
 @app.route('/favicon.ico')
 def favicon():
@@ -206,15 +179,19 @@ def user_content(filename):
 # --- INITIALIZATION LOGIC ---
 def init_profiles():
     """Ensure DB structure exists"""
+    global MIGRATION_ERROR
     with app.app_context():
         # IMPORT MODELS HERE to ensure they are registered with SQLAlchemy before create_all
         import models 
         
-        # ALWAYS run migrations first to patch schema if it exists but is old
-        run_migrations()
-        
-        # Create tables if they don't exist
-        db.create_all()
+        # Creates missing tables and applies pending schema migrations;
+        # a no-op when the stored schema version is current
+        try:
+            run_migrations()
+        except Exception as e:
+            MIGRATION_ERROR = str(e)
+            logging.error(f"Migration fatal error: {e}", exc_info=True)
+            print(f"Migration fatal error: {e}")
         # No longer creating default profile automatically!
         # This forces the user to go through the Setup flow.
 
@@ -249,10 +226,25 @@ def migrate_existing_logos():
 init_profiles()
 migrate_existing_logos()
 
+def start_background_workers():
+    """
+    Start the maintenance threads. Called by the entry points only (here and in
+    desktop_launcher.py), so tests, scripts and process-pool workers that import
+    this module start none.
+    """
+    if MIGRATION_ERROR is not None:
+        return
+    # Background retention of the undo/redo history (history_retention.py)
+    from history_retention import start_compaction_worker
+    start_compaction_worker(DB_PATH)
+    # Nightly stock checkpoints for point-in-time balances (stock_checkpoints.py)
+    from stock_checkpoints import start_checkpoint_worker
+    start_checkpoint_worker(app)
+
 @app.before_request
 def enforce_profile():
     # List of allowed endpoints during setup/login
-    allowed = ['setup_page', 'setup_create', 'setup_restore', 'user_content', 'static', 'select_profile_page', 'select_profile_action', 'login', 'shutdown', 'heartbeat']
+    allowed = ['setup_page', 'setup_create', 'setup_restore', 'user_content', 'static', 'select_profile_page', 'select_profile_action', 'login', 'shutdown', 'heartbeat', 'metrics_endpoint']
     
     # 1. Check if DB is empty (Fresh Install)
     # We do this check only if we are not already in the setup flow
@@ -372,6 +364,10 @@ def setup_restore():
                     # Run column-level migrations
                     run_migrations()
                     
+                    # Cached settings belong to the replaced database
+                    from services import SettingsService
+                    SettingsService.invalidate()
+                    
                     # 5. Legacy Data Migration (if key tables are empty)
                     # If we restored an old DB, 'gestiune' table might be empty but 'company' has data
                     from models import Gestiune, Company, Vehicle
@@ -453,13 +449,12 @@ def inject_gestiune():
         # Guard against DB errors during context injection
         if gid:
             try:
-                from models import AppSettings
+                from services import SettingsService
                 gestiune = Gestiune.query.get(gid)
                 context['active_gestiune'] = gestiune
                 
-                # Fetch saved theme
-                theme_setting = AppSettings.query.filter_by(key='app_theme', gestiune_id=gid).first()
-                context['current_theme'] = theme_setting.value if theme_setting else 'light'
+                # Fetch saved theme (cached, no query per render)
+                context['current_theme'] = SettingsService.get(gid, 'app_theme', 'light')
             except:
                 context['active_gestiune'] = None
                 context['current_theme'] = 'light'
@@ -604,13 +599,17 @@ def delete_profile_logo(id):
 
 @app.route('/admin/profile/delete/<int:id>')
 def delete_profile(id):
-    from models import Gestiune, Company, Vehicle, Transaction, StockOperation, VehicleCategory
+    from models import Gestiune, Company, Vehicle, Transaction, StockOperation, VehicleCategory, BackupMark, BackupChange
+    from services import SettingsService
     gest = Gestiune.query.get_or_404(id)
     
     # Settle session if deleted profile was active
     if session.get('gestiune_id') == id:
         session.pop('gestiune_id', None)
         
+    # End its incremental backup chain first, so the deletes below are not logged
+    BackupMark.query.filter_by(gestiune_id=id).delete()
+    BackupChange.query.filter_by(gestiune_id=id).delete()
     # Delete all associated data
     Transaction.query.filter_by(gestiune_id=id).delete()
     StockOperation.query.filter_by(gestiune_id=id).delete()
@@ -620,12 +619,13 @@ def delete_profile(id):
     
     db.session.delete(gest)
     db.session.commit()
+    SettingsService.invalidate(id)
     flash("Gestiune și toate datele asociate au fost șterse.", "warning")
     return redirect(url_for('select_profile_page'))
 
 @app.route('/machines')
 def machine_categories():
-    from models import VehicleCategory, Transaction, Vehicle
+    from models import VehicleCategory, Transaction, Vehicle, to_liters
     from sqlalchemy import func
     gid = session.get('gestiune_id')
     categories = VehicleCategory.query.filter_by(gestiune_id=gid).order_by(VehicleCategory.name).all()
@@ -635,39 +635,42 @@ def machine_categories():
         # Get last 100 transactions
         cat.recent_transactions = Transaction.query.filter_by(gestiune_id=gid).join(Vehicle).filter(Vehicle.category_id == cat.id).order_by(Transaction.date.desc()).limit(100).all()
         # Calculate totals
-        cat.total_qty = db.session.query(func.sum(Transaction.quantity)).filter(Transaction.gestiune_id == gid).join(Vehicle).filter(Vehicle.category_id == cat.id).scalar() or 0
+        cat.total_qty = to_liters(db.session.query(func.sum(Transaction.quantity_cl)).filter(Transaction.gestiune_id == gid).join(Vehicle).filter(Vehicle.category_id == cat.id).scalar())
         cat.vehicle_count = len(cat.vehicles)
         
     return render_template('machine_categories.html', categories=categories)
 @app.route('/')
 def dashboard():
-    from models import Company, StockOperation, Transaction
+    from models import Company, StockOperation, Transaction, to_liters
     from sqlalchemy import func
-    from models import AppSettings
+    from services import SettingsService
     
     gid = session.get('gestiune_id')
     
     # Get global tank capacity for this gestiune
-    tank_capacity = AppSettings.get_tank_capacity(gid)
+    tank_capacity = SettingsService.get_tank_capacity(gid)
     
     # Calculate stock per company
     companies = Company.query.filter_by(gestiune_id=gid).all()
     stocks = {}
     
+    total_stock_cl = 0
     for c in companies:
-        initial = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='INITIAL').scalar() or 0
-        refill = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='IN').scalar() or 0
-        manual_out = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='OUT').scalar() or 0
+        # Sums are exact integer centiliters; converted to liters once per value
+        initial = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='INITIAL').scalar() or 0
+        refill = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='IN').scalar() or 0
+        manual_out = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='OUT').scalar() or 0
         # Consumed calculation: Exclude transactions that are considered "unallocated" (no vehicle or no category)
         # We need to join with Vehicle to check category_id
         from models import Vehicle
-        consumed = db.session.query(func.sum(Transaction.quantity))\
+        consumed = db.session.query(func.sum(Transaction.quantity_cl))\
             .join(Vehicle, Transaction.vehicle_id == Vehicle.id)\
             .filter(Transaction.company_id == c.id, 
                     Transaction.gestiune_id == gid,
                     Vehicle.category_id != None).scalar() or 0
         
         current = initial + refill - manual_out - consumed
+        total_stock_cl += current
         
         # Calculate last update from both Transactions AND Stock Operations
         last_trans_date = db.session.query(func.max(Transaction.date)).filter_by(company_id=c.id, gestiune_id=gid).scalar()
@@ -678,10 +681,10 @@ def dashboard():
         
         stocks[c.id] = {
             'name': c.name,
-            'initial': initial,
-            'refill': refill,
-            'consumed': consumed + manual_out,
-            'current': current,
+            'initial': to_liters(initial),
+            'refill': to_liters(refill),
+            'consumed': to_liters(consumed + manual_out),
+            'current': to_liters(current),
             'color': c.color,
             'color_hex': c.color_hex,
             'last_update': last_update
@@ -703,10 +706,10 @@ def dashboard():
     # Combined Stats
     # 1. Unallocated Transactions (No company OR No vehicle OR No category)
     from models import Vehicle
-    unalloc_trans_direct = db.session.query(func.sum(Transaction.quantity)).filter_by(company_id=None, gestiune_id=gid).scalar() or 0
+    unalloc_trans_direct = db.session.query(func.sum(Transaction.quantity_cl)).filter_by(company_id=None, gestiune_id=gid).scalar() or 0
     
     # 2. Transactions assigned to a company but missing vehicle/category
-    unalloc_trans_orphans = db.session.query(func.sum(Transaction.quantity))\
+    unalloc_trans_orphans = db.session.query(func.sum(Transaction.quantity_cl))\
         .outerjoin(Vehicle, Transaction.vehicle_id == Vehicle.id)\
         .filter(Transaction.gestiune_id == gid,
                 Transaction.company_id != None,
@@ -722,13 +725,13 @@ def dashboard():
                 db.or_(Transaction.company_id == None, Transaction.vehicle_id == None, Vehicle.category_id == None)).scalar()
 
     # 3. Unallocated Stock Operations (ONLY Manual Out 'OUT', not Refills 'IN')
-    unalloc_ops_qty = db.session.query(func.sum(StockOperation.quantity))\
+    unalloc_ops_qty = db.session.query(func.sum(StockOperation.quantity_cl))\
         .filter_by(company_id=None, gestiune_id=gid, operation_type='OUT').scalar() or 0
     unalloc_ops_count = StockOperation.query.filter_by(company_id=None, gestiune_id=gid, operation_type='OUT').count()
     unalloc_ops_last = db.session.query(func.max(StockOperation.date))\
         .filter_by(company_id=None, gestiune_id=gid, operation_type='OUT').scalar()
     
-    unallocated_consumed = unalloc_trans_qty + unalloc_ops_qty
+    unallocated_consumed = to_liters(unalloc_trans_qty + unalloc_ops_qty)
     unallocated_count = unalloc_trans_count + unalloc_ops_count
     
     from sqlalchemy import or_
@@ -737,7 +740,7 @@ def dashboard():
     
     # Combined Stats
     # ACCOUNTING TOTAL: Sum up all company stocks to get global available balance
-    total_stock = sum(s['current'] for s in stocks.values())
+    total_stock = to_liters(total_stock_cl)
     
     # Calculate global metrics based on accounting total
     total_percent = (total_stock / tank_capacity * 100) if tank_capacity > 0 else 0
@@ -776,11 +779,11 @@ def dashboard():
 
 @app.route('/admin/set_tank_capacity', methods=['POST'])
 def set_tank_capacity():
-    from models import AppSettings
+    from services import SettingsService
     gid = session.get('gestiune_id')
     try:
         new_capacity = float(request.form.get('capacity', 27000))
-        AppSettings.set_tank_capacity(new_capacity, gid)
+        SettingsService.set_tank_capacity(new_capacity, gid)
         flash(f'Capacitatea bazinului a fost actualizată la {new_capacity:,.0f} L!', 'success')
     except Exception as e:
         flash(f'Eroare la actualizarea capacității: {str(e)}', 'danger')
@@ -805,22 +808,93 @@ def set_company_capacity(company_id):
 def inject_now():
     return {'now': datetime.utcnow()}
 
-@app.template_filter('format_thousands')
-def format_thousands(value, decimals=0):
-    try:
-        val = float(value)
-        if decimals > 0:
-            fmt = "{:,.%df}" % decimals
-            # First replace thousands comma with space, then replace decimal dot with comma
-            return fmt.format(val).replace(",", " ").replace(".", ",")
-        else:
-            return "{:,}".format(int(val)).replace(",", " ")
-    except (ValueError, TypeError):
-        return value
+from formatting import format_thousands
+app.add_template_filter(format_thousands, 'format_thousands')
 
 @app.route('/data-management')
 def data_management():
-    return render_template('data_management.html')
+    from archive import get_archive_cutoff, list_archive_years
+    from history_retention import history_stats
+    from profile_diff import backup_status
+    gid = session.get('gestiune_id')
+    return render_template('data_management.html',
+                           archive_cutoff=get_archive_cutoff(gid) if gid else None,
+                           archive_years=list_archive_years(DB_PATH),
+                           history_stats=history_stats(DB_PATH, gid) if gid else None,
+                           backup_status=backup_status(gid) if gid else None)
+
+@app.route('/admin/archive/close', methods=['POST'])
+def close_archive_period():
+    """Move transactions/stock operations before the chosen date into per-year archive files"""
+    from archive import close_period, get_archive_cutoff
+    from services import SettingsService
+    global BUSY_MODE
+    
+    gid = session.get('gestiune_id')
+    if not gid:
+        return redirect('/select-profile')
+    
+    try:
+        cutoff = datetime.strptime(request.form.get('cutoff', ''), '%Y-%m-%d')
+    except ValueError:
+        flash('Data de închidere este invalidă.', 'danger')
+        return redirect('/data-management')
+    
+    current_cutoff = get_archive_cutoff(gid)
+    if current_cutoff and cutoff <= current_cutoff:
+        flash(f'Perioada până la {current_cutoff.strftime("%d.%m.%Y")} este deja arhivată.', 'warning')
+        return redirect('/data-management')
+    if cutoff > datetime.now():
+        flash('Nu se poate arhiva o perioadă care nu s-a încheiat.', 'danger')
+        return redirect('/data-management')
+    
+    BUSY_MODE = True
+    try:
+        # Release the session's connection: archiving runs in its own write transaction
+        db.session.remove()
+        summary = close_period(DB_PATH, gid, cutoff)
+        SettingsService.invalidate(gid)
+        if summary['years']:
+            flash(f"Arhivare reușită: {summary['transactions']} tranzacții și {summary['stock_operations']} op. stoc "
+                  f"mutate în arhivele {', '.join(str(y) for y in summary['years'])}. "
+                  f"Sold reportat pentru {summary['openings']} companii.", 'success')
+        else:
+            flash('Nu există date anterioare datei alese.', 'info')
+    except Exception as e:
+        flash(f'Eroare la arhivare: {str(e)}', 'danger')
+    finally:
+        BUSY_MODE = False
+    
+    return redirect('/data-management')
+
+@app.route('/admin/history/retention', methods=['POST'])
+def save_history_retention():
+    """Save the history retention policy of the profile and compact its history right away"""
+    from history_retention import KEEP_ACTIONS_KEY, KEEP_DAYS_KEY, compact
+    from services import SettingsService
+    
+    gid = session.get('gestiune_id')
+    if not gid:
+        return redirect('/select-profile')
+    
+    try:
+        keep_actions = max(0, int(request.form.get('keep_actions', '')))
+        keep_days = max(0, int(request.form.get('keep_days', '')))
+    except ValueError:
+        flash('Valorile de păstrare a istoricului sunt invalide.', 'danger')
+        return redirect('/data-management')
+    
+    SettingsService.set_many(gid, {KEEP_ACTIONS_KEY: keep_actions, KEEP_DAYS_KEY: keep_days})
+    try:
+        # Compaction writes through its own connection
+        db.session.remove()
+        result = compact(DB_PATH, [gid])
+        flash(f"Istoric compactat: {result['deleted']} intrări șterse, "
+              f"{result['reclaimed_bytes'] // 1024} KB eliberați.", 'success')
+    except Exception as e:
+        flash(f'Eroare la compactarea istoricului: {str(e)}', 'danger')
+    
+    return redirect('/data-management')
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_file():
@@ -946,10 +1020,49 @@ def get_transaction_api(id):
         'company_color': t.company.color_hex if t.company else '#6c757d'
     })
 
+@app.route('/api/stock/as_of')
+def api_stock_as_of():
+    """
+    Stock of every company of the active gestiune at a moment (?at=YYYY-MM-DDTHH:MM),
+    from the nearest daily checkpoint plus the movements since (stock_checkpoints.py)
+    """
+    from models import Company, to_liters
+    from stock_checkpoints import balances_as_of, build_checkpoints
+    from sqlalchemy.exc import SQLAlchemyError
+    
+    gid = session.get('gestiune_id')
+    if not gid:
+        return jsonify({'error': 'No active session'}), 401
+    
+    try:
+        at = datetime.strptime(request.args.get('at', ''), '%Y-%m-%dT%H:%M')
+    except ValueError:
+        return jsonify({'error': 'Invalid or missing "at" (expected YYYY-MM-DDTHH:MM)'}), 400
+    
+    # Catch up on days not checkpointed yet (a no-op once the nightly build ran).
+    # Optional: without them the balances are summed from the previous checkpoint.
+    try:
+        build_checkpoints(gid)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"[STOCK] Checkpoint build skipped for gestiune {gid}: {e}")
+    balances, checkpoint = balances_as_of(gid, at)
+    
+    companies = Company.query.filter_by(gestiune_id=gid).order_by(Company.name).all()
+    return jsonify({
+        'at': at.strftime('%Y-%m-%dT%H:%M'),
+        'checkpoint': checkpoint.strftime('%Y-%m-%dT%H:%M') if checkpoint else None,
+        'companies': [{
+            'id': c.id,
+            'name': c.name,
+            'stock': to_liters(balances.get(c.id, 0))
+        } for c in companies],
+        'total': to_liters(sum(balances.get(c.id, 0) for c in companies))
+    })
+
 @app.route('/admin/database/export')
 def export_database():
     """Export ONLY the active profile's data into a standalone SQLite file."""
-    import sqlite3
     import tempfile
     import unicodedata
     
@@ -987,170 +1100,33 @@ def export_database():
         
         profile_name = clean_filename(gestiune.name)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-        export_filename = f'FuelManager_{profile_name}_{timestamp}.db'
+        # full: standalone copy; base/diff: incremental backup chain (profile_diff.py)
+        mode = request.args.get('mode', 'full')
+        suffix = {'base': '_baza', 'diff': '_incremental'}.get(mode, '')
+        export_filename = f'FuelManager_{profile_name}_{timestamp}{suffix}.db'
         
         # Create temp export file
         temp_dir = tempfile.gettempdir()
         export_path = os.path.join(temp_dir, export_filename)
         
-        # Connect to source database
-        src_conn = sqlite3.connect(str(db_path))
-        src_cursor = src_conn.cursor()
-        
-        # Create export database with clean schema
-        dst_conn = sqlite3.connect(export_path)
-        dst_cursor = dst_conn.cursor()
-        
-        # --- Create tables in export DB (mirroring current schema) ---
-        dst_cursor.executescript('''
-            CREATE TABLE IF NOT EXISTS gestiune (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name VARCHAR(100) NOT NULL,
-                site_code VARCHAR(20),
-                default_fuel_type VARCHAR(20) DEFAULT 'Motorină',
-                logo_path VARCHAR(200),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS vehicle_category (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name VARCHAR(50) NOT NULL,
-                description VARCHAR(200),
-                icon VARCHAR(50) DEFAULT 'bi-tag-fill',
-                gestiune_id INTEGER REFERENCES gestiune(id)
-            );
-            CREATE TABLE IF NOT EXISTS company (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name VARCHAR(100) NOT NULL,
-                cui VARCHAR(20),
-                address VARCHAR(200),
-                product_code VARCHAR(50),
-                gestiune_id INTEGER REFERENCES gestiune(id),
-                last_report_start TIMESTAMP,
-                last_report_end TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS vehicle (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                plate_number VARCHAR(50) NOT NULL,
-                company_id INTEGER,
-                category_id INTEGER,
-                gestiune_id INTEGER REFERENCES gestiune(id)
-            );
-            CREATE TABLE IF NOT EXISTS stock_operation (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                operation_type VARCHAR(20),
-                quantity FLOAT NOT NULL,
-                date DATETIME,
-                description VARCHAR(200),
-                company_id INTEGER,
-                gestiune_id INTEGER REFERENCES gestiune(id)
-            );
-            CREATE TABLE IF NOT EXISTS [transaction] (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date DATETIME NOT NULL,
-                vehicle_id INTEGER,
-                company_id INTEGER,
-                quantity FLOAT NOT NULL,
-                gestiune_id INTEGER REFERENCES gestiune(id)
-            );
-            CREATE TABLE IF NOT EXISTS app_settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key VARCHAR(50) NOT NULL,
-                value VARCHAR(200),
-                gestiune_id INTEGER REFERENCES gestiune(id)
-            );
-        ''')
-        
-        # --- Export data filtered by gestiune_id ---
-        
-        # 0. Export current Gestiune profile
-        from models import Gestiune
-        current_gest = Gestiune.query.get(gid)
-        if current_gest:
-            dst_cursor.execute(
-                'INSERT INTO gestiune (id, name, site_code, default_fuel_type, logo_path, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                (current_gest.id, current_gest.name, current_gest.site_code, current_gest.default_fuel_type, current_gest.logo_path, current_gest.created_at)
-            )
-        
-        # 1. Categories
-        src_cursor.execute(
-            'SELECT id, name, description, icon, gestiune_id FROM vehicle_category WHERE gestiune_id = ?', (gid,))
-        categories = src_cursor.fetchall()
-        cat_id_map = {}  # old_id -> new_id (to remap foreign keys)
-        for row in categories:
-            dst_cursor.execute(
-                'INSERT INTO vehicle_category (name, description, icon, gestiune_id) VALUES (?, ?, ?, ?)',
-                (row[1], row[2], row[3], row[4]))
-            cat_id_map[row[0]] = dst_cursor.lastrowid
-        
-        # 2. Companies
-        src_cursor.execute(
-            'SELECT id, name, cui, address, product_code, gestiune_id FROM company WHERE gestiune_id = ?', (gid,))
-        companies = src_cursor.fetchall()
-        comp_id_map = {}
-        for row in companies:
-            dst_cursor.execute(
-                'INSERT INTO company (name, cui, address, product_code, gestiune_id) VALUES (?, ?, ?, ?, ?)',
-                (row[1], row[2], row[3], row[4], row[5]))
-            comp_id_map[row[0]] = dst_cursor.lastrowid
-        
-        # 3. Vehicles (remap company_id and category_id)
-        src_cursor.execute(
-            'SELECT id, plate_number, company_id, category_id, gestiune_id FROM vehicle WHERE gestiune_id = ?', (gid,))
-        vehicles = src_cursor.fetchall()
-        veh_id_map = {}
-        for row in vehicles:
-            new_comp_id = comp_id_map.get(row[2])
-            new_cat_id = cat_id_map.get(row[3])
-            dst_cursor.execute(
-                'INSERT INTO vehicle (plate_number, company_id, category_id, gestiune_id) VALUES (?, ?, ?, ?)',
-                (row[1], new_comp_id, new_cat_id, row[4]))
-            veh_id_map[row[0]] = dst_cursor.lastrowid
-        
-        # 4. Stock Operations (remap company_id)
-        src_cursor.execute(
-            'SELECT id, operation_type, quantity, date, description, company_id, gestiune_id '
-            'FROM stock_operation WHERE gestiune_id = ?', (gid,))
-        stock_ops = src_cursor.fetchall()
-        for row in stock_ops:
-            new_comp_id = comp_id_map.get(row[5])
-            dst_cursor.execute(
-                'INSERT INTO stock_operation (operation_type, quantity, date, description, company_id, gestiune_id) '
-                'VALUES (?, ?, ?, ?, ?, ?)',
-                (row[1], row[2], row[3], row[4], new_comp_id, row[6]))
-        
-        # 5. Transactions (remap vehicle_id and company_id)
-        src_cursor.execute(
-            'SELECT id, date, vehicle_id, company_id, quantity, gestiune_id '
-            'FROM [transaction] WHERE gestiune_id = ?', (gid,))
-        transactions = src_cursor.fetchall()
-        for row in transactions:
-            new_veh_id = veh_id_map.get(row[2])
-            new_comp_id = comp_id_map.get(row[3])
-            if new_veh_id:  # Skip orphaned transactions
-                dst_cursor.execute(
-                    'INSERT INTO [transaction] (date, vehicle_id, company_id, quantity, gestiune_id) '
-                    'VALUES (?, ?, ?, ?, ?)',
-                    (row[1], new_veh_id, new_comp_id, row[4], row[5]))
-        
-        # 6. App Settings (tank capacity, etc.)
-        try:
-            src_cursor.execute(
-                'SELECT key, value, gestiune_id FROM app_settings WHERE gestiune_id = ?', (gid,))
-            settings = src_cursor.fetchall()
-            for row in settings:
-                dst_cursor.execute(
-                    'INSERT INTO app_settings (key, value, gestiune_id) VALUES (?, ?, ?)',
-                    (row[0], row[1], row[2]))
-        except Exception:
-            pass  # Table might not exist in older DBs
-        
-        dst_conn.commit()
-        dst_conn.close()
-        src_conn.close()
-        
-        print(f"[EXPORT] Profile '{gestiune.name}' (id={gid}): "
-              f"{len(categories)} cat, {len(companies)} comp, {len(vehicles)} veh, "
-              f"{len(stock_ops)} stock, {len(transactions)} trans")
+        # Set-based copy through an ATTACHed export file (profile_export.py)
+        from profile_export import export_profile
+        from profile_diff import TRACKED_TABLES, export_base, export_diff
+        if mode == 'diff':
+            try:
+                counts = export_diff(str(db_path), gid, export_path)
+            except ValueError as e:
+                flash(str(e), 'warning')
+                return redirect('/data-management')
+            print(f"[EXPORT] Incremental backup of '{gestiune.name}' (id={gid}), changes "
+                  f"{counts['info']['from_seq']}-{counts['info']['to_seq']}: "
+                  f"{sum(counts[t] for t in TRACKED_TABLES)} "
+                  f"rows written, {counts['deleted']} deleted")
+        else:
+            counts = (export_base if mode == 'base' else export_profile)(str(db_path), gid, export_path)
+            print(f"[EXPORT] Profile '{gestiune.name}' (id={gid}){' base backup' if mode == 'base' else ''}: "
+                  f"{counts['vehicle_category']} cat, {counts['company']} comp, {counts['vehicle']} veh, "
+                  f"{counts['stock_operation']} stock, {counts['transaction']} trans")
         
         # PDF System v6.1 style: Save copy to Downloads if in Desktop Mode
         if os.environ.get('DESKTOP_MODE') == '1':
@@ -1175,7 +1151,7 @@ def export_database():
 
 @app.route('/admin/stock/details')
 def stock_details():
-    from models import Company, StockOperation, Transaction, Vehicle
+    from models import Company, StockOperation, Transaction, Vehicle, to_liters
     from datetime import datetime
     from sqlalchemy import func
     
@@ -1199,6 +1175,7 @@ def stock_details():
                 'date': o.date,
                 'type': o.operation_type,
                 'quantity': o.quantity,
+                'quantity_cl': o.quantity_cl,
                 'description': o.description or '',
                 'category': ''
             })
@@ -1208,6 +1185,7 @@ def stock_details():
                 'date': t.date,
                 'type': 'TRANSACTION',
                 'quantity': t.quantity,
+                'quantity_cl': t.quantity_cl,
                 'description': t.vehicle.plate_number if t.vehicle else 'Unknown',
                 'category': t.vehicle.category.name if (t.vehicle and t.vehicle.category) else '',
                 'is_unallocated': (t.vehicle is None) or (t.vehicle.company_id is None) or (t.vehicle.category_id is None)
@@ -1217,16 +1195,16 @@ def stock_details():
         history.sort(key=lambda x: x['date'], reverse=True)
         
         # Calc stats
-        initial = sum(x['quantity'] for x in history if x['type'] == 'INITIAL')
-        refill = sum(x['quantity'] for x in history if x['type'] == 'IN')
-        consumed = sum(x['quantity'] for x in history if x['type'] in ['TRANSACTION', 'OUT'])
+        initial = sum(x['quantity_cl'] for x in history if x['type'] == 'INITIAL')
+        refill = sum(x['quantity_cl'] for x in history if x['type'] == 'IN')
+        consumed = sum(x['quantity_cl'] for x in history if x['type'] in ['TRANSACTION', 'OUT'])
         current = initial + refill - consumed
         
         stocks_data[c.id] = {
-            'initial': initial,
-            'in': refill,
-            'consumed': consumed,
-            'current': current,
+            'initial': to_liters(initial),
+            'in': to_liters(refill),
+            'consumed': to_liters(consumed),
+            'current': to_liters(current),
             'history': history,
             'last_update': (lambda t, o: max([d for d in [t, o] if d]) if (t or o) else None)(
                 db.session.query(func.max(Transaction.date)).filter_by(company_id=c.id, gestiune_id=gid).scalar(),
@@ -1252,7 +1230,7 @@ def stock_details():
         # Check for potential duplicates (same date, same quantity, different ID)
         duplicate_check = Transaction.query.filter_by(
             date=t.date, 
-            quantity=t.quantity, 
+            quantity_cl=t.quantity_cl, 
             gestiune_id=gid
         ).filter(Transaction.id != t.id).first()
         
@@ -1270,6 +1248,7 @@ def stock_details():
             'type': 'TRANSACTION',
             'item_type': 'trans',
             'quantity': t.quantity,
+            'quantity_cl': t.quantity_cl,
             'description': t.vehicle.plate_number if t.vehicle else 'Unknown',
             'category': t.vehicle.category.name if (t.vehicle and t.vehicle.category) else '',
             'is_unallocated': True,
@@ -1288,6 +1267,7 @@ def stock_details():
             'type': op.operation_type,
             'item_type': 'op',
             'quantity': op.quantity,
+            'quantity_cl': op.quantity_cl,
             'description': op.description or desc,
             'category': 'SISTEM',
             'is_unallocated': True
@@ -1298,10 +1278,10 @@ def stock_details():
     # Sum ALL unallocated items (Transactions + Ops) to match Dashboard
     
     # Calculate breakdown
-    unallocated_initial = sum(x['quantity'] for x in unallocated_history if x.get('type') == 'INITIAL')
-    unallocated_in = sum(x['quantity'] for x in unallocated_history if x.get('type') == 'IN')
-    unallocated_out = sum(x['quantity'] for x in unallocated_history if x.get('type') == 'OUT')
-    unallocated_trans_qty = sum(x['quantity'] for x in unallocated_history if x.get('item_type') == 'trans')
+    unallocated_initial = sum(x['quantity_cl'] for x in unallocated_history if x.get('type') == 'INITIAL')
+    unallocated_in = sum(x['quantity_cl'] for x in unallocated_history if x.get('type') == 'IN')
+    unallocated_out = sum(x['quantity_cl'] for x in unallocated_history if x.get('type') == 'OUT')
+    unallocated_trans_qty = sum(x['quantity_cl'] for x in unallocated_history if x.get('item_type') == 'trans')
     
     # "Consumed" in summary usually means Transactions + Manual Out
     unallocated_consumed_total = unallocated_trans_qty + unallocated_out
@@ -1330,10 +1310,10 @@ def stock_details():
                          vehicles_autocomplete=vehicles_data,
                          unallocated_history=unallocated_history,
                          unallocated_stats={
-                             'initial': unallocated_initial,
-                             'in': unallocated_in,
-                             'consumed': unallocated_consumed_total,
-                             'current': unallocated_current
+                             'initial': to_liters(unallocated_initial),
+                             'in': to_liters(unallocated_in),
+                             'consumed': to_liters(unallocated_consumed_total),
+                             'current': to_liters(unallocated_current)
                          })
 
 @app.route('/admin/stock/add_detailed', methods=['POST'])
@@ -1645,23 +1625,24 @@ def delete_stock_bulk():
         except ValueError:
             continue
             
-    # LOG ACTIONS BEFORE DELETE (for Undo)
+    # LOG ACTIONS BEFORE DELETE (for Undo), as one changeset committed with the deletes
     deleted_count = 0
-    if op_ids_to_delete:
-        ops = StockOperation.query.filter(StockOperation.id.in_(op_ids_to_delete)).all()
-        for op in ops:
-            HistoryService.log_action('StockOperation', op.id, 'DELETE', op, gestiune_id=gid)
-            db.session.delete(op)
-            deleted_count += 1
-    
-    if trans_ids_to_delete:
-        transactions = Transaction.query.filter(Transaction.id.in_(trans_ids_to_delete)).all()
-        for t in transactions:
-            HistoryService.log_action('Transaction', t.id, 'DELETE', t, gestiune_id=gid)
-            db.session.delete(t)
-            deleted_count += 1
-        
-    db.session.commit()
+    with HistoryService.changeset(gid):
+        if op_ids_to_delete:
+            ops = StockOperation.query.filter(StockOperation.id.in_(op_ids_to_delete)).all()
+            for op in ops:
+                HistoryService.log_action('StockOperation', op.id, 'DELETE', op, gestiune_id=gid)
+                db.session.delete(op)
+                deleted_count += 1
+        
+        if trans_ids_to_delete:
+            transactions = Transaction.query.filter(Transaction.id.in_(trans_ids_to_delete)).all()
+            for t in transactions:
+                HistoryService.log_action('Transaction', t.id, 'DELETE', t, gestiune_id=gid)
+                db.session.delete(t)
+                deleted_count += 1
+            
+        db.session.commit()
     
     flash(f"{deleted_count} elemente au fost șterse.", "success")
     if company_id:
@@ -1695,43 +1676,45 @@ def rename_vehicle_bulk():
     count = 0
     company_id = None
     
-    # Process mixed items (Company Tab)
-    for item in items:
-        if ':' in item:
-            type_str, id_str = item.split(':')
-            itemId = int(id_str)
-            if type_str == 'trans':
-                t = Transaction.query.filter_by(id=itemId, gestiune_id=gid).first()
-                if t:
-                    HistoryService.log_action('Transaction', t.id, 'UPDATE', t, gestiune_id=gid)
-                    t.vehicle_id = v.id
-                    if v.company_id: t.company_id = v.company_id
-                    if not company_id: company_id = t.company_id
-                    count += 1
-            else: # op
-                op = StockOperation.query.filter_by(id=itemId, gestiune_id=gid).first()
+    # One undo step for the whole rename, committed once
+    with HistoryService.changeset(gid):
+        # Process mixed items (Company Tab)
+        for item in items:
+            if ':' in item:
+                type_str, id_str = item.split(':')
+                itemId = int(id_str)
+                if type_str == 'trans':
+                    t = Transaction.query.filter_by(id=itemId, gestiune_id=gid).first()
+                    if t:
+                        HistoryService.log_action('Transaction', t.id, 'UPDATE', t, gestiune_id=gid)
+                        t.vehicle_id = v.id
+                        if v.company_id: t.company_id = v.company_id
+                        if not company_id: company_id = t.company_id
+                        count += 1
+                else: # op
+                    op = StockOperation.query.filter_by(id=itemId, gestiune_id=gid).first()
+                    if op:
+                        HistoryService.log_action('StockOperation', op.id, 'UPDATE', op, gestiune_id=gid)
+                        op.description = f"Redenumit: {new_plate} (original: {op.description})"
+                        if not company_id: company_id = op.company_id
+                        count += 1
+            else: # ID only (Unallocated Tab Ops)
+                op = StockOperation.query.filter_by(id=int(item), gestiune_id=gid).first()
                 if op:
                     HistoryService.log_action('StockOperation', op.id, 'UPDATE', op, gestiune_id=gid)
-                    op.description = f"Redenumit: {new_plate} (original: {op.description})"
-                    if not company_id: company_id = op.company_id
+                    op.description = f"Redenumit: {new_plate}"
                     count += 1
-        else: # ID only (Unallocated Tab Ops)
-            op = StockOperation.query.filter_by(id=int(item), gestiune_id=gid).first()
-            if op:
-                HistoryService.log_action('StockOperation', op.id, 'UPDATE', op, gestiune_id=gid)
-                op.description = f"Redenumit: {new_plate}"
-                count += 1
 
-    # Process explicit transaction IDs (Unallocated Tab)
-    for tid in trans_ids_from_form:
-        t = Transaction.query.filter_by(id=int(tid), gestiune_id=gid).first()
-        if t:
-            HistoryService.log_action('Transaction', t.id, 'UPDATE', t, gestiune_id=gid)
-            t.vehicle_id = v.id
-            if v.company_id: t.company_id = v.company_id
-            count += 1
+        # Process explicit transaction IDs (Unallocated Tab)
+        for tid in trans_ids_from_form:
+            t = Transaction.query.filter_by(id=int(tid), gestiune_id=gid).first()
+            if t:
+                HistoryService.log_action('Transaction', t.id, 'UPDATE', t, gestiune_id=gid)
+                t.vehicle_id = v.id
+                if v.company_id: t.company_id = v.company_id
+                count += 1
 
-    db.session.commit()
+        db.session.commit()
     flash(f'{count} elemente au fost redenumite la {new_plate}.', 'success')
     
     if company_id:
@@ -1846,7 +1829,7 @@ def history_redo():
 
 @app.route('/reports', methods=['GET'])
 def reports_page():
-    from models import Company
+    from models import Company, VehicleCategory
     from datetime import datetime
     
     gid = session.get('gestiune_id')
@@ -1856,7 +1839,73 @@ def reports_page():
     default_start = now.replace(hour=0, minute=0).strftime('%Y-%m-%dT%H:%M')
     default_end = now.replace(hour=23, minute=59).strftime('%Y-%m-%dT%H:%M')
     
-    return render_template('reports.html', companies=companies, default_start=default_start, default_end=default_end)
+    categories = VehicleCategory.query.filter_by(gestiune_id=gid).order_by(VehicleCategory.name).all()
+    
+    return render_template('reports.html', companies=companies, categories=categories, default_start=default_start, default_end=default_end)
+
+
+@app.route('/export/transactions')
+def export_transactions():
+    """
+    Stream the transactions of a range as CSV (default) or XLSX (?format=xlsx).
+    Optional args: start, end (YYYY-MM-DDTHH:MM or YYYY-MM-DD), company_id, category_id.
+    """
+    from flask import Response, stream_with_context
+    from models import Gestiune
+    from services import iter_transaction_rows, stream_transactions_csv, stream_transactions_xlsx
+    
+    gid = session.get('gestiune_id')
+    if not gid:
+        return redirect('/select-profile')
+    
+    def parse_dt(value, end_of_day=False):
+        if not value:
+            return None
+        for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+            try:
+                parsed = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if end_of_day and fmt == '%Y-%m-%d':
+                parsed = parsed.replace(hour=23, minute=59, second=59)
+            return parsed
+        raise ValueError(value)
+    
+    try:
+        start_date = parse_dt(request.args.get('start'))
+        end_date = parse_dt(request.args.get('end'), end_of_day=True)
+        company_id = request.args.get('company_id', type=int)
+        category_id = request.args.get('category_id', type=int)
+    except ValueError as e:
+        flash(f'Dată invalidă pentru export: {e}', 'danger')
+        return redirect(request.referrer or '/reports')
+    
+    export_format = request.args.get('format', 'csv').lower()
+    gest = db.session.get(Gestiune, gid)
+    name_parts = ['Tranzactii', gest.name.replace(' ', '_') if gest else f'Gestiune_{gid}']
+    if start_date: name_parts.append(start_date.strftime('%Y%m%d'))
+    if end_date: name_parts.append(end_date.strftime('%Y%m%d'))
+    basename = '_'.join(name_parts)
+    
+    rows = iter_transaction_rows(gid, start_date, end_date, company_id, category_id)
+    if export_format == 'xlsx':
+        try:
+            import openpyxl
+        except ImportError:
+            flash('Exportul XLSX necesită pachetul openpyxl (pip install openpyxl).', 'danger')
+            return redirect(request.referrer or '/reports')
+        body = stream_transactions_xlsx(rows)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        filename = basename + '.xlsx'
+    else:
+        body = stream_transactions_csv(rows)
+        mimetype = 'text/csv; charset=utf-8'
+        filename = basename + '.csv'
+    
+    print(f"[EXPORT] Streaming {filename}")
+    # stream_with_context keeps the request (and its DB session) open while the rows are read
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 
 @app.route('/api/report_stats', methods=['GET'])
@@ -1866,7 +1915,8 @@ def api_report_stats():
     1. Total consumption for a selected range (and optional company)
     2. Last saved report interval for a specific company
     """
-    from models import Transaction, Company
+    from models import Company, to_liters
+    from archive import transaction_source
     from sqlalchemy import func
     from datetime import datetime
 
@@ -1905,21 +1955,22 @@ def api_report_stats():
             start_date = datetime.strptime(start_str, '%Y-%m-%dT%H:%M')
             end_date = datetime.strptime(end_str, '%Y-%m-%dT%H:%M')
             
-            query = db.session.query(func.sum(Transaction.quantity)).filter(
-                Transaction.gestiune_id == gid,
-                Transaction.date >= start_date,
-                Transaction.date <= end_date
+            # Includes archived years when the range reaches before the archive cutoff
+            src = transaction_source(gid, start_date, end_date)
+            query = db.session.query(func.sum(src.c.quantity_cl)).filter(
+                src.c.gestiune_id == gid,
+                src.c.date >= start_date,
+                src.c.date <= end_date
             )
             
             if company_id:
                 try:
                     cid = int(company_id)
-                    query = query.filter(Transaction.company_id == cid)
+                    query = query.filter(src.c.company_id == cid)
                 except ValueError:
                     pass # Ignore invalid company_id
             
-            total = query.scalar() or 0
-            response['total_liters'] = total
+            response['total_liters'] = to_liters(query.scalar())
         except ValueError:
             pass # Invalid date format
 
@@ -1928,7 +1979,9 @@ def api_report_stats():
 
 @app.route('/analysis', methods=['GET', 'POST'])
 def analysis_page():
-    from models import VehicleCategory, Transaction, Vehicle, AppSettings
+    from models import VehicleCategory, Vehicle, to_liters
+    from services import SettingsService
+    from archive import transaction_source
     from sqlalchemy import func
     from datetime import datetime
     
@@ -1937,40 +1990,25 @@ def analysis_page():
         return redirect('/select-profile')
         
     # Get last used dates from settings or default to current month
-    saved_start = AppSettings.query.filter_by(key='analysis_last_start', gestiune_id=gid).first()
-    saved_end = AppSettings.query.filter_by(key='analysis_last_end', gestiune_id=gid).first()
-    
-    default_start = saved_start.value if saved_start else datetime.now().replace(day=1, hour=0, minute=0).strftime('%Y-%m-%dT%H:%M')
-    default_end = saved_end.value if saved_end else datetime.now().replace(hour=23, minute=59).strftime('%Y-%m-%dT%H:%M')
+    default_start = SettingsService.get(gid, 'analysis_last_start') or datetime.now().replace(day=1, hour=0, minute=0).strftime('%Y-%m-%dT%H:%M')
+    default_end = SettingsService.get(gid, 'analysis_last_end') or datetime.now().replace(hour=23, minute=59).strftime('%Y-%m-%dT%H:%M')
 
     # Date filters (URL takes priority, defaults to last used)
     start_date_str = request.args.get('start', default_start)
     end_date_str = request.args.get('end', default_end)
     
-    # Save these as last used
-    for key, val in [('analysis_last_start', start_date_str), ('analysis_last_end', end_date_str)]:
-        setting = AppSettings.query.filter_by(key=key, gestiune_id=gid).first()
-        if not setting:
-            setting = AppSettings(key=key, value=val, gestiune_id=gid)
-            db.session.add(setting)
-        else:
-            setting.value = val
-    db.session.commit()
+    # Save these as last used (no write when unchanged)
+    SettingsService.set_many(gid, {'analysis_last_start': start_date_str, 'analysis_last_end': end_date_str})
     
     # Persistent Calculation Basis (General)
-    basis_setting = AppSettings.query.filter_by(key='analysis_calculation_basis', gestiune_id=gid).first()
-    calc_basis = basis_setting.value if basis_setting else 'diferenta_mc'
+    calc_basis = SettingsService.get(gid, 'analysis_calculation_basis', 'diferenta_mc')
     
     # Category-specific Basis Settings
-    cat_basis_settings = AppSettings.query.filter(AppSettings.key.like('analysis_basis_cat_%'), AppSettings.gestiune_id == gid).all()
-    cat_basis_map = {s.key.replace('analysis_basis_cat_', ''): s.value for s in cat_basis_settings}
+    cat_basis_map = SettingsService.get_prefixed(gid, 'analysis_basis_cat_')
     
     # Visibility and filtering settings
-    visible_setting = AppSettings.query.filter_by(key='analysis_visible_categories', gestiune_id=gid).first()
-    visible_categories = json.loads(visible_setting.value) if visible_setting else []
-    
-    hidden_setting = AppSettings.query.filter_by(key='analysis_exclude_hidden', gestiune_id=gid).first()
-    exclude_hidden = hidden_setting.value == 'true' if hidden_setting else False
+    visible_categories = SettingsService.get_json(gid, 'analysis_visible_categories', [])
+    exclude_hidden = SettingsService.get_bool(gid, 'analysis_exclude_hidden')
     
     start_date = datetime.strptime(start_date_str, '%Y-%m-%dT%H:%M')
     end_date = datetime.strptime(end_date_str, '%Y-%m-%dT%H:%M')
@@ -1983,28 +2021,12 @@ def analysis_page():
     ]
     
     if request.method == 'POST':
-        for key in mc_keys:
-            val = request.form.get(key, '0')
-            # Save using AppSettings helper or manual update
-            setting = AppSettings.query.filter_by(key=f'analysis_{key}', gestiune_id=gid).first()
-            if not setting:
-                setting = AppSettings(key=f'analysis_{key}', value=str(val), gestiune_id=gid)
-                db.session.add(setting)
-            else:
-                setting.value = str(val)
-        db.session.commit()
+        SettingsService.set_many(gid, {f'analysis_{key}': request.form.get(key, '0') for key in mc_keys})
         flash("Valorile de producție au fost actualizate.", "success")
         return redirect(url_for('analysis_page', start=start_date_str, end=end_date_str))
         
     # Get current MC values
-    mc_values = {}
-    for key in mc_keys:
-        setting = AppSettings.query.filter_by(key=f'analysis_{key}', gestiune_id=gid).first()
-        try:
-            val = float(setting.value) if setting and setting.value else 0.0
-        except:
-            val = 0.0
-        mc_values[key] = val
+    mc_values = {key: SettingsService.get_float(gid, f'analysis_{key}') for key in mc_keys}
         
     # CALCULATED FIELDS (v5.5 Logic)
     # c. Sorturi Vanduti = Total Vanduti - Balast Vanduti
@@ -2023,15 +2045,18 @@ def analysis_page():
     consum_extra = mc_values.get('consum_extra_8x4', 0.0)
     
     # Aggregation logic: Fuel consumption per Category
-    # Join Transaction -> Vehicle -> VehicleCategory
+    # Join Transaction (hot + archived years in range) -> Vehicle -> VehicleCategory
+    src = transaction_source(gid, start_date, end_date)
     stats = db.session.query(
         VehicleCategory.name,
-        func.sum(Transaction.quantity).label('total_fuel'),
+        func.sum(src.c.quantity_cl).label('total_fuel'),
         func.max(VehicleCategory.id).label('cat_id')
-    ).join(Vehicle, Transaction.vehicle_id == Vehicle.id)\
+    ).select_from(src)\
+     .join(Vehicle, src.c.vehicle_id == Vehicle.id)\
      .join(VehicleCategory, Vehicle.category_id == VehicleCategory.id)\
-     .filter(Transaction.gestiune_id == gid, Transaction.date >= start_date, Transaction.date <= end_date)\
+     .filter(src.c.gestiune_id == gid, src.c.date >= start_date, src.c.date <= end_date)\
      .group_by(VehicleCategory.name).all()
+    stats = [(name, to_liters(fuel_cl), cat_id) for name, fuel_cl, cat_id in stats]
      
     # Define Section Categories
     budila_categories = ['VOLA', 'EXCAVATOR', 'BULDOZER', 'BOBCAT', 'CAMION 8X4', 'CAP TRACTOR', 'AUTOTURISM']
@@ -2131,7 +2156,7 @@ def analysis_page():
 
 @app.route('/analysis/settings', methods=['POST'])
 def analysis_settings():
-    from models import AppSettings
+    from services import SettingsService
     import json
     
     gid = session.get('gestiune_id')
@@ -2141,23 +2166,11 @@ def analysis_settings():
     visible = request.form.getlist('visible_categories')
     exclude_hidden = request.form.get('exclude_hidden') == 'on'
     
-    # Save visible categories
-    setting = AppSettings.query.filter_by(key='analysis_visible_categories', gestiune_id=gid).first()
-    if not setting:
-        setting = AppSettings(key='analysis_visible_categories', value=json.dumps(visible), gestiune_id=gid)
-        db.session.add(setting)
-    else:
-        setting.value = json.dumps(visible)
-        
-    # Save exclude toggle
-    setting_toggle = AppSettings.query.filter_by(key='analysis_exclude_hidden', gestiune_id=gid).first()
-    if not setting_toggle:
-        setting_toggle = AppSettings(key='analysis_exclude_hidden', value='1' if exclude_hidden else '0', gestiune_id=gid)
-        db.session.add(setting_toggle)
-    else:
-        setting_toggle.value = '1' if exclude_hidden else '0'
-        
-    db.session.commit()
+    # Save visible categories and exclude toggle
+    SettingsService.set_many(gid, {
+        'analysis_visible_categories': json.dumps(visible),
+        'analysis_exclude_hidden': '1' if exclude_hidden else '0',
+    })
     flash("Preferințele de afișare au fost salvate.", "success")
     
     # Pass back filters
@@ -2168,7 +2181,7 @@ def analysis_settings():
 
 @app.route('/analysis/save-basis', methods=['POST'])
 def save_analysis_basis():
-    from models import AppSettings
+    from services import SettingsService
     gid = session.get('gestiune_id')
     if not gid:
         return {"status": "error", "message": "No session"}, 401
@@ -2181,65 +2194,29 @@ def save_analysis_basis():
         
     key = f'analysis_basis_cat_{cat_name}' if cat_name else 'analysis_calculation_basis'
     
-    setting = AppSettings.query.filter_by(key=key, gestiune_id=gid).first()
-    if not setting:
-        setting = AppSettings(key=key, value=basis, gestiune_id=gid)
-        db.session.add(setting)
-    else:
-        setting.value = basis
-        
-    db.session.commit()
+    SettingsService.set(gid, key, basis)
     return {"status": "success", "basis": basis, "category": cat_name}
 
 
-@app.route('/admin/analysis_pdf')
-def analysis_pdf():
-    from models import VehicleCategory, Transaction, Vehicle, AppSettings, Gestiune
+def analysis_report_context(gid, start_date, end_date, stats=None):
+    """
+    Template values of the analysis PDF for one period (analysis_pdf.html and
+    pdf_analysis). `stats` are the (category name, liters) consumption totals;
+    they are queried when not given (month_close passes its own).
+    """
+    from models import VehicleCategory, Vehicle, Gestiune, to_liters
     from sqlalchemy import func
-    from services import generate_analysis_report_pdf
-    import json
-    
-    gid = session.get('gestiune_id')
-    if not gid:
-        return redirect('/select-profile')
-        
-    start_date_str = request.args.get('start')
-    end_date_str = request.args.get('end')
-    print(f"DEBUG PDF: {start_date_str} to {end_date_str}")
-    
-    if not start_date_str or not end_date_str:
-        return "Parametri incorecți", 400
-
-    def parse_dt(dt_str):
-        for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
-            try:
-                return datetime.strptime(dt_str, fmt)
-            except ValueError:
-                continue
-        return None
-
-    start_date = parse_dt(start_date_str)
-    end_date = parse_dt(end_date_str)
-
-    if not start_date or not end_date:
-        return f"Format dată invalid: {start_date_str}", 400
+    from services import SettingsService
+    from archive import transaction_source
+    from pdf_resources import logo_resource
 
     # Get settings (same as analysis_page)
-    visible_setting = AppSettings.query.filter_by(key='analysis_visible_categories', gestiune_id=gid).first()
-    if visible_setting and visible_setting.value:
-        try: visible_categories = json.loads(visible_setting.value)
-        except: visible_categories = []
-    else: visible_categories = []
-
-    exclude_setting = AppSettings.query.filter_by(key='analysis_exclude_hidden', gestiune_id=gid).first()
-    exclude_hidden = (exclude_setting.value == '1') if exclude_setting else False
+    visible_categories = SettingsService.get_json(gid, 'analysis_visible_categories', [])
+    exclude_hidden = SettingsService.get_bool(gid, 'analysis_exclude_hidden')
 
     # Get basis settings
-    basis_setting = AppSettings.query.filter_by(key='analysis_calculation_basis', gestiune_id=gid).first()
-    calc_basis = basis_setting.value if basis_setting else 'total_mc_vanduti'
-    
-    cat_basis_settings = AppSettings.query.filter(AppSettings.key.like('analysis_basis_cat_%'), AppSettings.gestiune_id == gid).all()
-    cat_basis_map = {s.key.replace('analysis_basis_cat_', ''): s.value for s in cat_basis_settings}
+    calc_basis = SettingsService.get(gid, 'analysis_calculation_basis', 'total_mc_vanduti')
+    cat_basis_map = SettingsService.get_prefixed(gid, 'analysis_basis_cat_')
 
     # MC values logic (v5.5 + v5.6)
     mc_keys = [
@@ -2249,26 +2226,25 @@ def analysis_pdf():
         'nisip_exploatat_ghidfalau', 'nisip_transportat_budila',
         'consum_extra_ghidfalau'
     ]
-    mc_values = {k: 0.0 for k in mc_keys}
-    for key in mc_keys:
-        setting = AppSettings.query.filter_by(key=f'analysis_{key}', gestiune_id=gid).first()
-        try: val = float(setting.value) if setting and setting.value else 0.0
-        except: val = 0.0
-        mc_values[key] = val
+    mc_values = {key: SettingsService.get_float(gid, f'analysis_{key}') for key in mc_keys}
         
     mc_values['mc_sorturi_vanduti'] = mc_values['total_mc_vanduti'] - mc_values['mc_balast']
     mc_values['mc_stoc_statie'] = mc_values['mc_exploatati'] - mc_values['mc_balast_sortati']
     if mc_values['to_cap_tractor'] > 0:
         mc_values['mc_cap_tractor'] = mc_values['to_cap_tractor'] / 1.5
 
-    # Fetch stats
-    stats = db.session.query(
-        VehicleCategory.name,
-        func.sum(Transaction.quantity).label('total_fuel')
-    ).join(Vehicle, Transaction.vehicle_id == Vehicle.id)\
-     .join(VehicleCategory, Vehicle.category_id == VehicleCategory.id)\
-     .filter(Transaction.gestiune_id == gid, Transaction.date >= start_date, Transaction.date <= end_date)\
-     .group_by(VehicleCategory.name).all()
+    # Fetch stats (hot + archived years in range)
+    if stats is None:
+        src = transaction_source(gid, start_date, end_date)
+        stats = db.session.query(
+            VehicleCategory.name,
+            func.sum(src.c.quantity_cl).label('total_fuel')
+        ).select_from(src)\
+         .join(Vehicle, src.c.vehicle_id == Vehicle.id)\
+         .join(VehicleCategory, Vehicle.category_id == VehicleCategory.id)\
+         .filter(src.c.gestiune_id == gid, src.c.date >= start_date, src.c.date <= end_date)\
+         .group_by(VehicleCategory.name).all()
+        stats = [(name, to_liters(fuel_cl)) for name, fuel_cl in stats]
     
     consumption_map = {name: fuel for name, fuel in stats}
     all_categories = VehicleCategory.query.filter_by(gestiune_id=gid).all()
@@ -2365,16 +2341,11 @@ def analysis_pdf():
         return cleaned
 
     gestiune = Gestiune.query.get(gid)
-    logo_base64 = None
+    logo_base64 = logo_file = None
     if gestiune.logo_path and not ('profile_logos/1.jpg' in gestiune.logo_path or gestiune.logo_path == '1.jpg'):
         logo_abs_path = os.path.join(app.root_path, gestiune.logo_path.replace('/', os.sep)) if gestiune.logo_path.startswith('static/') else os.path.join(DATA_DIR, 'logos', gestiune.logo_path.replace('/', os.sep))
-        if os.path.exists(logo_abs_path):
-            import base64
-            try:
-                with open(logo_abs_path, "rb") as img_file:
-                    ext = os.path.splitext(logo_abs_path)[1][1:]
-                    logo_base64 = f"data:image/{ext};base64,{base64.b64encode(img_file.read()).decode()}"
-            except: pass
+        # Downsized and encoded once per logo change (pdf_resources)
+        logo_base64, logo_file = logo_resource(logo_abs_path)
 
     # Global scores for Summary
     gen_mc_vanduti = mc_values.get('total_mc_vanduti', 0)
@@ -2391,39 +2362,66 @@ def analysis_pdf():
     gen_mc_ghid = mc_values.get('nisip_exploatat_ghidfalau', 0)
     eff_ghid = ghidfalau_net_fuel / gen_mc_ghid if gen_mc_ghid > 0 else 0
 
-    html = render_template('analysis_pdf.html',
-                         gestiune_name=clean_accents(gestiune.name),
-                         logo_base64=logo_base64,
-                         start_date=start_date.strftime('%d.%m.%Y'),
-                         end_date=end_date.strftime('%d.%m.%Y'),
-                         total_fuel_budila=total_engine_fuel,
-                         total_fuel_ghid=ghidfalau_total_fuel,
-                         net_fuel=net_engine_fuel,
-                         mc_vanduti=gen_mc_vanduti,
-                         mc_sortati=gen_mc_sortati,
-                         mc_ghid=gen_mc_ghid,
-                         eff_vanduti=eff_vanduti,
-                         eff_sortati=eff_sortati,
-                         eff_ghid=eff_ghid,
-                         budila_data=prep_list(budila_data),
-                         ghidfalau_data=prep_list(ghidfalau_data),
-                         generated_at=datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
-    
-    
-    # ... (Preceding HTML generation logic) ...
+    return dict(gestiune_name=clean_accents(gestiune.name),
+                logo_base64=logo_base64,
+                logo_file=logo_file,
+                start_date=start_date.strftime('%d.%m.%Y'),
+                end_date=end_date.strftime('%d.%m.%Y'),
+                total_fuel_budila=total_engine_fuel,
+                total_fuel_ghid=ghidfalau_total_fuel,
+                net_fuel=net_engine_fuel,
+                mc_vanduti=gen_mc_vanduti,
+                mc_sortati=gen_mc_sortati,
+                mc_ghid=gen_mc_ghid,
+                eff_vanduti=eff_vanduti,
+                eff_sortati=eff_sortati,
+                eff_ghid=eff_ghid,
+                budila_data=prep_list(budila_data),
+                ghidfalau_data=prep_list(ghidfalau_data))
+
+
+@app.route('/admin/analysis_pdf')
+def analysis_pdf():
+    from services import generate_analysis_report_pdf
     
+    gid = session.get('gestiune_id')
+    if not gid:
+        return redirect('/select-profile')
+        
+    start_date_str = request.args.get('start')
+    end_date_str = request.args.get('end')
+    print(f"DEBUG PDF: {start_date_str} to {end_date_str}")
     
+    if not start_date_str or not end_date_str:
+        return "Parametri incorecți", 400
+
+    def parse_dt(dt_str):
+        for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.strptime(dt_str, fmt)
+            except ValueError:
+                continue
+        return None
+
+    start_date = parse_dt(start_date_str)
+    end_date = parse_dt(end_date_str)
+
+    if not start_date or not end_date:
+        return f"Format dată invalid: {start_date_str}", 400
+
+    context = analysis_report_context(gid, start_date, end_date)
+    report_data = dict(context, generated_at=datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+    # Drawn natively from report_data; the HTML is the xhtml2pdf fallback
+    html = render_template('analysis_pdf.html', **report_data)
     
-    pdf_path, msg = generate_analysis_report_pdf(html, gid)
-    if pdf_path:
-        return jsonify({'status': 'success', 'filepath': pdf_path, 'filename': os.path.basename(pdf_path)})
-        
-    return jsonify({'status': 'error', 'message': msg}), 500
+    job_id = report_jobs.submit(app, 'analiza', gid, generate_analysis_report_pdf, html, gid, report_data=report_data)
+    return jsonify({'status': 'queued', 'job_id': job_id})
 
 
 @app.route('/admin')
 def admin_page():
-    from models import Company, Vehicle, Transaction, VehicleCategory, AppSettings
+    from models import Company, Vehicle, Transaction, VehicleCategory
+    from services import SettingsService
     
     gid = session.get('gestiune_id')
     
@@ -2447,11 +2445,9 @@ def admin_page():
     
     # Get custom capacities
     custom_capacities = {}
-    settings = AppSettings.query.filter(AppSettings.key.like('tank_capacity_%'), AppSettings.gestiune_id == gid).all()
-    for s in settings:
+    for c_id_match, value in SettingsService.get_prefixed(gid, 'tank_capacity_').items():
         try:
-            c_id_match = s.key.split('_')[-1]
-            custom_capacities[int(c_id_match)] = float(s.value)
+            custom_capacities[int(c_id_match)] = float(value)
         except: continue
 
     return render_template('admin.html', 
@@ -2517,6 +2513,7 @@ def move_vehicle(id):
 @app.route('/admin/company/new', methods=['GET', 'POST'])
 def new_company():
     from models import Company
+    from services import assign_series_code
     gid = session.get('gestiune_id')
     if request.method == 'POST':
         name = request.form['name']
@@ -2537,6 +2534,7 @@ def new_company():
             gestiune_id=gid
         )
         db.session.add(c)
+        assign_series_code(c)
         db.session.commit()
         flash("Firma a fost creată.", "success")
         
@@ -2569,10 +2567,14 @@ def new_company():
 @app.route('/admin/company/edit/<int:id>', methods=['GET', 'POST'])
 def edit_company(id):
     from models import Company
+    from services import assign_series_code
     gid = session.get('gestiune_id')
     c = Company.query.filter_by(id=id, gestiune_id=gid).first_or_404()
     if request.method == 'POST':
+        renamed = c.name != request.form['name']
         c.name = request.form['name']
+        if renamed:
+            assign_series_code(c)
         c.cui = request.form.get('cui')
         c.address = request.form.get('address')
         c.product_code = request.form.get('product_code')
@@ -2749,12 +2751,8 @@ def generate_report():
         except ValueError:
             company_id = None
         
-    filepath, message = generate_pdf_report(start_date, end_date, gid, company_id, bon_number)
-    
-    if filepath:
-        return jsonify({'status': 'success', 'filepath': filepath, 'filename': os.path.basename(filepath), 'message': message})
-    else:
-        return jsonify({'status': 'error', 'message': message})
+    job_id = report_jobs.submit(app, 'bonuri', gid, generate_pdf_report, start_date, end_date, gid, company_id, bon_number)
+    return jsonify({'status': 'queued', 'job_id': job_id})
 
 @app.route('/admin/generate_monthly_report', methods=['POST'])
 def generate_monthly_report():
@@ -2773,12 +2771,48 @@ def generate_monthly_report():
     if initial_series: initial_series = float(initial_series)
     if final_series: final_series = float(final_series)
     
-    filepath, message = generate_monthly_report_pdf(start_date, end_date, gid, initial_series, final_series)
+    job_id = report_jobs.submit(app, 'lunar', gid, generate_monthly_report_pdf, start_date, end_date, gid, initial_series, final_series)
+    return jsonify({'status': 'queued', 'job_id': job_id})
+
+
+@app.route('/admin/month_close', methods=['POST'])
+def month_close():
+    """Month-close batch: bon batches per company, monthly and analysis reports in one ZIP"""
+    from functools import partial
+    from month_close import generate_month_close
     
-    if filepath:
-        return jsonify({'status': 'success', 'filepath': filepath, 'filename': os.path.basename(filepath), 'message': message})
-    else:
-        return jsonify({'status': 'error', 'message': message})
+    gid = session.get('gestiune_id')
+    start_date = request.form['start_date']
+    end_date = request.form['end_date']
+    bon_number = request.form.get('bon_number', '')
+    
+    initial_series = request.form.get('initial_series')
+    final_series = request.form.get('final_series')
+    
+    try:
+        start_date = datetime.strptime(start_date, '%Y-%m-%dT%H:%M')
+        end_date = datetime.strptime(end_date, '%Y-%m-%dT%H:%M')
+        initial_series = float(initial_series) if initial_series else None
+        final_series = float(final_series) if final_series else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Format dată sau serie invalid.'}), 400
+    
+    # Analysis settings are read in the job; its consumption stats come from the month-close snapshot
+    analysis_context = partial(analysis_report_context, gid, start_date, end_date)
+    
+    job_id = report_jobs.submit(app, 'inchidere', gid, generate_month_close, start_date, end_date, gid,
+                                bon_number, initial_series, final_series, analysis_context)
+    return jsonify({'status': 'queued', 'job_id': job_id})
+
+
+@app.route('/admin/report_jobs/<job_id>')
+def report_job_status(job_id):
+    """Progress of a queued report: status, pages written, and the file once done"""
+    job = report_jobs.get(job_id)
+    if job is None or job['gestiune_id'] != session.get('gestiune_id'):
+        return jsonify({'status': 'error', 'message': 'Raportul nu a fost găsit.'}), 404
+    return jsonify({key: job[key] for key in ('id', 'report', 'status', 'pages', 'total_pages',
+                                              'filepath', 'filename', 'message')})
 
 @app.route('/admin/undo')
 def undo_action():
@@ -2812,21 +2846,48 @@ def shutdown_server():
     
     return jsonify({'status': 'shutting down'}), 200
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text-format metrics for a local collector"""
+    import metrics
+    metrics.update_database_gauges(DB_PATH)
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def profiling_control():
+    """
+    GET: profiling window status and the saved reports.
+    POST minutes=N starts a profiling window for every request, minutes=0 stops it.
+    A single request is profiled by adding ?_profile=1 to its URL.
+    """
+    import request_profiler
+    if request.method == 'POST':
+        minutes = request.form.get('minutes', type=float) or 0
+        if minutes > 0:
+            request_profiler.start_window(minutes)
+        else:
+            request_profiler.stop_window()
+    
+    profile_dir = os.path.join(DATA_DIR, 'logs', 'profiles')
+    reports = sorted((f for f in os.listdir(profile_dir) if f.endswith('.html')), reverse=True) if os.path.isdir(profile_dir) else []
+    return jsonify({
+        'window_active': request_profiler.window_active(),
+        'reports': [url_for('profiling_report', filename=f) for f in reports[:50]],
+    })
+
+@app.route('/admin/profiling/<path:filename>')
+def profiling_report(filename):
+    return send_from_directory(os.path.join(DATA_DIR, 'logs', 'profiles'), filename)
+
 @app.route('/api/set-theme', methods=['POST'])
 def set_theme_api():
-    from models import AppSettings
+    from services import SettingsService
     gid = session.get('gestiune_id')
     if not gid:
         return jsonify({'status': 'error', 'message': 'No active session'}), 401
     data = request.json
     theme = data.get('theme', 'light')
-    setting = AppSettings.query.filter_by(key='app_theme', gestiune_id=gid).first()
-    if not setting:
-        setting = AppSettings(key='app_theme', value=theme, gestiune_id=gid)
-        db.session.add(setting)
-    else:
-        setting.value = theme
-    db.session.commit()
+    SettingsService.set(gid, 'app_theme', theme)
     return jsonify({'status': 'success', 'theme': theme})
 
 @app.route('/api/heartbeat', methods=['POST'])
@@ -2841,12 +2902,9 @@ def heartbeat():
 @app.route('/admin/database/import', methods=['POST'])
 def import_database():
     """Import data from an SQLite backup, FULLY REPLACING the active profile's data."""
-    if 'db_file' not in request.files:
-        flash('Nici un fișier selectat.', 'danger')
-        return redirect('/data-management')
-    
-    file = request.files['db_file']
-    if file.filename == '':
+    # One backup file, or an incremental chain: its base plus the diffs (profile_diff.py)
+    files = [f for f in request.files.getlist('db_file') if f and f.filename]
+    if not files:
         flash('Nici un fișier selectat.', 'danger')
         return redirect('/data-management')
 
@@ -2855,7 +2913,7 @@ def import_database():
         flash('Nu există nici o gestiune activă selectată!', 'danger')
         return redirect('/select-profile')
 
-    if not file or not (file.filename.endswith('.db') or file.filename.endswith('.sqlite')):
+    if not all(f.filename.endswith('.db') or f.filename.endswith('.sqlite') for f in files):
         flash('Fișier nevalid. Doar .db și .sqlite sunt acceptate.', 'danger')
         return redirect('/data-management')
 
@@ -2863,79 +2921,52 @@ def import_database():
     import tempfile
     import time as time_module
     from models import Company, Vehicle, Transaction, StockOperation, VehicleCategory, AppSettings
-    from datetime import datetime
+    from services import SettingsService
+    from profile_import import import_profile
+    from profile_diff import read_backup_info, rebuild_profile
     
     global BUSY_MODE
     BUSY_MODE = True
     
-    # Save uploaded file to temp location
+    # Save uploaded files to temp location
     temp_dir = tempfile.gettempdir()
-    temp_path = os.path.join(temp_dir, f"import_{int(time_module.time())}.db")
-    file.save(temp_path)
+    stamp = int(time_module.time())
+    temp_path = os.path.join(temp_dir, f"import_{stamp}.db")
+    part_paths = [os.path.join(temp_dir, f"import_{stamp}_{i}.db") for i in range(len(files))]
+    for file, part_path in zip(files, part_paths):
+        file.save(part_path)
     
     src_conn = None
     try:
         # Validate SQLite header
-        with open(temp_path, 'rb') as f:
-            header = f.read(16)
-        if not header.startswith(b'SQLite format 3'):
-            flash('Fișierul încărcat nu este o bază de date SQLite validă!', 'danger')
-            return redirect('/data-management')
+        for file, part_path in zip(files, part_paths):
+            with open(part_path, 'rb') as f:
+                header = f.read(16)
+            if not header.startswith(b'SQLite format 3'):
+                flash(f'Fișierul {file.filename} nu este o bază de date SQLite validă!', 'danger')
+                return redirect('/data-management')
+        
+        if len(part_paths) > 1 or (read_backup_info(part_paths[0]) or {}).get('kind') == 'diff':
+            try:
+                applied = rebuild_profile(part_paths, temp_path)
+            except ValueError as e:
+                msg = str(e)
+                for file, part_path in zip(files, part_paths):
+                    msg = msg.replace(os.path.basename(part_path), file.filename)
+                flash(msg, 'danger')
+                return redirect('/data-management')
+            print(f"[IMPORT] Rebuilt profile from a base backup and {applied} incremental backups")
+        else:
+            os.replace(part_paths[0], temp_path)
         
         # Connect to uploaded database
         src_conn = sqlite3.connect(temp_path)
-        src_cursor = src_conn.cursor()
         
         print(f"[IMPORT] Starting FULL OVERWRITE import into gestiune_id={gid}")
+        # The archive cutoff is dropped with the other settings and backups never carry one
+        from archive import get_archive_cutoff
+        archive_cutoff = get_archive_cutoff(gid)
         
-        # --- Helper functions ---
-        def get_columns(table_name):
-            try:
-                src_cursor.execute(f"PRAGMA table_info([{table_name}])")
-                return [info[1] for info in src_cursor.fetchall()]
-            except Exception:
-                return []
-
-        def table_exists(table_name):
-            src_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-            return src_cursor.fetchone() is not None
-
-        def parse_sqlite_date(d_str):
-            if not d_str: return datetime.utcnow()
-            try: return datetime.strptime(d_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
-            except Exception:
-                try: return datetime.strptime(d_str, '%Y-%m-%d')
-                except Exception: return datetime.utcnow()
-
-        def build_gestiune_filter(table_name):
-            """Build WHERE clause for gestiune_id filtering in source DB."""
-            cols = get_columns(table_name)
-            if 'gestiune_id' in cols:
-                # Find the source gestiune_id to filter by
-                # If source has gestiune table, pick the first one; otherwise filter by any
-                src_gid = detect_source_gestiune_id()
-                if src_gid is not None:
-                    return f" WHERE gestiune_id = {src_gid}"
-                # If we can't detect, import everything (old single-profile backup)
-            return ""
-
-        def detect_source_gestiune_id():
-            """Detect the gestiune_id in the source backup file."""
-            if not hasattr(detect_source_gestiune_id, '_cached'):
-                detect_source_gestiune_id._cached = None
-                try:
-                    if table_exists('gestiune'):
-                        src_cursor.execute("SELECT id FROM gestiune LIMIT 1")
-                        row = src_cursor.fetchone()
-                        if row:
-                            detect_source_gestiune_id._cached = row[0]
-                    else:
-                        # No gestiune table = old single-profile DB, no filtering needed
-                        detect_source_gestiune_id._cached = None
-                except Exception:
-                    detect_source_gestiune_id._cached = None
-            return detect_source_gestiune_id._cached
-
         # ============================================================
         # PHASE 1: DELETE all existing data for the active profile
         # (Order: most dependent first → least dependent last)
@@ -2960,151 +2991,15 @@ def import_database():
 
         # ============================================================
         # PHASE 2: INSERT new data from the backup file
+        # (batched executemany inserts, ids remapped in memory; see profile_import.py)
         # ============================================================
-        company_map = {}   # src_id -> new_id
-        category_map = {}  # src_id -> new_id
-        vehicle_map = {}   # src_id -> new_id
-        counts = {"categories": 0, "companies": 0, "vehicles": 0, "stock": 0, "trans": 0, "settings": 0}
-
-        # 1. Import Categories
-        if table_exists("vehicle_category"):
-            cols = get_columns("vehicle_category")
-            where = build_gestiune_filter("vehicle_category")
-            
-            select_cols = ["id", "name"]
-            if "description" in cols: select_cols.append("description")
-            if "icon" in cols: select_cols.append("icon")
-            
-            src_cursor.execute(f"SELECT {', '.join(select_cols)} FROM vehicle_category{where}")
-            for row in src_cursor.fetchall():
-                r = dict(zip(select_cols, row))
-                new_cat = VehicleCategory(
-                    name=r['name'],
-                    description=r.get('description'),
-                    icon=r.get('icon', 'bi-tag-fill'),
-                    gestiune_id=gid
-                )
-                db.session.add(new_cat)
-                db.session.flush()
-                category_map[r['id']] = new_cat.id
-                counts["categories"] += 1
-
-        # 2. Import Companies
-        if table_exists("company"):
-            cols = get_columns("company")
-            where = build_gestiune_filter("company")
-            
-            select_cols = ["id", "name"]
-            for c in ["cui", "address", "product_code"]:
-                if c in cols: select_cols.append(c)
-            
-            src_cursor.execute(f"SELECT {', '.join(select_cols)} FROM company{where}")
-            for row in src_cursor.fetchall():
-                r = dict(zip(select_cols, row))
-                new_comp = Company(
-                    name=r['name'],
-                    cui=r.get('cui'),
-                    address=r.get('address'),
-                    product_code=r.get('product_code'),
-                    gestiune_id=gid
-                )
-                db.session.add(new_comp)
-                db.session.flush()
-                company_map[r['id']] = new_comp.id
-                counts["companies"] += 1
-
-        # 3. Import Vehicles
-        if table_exists("vehicle"):
-            cols = get_columns("vehicle")
-            where = build_gestiune_filter("vehicle")
-            
-            select_cols = ["id", "plate_number"]
-            if "company_id" in cols: select_cols.append("company_id")
-            if "category_id" in cols: select_cols.append("category_id")
-            
-            src_cursor.execute(f"SELECT {', '.join(select_cols)} FROM vehicle{where}")
-            for row in src_cursor.fetchall():
-                r = dict(zip(select_cols, row))
-                new_veh = Vehicle(
-                    plate_number=r['plate_number'],
-                    company_id=company_map.get(r.get('company_id')),
-                    category_id=category_map.get(r.get('category_id')),
-                    gestiune_id=gid
-                )
-                db.session.add(new_veh)
-                db.session.flush()
-                vehicle_map[r['id']] = new_veh.id
-                counts["vehicles"] += 1
-
-        # 4. Import Stock Operations
-        if table_exists("stock_operation"):
-            cols = get_columns("stock_operation")
-            where = build_gestiune_filter("stock_operation")
-            
-            select_cols = ["operation_type", "quantity", "date"]
-            if "description" in cols: select_cols.append("description")
-            if "company_id" in cols: select_cols.append("company_id")
-            
-            src_cursor.execute(f"SELECT {', '.join(select_cols)} FROM stock_operation{where}")
-            for row in src_cursor.fetchall():
-                r = dict(zip(select_cols, row))
-                new_op = StockOperation(
-                    operation_type=r['operation_type'],
-                    quantity=r['quantity'],
-                    date=parse_sqlite_date(r['date']),
-                    description=r.get('description'),
-                    company_id=company_map.get(r.get('company_id')),
-                    gestiune_id=gid
-                )
-                db.session.add(new_op)
-                counts["stock"] += 1
-            db.session.flush()
-
-        # 5. Import Transactions
-        if table_exists("transaction"):
-            cols = get_columns("transaction")
-            where = build_gestiune_filter("transaction")
-            
-            select_cols = ["date", "vehicle_id", "company_id", "quantity"]
-            
-            src_cursor.execute(f"SELECT {', '.join(select_cols)} FROM [transaction]{where}")
-            for row in src_cursor.fetchall():
-                r = dict(zip(select_cols, row))
-                new_veh_id = vehicle_map.get(r['vehicle_id'])
-                if not new_veh_id:
-                    continue  # Skip orphaned transactions
-                
-                new_trans = Transaction(
-                    date=parse_sqlite_date(r['date']),
-                    vehicle_id=new_veh_id,
-                    company_id=company_map.get(r['company_id']),
-                    quantity=r['quantity'],
-                    gestiune_id=gid
-                )
-                db.session.add(new_trans)
-                counts["trans"] += 1
-            db.session.flush()
-
-        # 6. Import App Settings
-        if table_exists("app_settings"):
-            cols = get_columns("app_settings")
-            where = build_gestiune_filter("app_settings")
-            
-            src_cursor.execute(f"SELECT key, value FROM app_settings{where}")
-            for row in src_cursor.fetchall():
-                new_setting = AppSettings(
-                    key=row[0],
-                    value=row[1],
-                    gestiune_id=gid
-                )
-                db.session.add(new_setting)
-                counts["settings"] += 1
-            db.session.flush()
+        counts = import_profile(src_conn, gid)
 
         # ============================================================
         # PHASE 3: COMMIT
         # ============================================================
         db.session.commit()
+        SettingsService.invalidate(gid)
         
         print(f"[IMPORT] Phase 2 complete: {counts}")
         
@@ -3113,6 +3008,9 @@ def import_database():
                f"{counts['vehicles']} vehicule, {counts['stock']} op. stoc, "
                f"{counts['trans']} tranzacții, {counts['settings']} setări.")
         flash(msg, 'success')
+        if archive_cutoff:
+            flash(f"Perioada arhivată până la {archive_cutoff.strftime('%d.%m.%Y')} nu face parte din backup: "
+                  f"datele din anii arhivați nu au fost restaurate, iar arhivarea profilului a fost resetată.", 'warning')
         return redirect('/data-management')
         
     except Exception as e:
@@ -3125,9 +3023,10 @@ def import_database():
         if src_conn:
             try: src_conn.close()
             except Exception: pass
-        if os.path.exists(temp_path):
-            try: os.remove(temp_path)
-            except Exception: pass
+        for path in [temp_path] + part_paths:
+            if os.path.exists(path):
+                try: os.remove(path)
+                except Exception: pass
             
         BUSY_MODE = False
 
@@ -3442,11 +3341,13 @@ def handle_exception(e):
     """, 500
 
 if __name__ == '__main__':
+    # Frozen builds: let process-pool workers (parallel PDF rendering) start instead of a second app
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
     # 1. Initialize Database & Run Migrations
-    with app.app_context():
-        # Migrations are already run at module level
-        db.create_all()
-        print(f"Database initialized at: {get_database_path()}")
+    # (Tables and migrations are handled at module level by init_profiles)
+    print(f"Database initialized at: {get_database_path()}")
 
     # 2. Check Single Instance
     if is_already_running(5000):
@@ -3463,6 +3364,9 @@ if __name__ == '__main__':
         webbrowser.open('http://127.0.0.1:5000/') # Re-used import
         sys.exit(0)
 
+    # Undo/redo history compaction and stock checkpoints
+    start_background_workers()
+
     # 3. Initialize System Tray (Background)
     # This handles the "Exit" button and keeps the app "alive" visually
     from system_tray import SystemTrayManager
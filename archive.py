@@ -0,0 +1,337 @@
+"""
+Archival of closed periods into per-year SQLite files.
+
+Closing a period moves the transactions and stock operations of a gestiune
+dated before the cutoff out of fuel_manager.db into archive/fuel_archive_<year>.db
+(next to the main database) and replaces them with one INITIAL stock operation
+per company carrying the closing balance forward. Dashboard balances therefore
+only read the hot database.
+
+Only rows that make up a company balance are archived. Unallocated rows (stock
+operations without a company, transactions without a company, vehicle or
+vehicle category) stay in the hot tables whatever their date: the dashboard
+sums them without a date range, there is no balance to carry them forward in,
+and they can still be allocated later.
+
+Range queries that reach before the cutoff ATTACH the relevant year files on
+demand and UNION ALL them with the hot tables (transaction_source /
+stock_operation_source / fetch_transactions), so reports over archived months
+keep working unchanged.
+"""
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+from sqlalchemy import select, union_all, table, column
+
+ARCHIVE_DIRNAME = 'archive'
+ARCHIVE_CUTOFF_KEY = 'archive_cutoff'
+ARCHIVE_YEARS_KEY = 'archive_years'
+# Profile exports leave archived years out, so these settings are neither exported nor imported
+ARCHIVE_SETTING_KEYS = (ARCHIVE_CUTOFF_KEY, ARCHIVE_YEARS_KEY)
+ARCHIVED_TABLES = ('transaction', 'stock_operation')
+# Rows counted in the per-company balances; unallocated rows are never archived
+_ALLOCATED = {
+    'stock_operation': "company_id IS NOT NULL AND operation_type IN ('INITIAL', 'IN', 'OUT')",
+    'transaction': "company_id IS NOT NULL AND vehicle_id IN (SELECT id FROM main.vehicle WHERE category_id IS NOT NULL)",
+}
+# SQLite's default SQLITE_MAX_ATTACHED: files attachable to one connection
+MAX_ATTACHED = 10
+
+# Same text format SQLAlchemy uses for DateTime columns on SQLite
+_DATE_FMT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def get_archive_dir(db_path):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), ARCHIVE_DIRNAME)
+
+
+def get_archive_path(db_path, year):
+    return os.path.join(get_archive_dir(db_path), f'fuel_archive_{int(year)}.db')
+
+
+def _schema_name(year):
+    return f'archive_{int(year)}'
+
+
+def list_archive_years(db_path):
+    """Years that have an archive file next to `db_path`"""
+    archive_dir = get_archive_dir(db_path)
+    if not os.path.isdir(archive_dir):
+        return []
+    years = []
+    for name in os.listdir(archive_dir):
+        match = re.match(r'^fuel_archive_(\d{4})\.db$', name)
+        if match:
+            years.append(int(match.group(1)))
+    return sorted(years)
+
+
+# --- Closing a period (raw sqlite3, like migrations.py) ---
+
+def _year_bounds(year, cutoff):
+    start = datetime(year, 1, 1)
+    end = min(datetime(year + 1, 1, 1), cutoff)
+    return start.strftime(_DATE_FMT), end.strftime(_DATE_FMT)
+
+
+def close_period(db_path, gestiune_id, cutoff):
+    """
+    Archive every allocated transaction/stock operation of `gestiune_id` dated
+    before `cutoff` and carry the per-company balance forward as INITIAL entries
+    dated `cutoff`; unallocated rows stay hot. Runs in a single transaction
+    across the main and archive files.
+
+    Returns a summary dict: {'years': [...], 'transactions': n, 'stock_operations': n, 'openings': n}
+    """
+    cutoff_str = cutoff.strftime(_DATE_FMT)
+    # Manual transaction control: ATTACH is not allowed inside a transaction
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    attached = []
+    try:
+        years = [int(y) for (y,) in conn.execute(f"""
+            SELECT DISTINCT strftime('%Y', date) FROM [transaction] WHERE gestiune_id = ? AND date < ?
+              AND {_ALLOCATED['transaction']}
+            UNION
+            SELECT DISTINCT strftime('%Y', date) FROM stock_operation WHERE gestiune_id = ? AND date < ?
+              AND {_ALLOCATED['stock_operation']}
+        """, (gestiune_id, cutoff_str, gestiune_id, cutoff_str)).fetchall() if y]
+        summary = {'years': sorted(years), 'transactions': 0, 'stock_operations': 0, 'openings': 0}
+        if not years:
+            return summary
+
+        os.makedirs(get_archive_dir(db_path), exist_ok=True)
+        for year in summary['years']:
+            schema = _schema_name(year)
+            conn.execute("ATTACH DATABASE ? AS " + schema, (get_archive_path(db_path, year),))
+            attached.append(schema)
+            for tbl in ARCHIVED_TABLES:
+                # Plain copy of the column layout: archived ids are not re-checked for uniqueness
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {schema}.[{tbl}] AS SELECT * FROM main.[{tbl}] WHERE 0")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.ix_{tbl}_gestiune_date ON [{tbl}] (gestiune_id, date)")
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        # Closing balance per company, same formula as the dashboard:
+        # INITIAL + IN - OUT - consumption of categorised vehicles
+        balances = {}
+        for company_id, net in conn.execute("""
+            SELECT company_id, SUM(CASE operation_type WHEN 'OUT' THEN -quantity_cl ELSE quantity_cl END)
+            FROM stock_operation
+            WHERE gestiune_id = ? AND date < ? AND company_id IS NOT NULL
+              AND operation_type IN ('INITIAL', 'IN', 'OUT')
+            GROUP BY company_id
+        """, (gestiune_id, cutoff_str)):
+            balances[company_id] = balances.get(company_id, 0) + (net or 0)
+        for company_id, consumed in conn.execute("""
+            SELECT t.company_id, SUM(t.quantity_cl)
+            FROM [transaction] t JOIN vehicle v ON t.vehicle_id = v.id
+            WHERE t.gestiune_id = ? AND t.date < ? AND t.company_id IS NOT NULL AND v.category_id IS NOT NULL
+            GROUP BY t.company_id
+        """, (gestiune_id, cutoff_str)):
+            balances[company_id] = balances.get(company_id, 0) - (consumed or 0)
+
+        model_names = {'transaction': 'Transaction', 'stock_operation': 'StockOperation'}
+        for year in summary['years']:
+            schema = _schema_name(year)
+            start_str, end_str = _year_bounds(year, cutoff)
+            for tbl in ARCHIVED_TABLES:
+                cols = ', '.join(f'[{c[1]}]' for c in conn.execute(f"PRAGMA {schema}.table_info([{tbl}])"))
+                where = f"gestiune_id = ? AND date >= ? AND date < ? AND {_ALLOCATED[tbl]}"
+                params = (gestiune_id, start_str, end_str)
+                conn.execute(f"INSERT INTO {schema}.[{tbl}] ({cols}) SELECT {cols} FROM main.[{tbl}] WHERE {where}", params)
+                # Undo entries for moved rows can no longer be applied
+                conn.execute(f"""
+                    DELETE FROM history_log WHERE gestiune_id = ? AND table_name = ?
+                      AND record_id IN (SELECT id FROM main.[{tbl}] WHERE {where})
+                """, (gestiune_id, model_names[tbl]) + params)
+                moved = conn.execute(f"DELETE FROM main.[{tbl}] WHERE {where}", params).rowcount
+                summary['transactions' if tbl == 'transaction' else 'stock_operations'] += moved
+
+        description = f"Sold reportat la {cutoff.strftime('%d.%m.%Y')} (perioadă arhivată)"
+        for company_id, balance_cl in sorted(balances.items()):
+            if balance_cl == 0:
+                continue
+            conn.execute("""
+                INSERT INTO stock_operation (operation_type, quantity_cl, date, description, company_id, gestiune_id)
+                VALUES ('INITIAL', ?, ?, ?, ?, ?)
+            """, (balance_cl, cutoff_str, description, company_id, gestiune_id))
+            summary['openings'] += 1
+
+        # Years holding rows of this gestiune, so reads attach only those files
+        row = conn.execute("SELECT value FROM app_settings WHERE key = ? AND gestiune_id = ?",
+                           (ARCHIVE_YEARS_KEY, gestiune_id)).fetchone()
+        archived_years = set(_parse_years(row[0] if row else None)) | set(summary['years'])
+        for key, value in ((ARCHIVE_CUTOFF_KEY, cutoff.strftime('%Y-%m-%dT%H:%M')),
+                           (ARCHIVE_YEARS_KEY, ','.join(str(y) for y in sorted(archived_years)))):
+            conn.execute("DELETE FROM app_settings WHERE key = ? AND gestiune_id = ?", (key, gestiune_id))
+            conn.execute("INSERT INTO app_settings (key, value, gestiune_id) VALUES (?, ?, ?)", (key, value, gestiune_id))
+        conn.execute("COMMIT")
+        print(f"[ARCHIVE] Gestiune {gestiune_id} closed before {cutoff_str}: {summary}")
+        return summary
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        for schema in attached:
+            try: conn.execute("DETACH DATABASE " + schema)
+            except sqlite3.Error: pass
+        conn.close()
+
+
+# --- Reading archived years through the SQLAlchemy session ---
+
+def get_archive_cutoff(gestiune_id):
+    from services import SettingsService
+    value = SettingsService.get(gestiune_id, ARCHIVE_CUTOFF_KEY)
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M') if value else None
+
+
+def _parse_years(value):
+    return [int(y) for y in value.split(',') if y.strip()] if value else []
+
+
+def get_archived_years(gestiune_id, db_path):
+    """Years archived for `gestiune_id`; every archive file for periods closed before the list was kept"""
+    from services import SettingsService
+    value = SettingsService.get(gestiune_id, ARCHIVE_YEARS_KEY)
+    return _parse_years(value) if value else list_archive_years(db_path)
+
+
+def _attach_for_range(gestiune_id, start_date, end_date):
+    """
+    ATTACH the archive files overlapping [start_date, end_date] to the session's
+    connection and return their schema names. Empty when the range starts after
+    the archive cutoff, so day-to-day queries never touch archive files.
+    """
+    from models import db
+    cutoff = get_archive_cutoff(gestiune_id)
+    if cutoff is None or (start_date is not None and start_date >= cutoff):
+        return []
+    db_path = db.engine.url.database
+    if not db_path or db_path == ':memory:':
+        return []
+
+    first_year = start_date.year if start_date else 0
+    last_year = min(end_date.year if end_date else cutoff.year, cutoff.year)
+    years = [y for y in get_archived_years(gestiune_id, db_path) if first_year <= y <= last_year]
+    if not years:
+        return []
+    # A partial source would silently undercount reports: every needed year attaches or the query fails
+    if len(years) > MAX_ATTACHED:
+        raise RuntimeError(f"Intervalul cuprinde {len(years)} ani arhivați; cel mult {MAX_ATTACHED} pot fi citiți odată.")
+
+    connection = db.session.connection()
+    attached = [row[1] for row in connection.exec_driver_sql("PRAGMA database_list")]
+    needed = [_schema_name(y) for y in years]
+    missing = [(y, s) for y, s in zip(years, needed) if s not in attached]
+    # Make room with archive years attached by earlier queries on this pooled connection
+    excess = len([s for s in attached if s not in ('main', 'temp')]) + len(missing) - MAX_ATTACHED
+    for schema in [s for s in attached if s.startswith('archive_') and s not in needed][:max(excess, 0)]:
+        connection.exec_driver_sql(f"DETACH DATABASE {schema}")
+    for year, schema in missing:
+        path = get_archive_path(db_path, year)
+        if not os.path.exists(path):
+            raise RuntimeError(f"Fișierul arhivei {year} lipsește ({path}).")
+        try:
+            connection.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (path,))
+        except Exception as e:
+            # e.g. pending writes in this session (ATTACH is refused inside a transaction) or a locked file
+            raise RuntimeError(f"Arhiva {year} nu poate fi deschisă: {e}") from e
+    return needed
+
+
+def _archived_table(hot, schema):
+    # Same column names and types as the hot table, so dates bind and load as datetimes
+    return table(hot.name, *[column(c.name, c.type) for c in hot.columns], schema=schema)
+
+
+def _union_source(model, gestiune_id, start_date, end_date):
+    hot = model.__table__
+    schemas = _attach_for_range(gestiune_id, start_date, end_date)
+    if not schemas:
+        return hot
+    parts = [select(*hot.columns)]
+    for schema in schemas:
+        parts.append(select(*_archived_table(hot, schema).columns))
+    return union_all(*parts).subquery(f'{hot.name}_all')
+
+
+def transaction_source(gestiune_id, start_date, end_date):
+    """
+    FROM-clause for Transaction rows of a date range: the hot table itself, or a
+    UNION ALL with the archived years when the range reaches before the cutoff.
+    Query it through `.c` (e.g. `src.c.quantity_cl`).
+    """
+    from models import Transaction
+    return _union_source(Transaction, gestiune_id, start_date, end_date)
+
+
+def stock_operation_source(gestiune_id, start_date, end_date):
+    """StockOperation counterpart of transaction_source()"""
+    from models import StockOperation
+    return _union_source(StockOperation, gestiune_id, start_date, end_date)
+
+
+class ArchivedTransaction:
+    """Read-only stand-in for a Transaction row stored in an archive file"""
+    __slots__ = ('id', 'date', 'vehicle_id', 'company_id', 'quantity_cl', 'gestiune_id')
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            setattr(self, name, row._mapping[name])
+
+    @property
+    def quantity(self):
+        from models import to_liters
+        return to_liters(self.quantity_cl)
+
+    @property
+    def vehicle(self):
+        from models import db, Vehicle
+        return db.session.get(Vehicle, self.vehicle_id) if self.vehicle_id else None
+
+    @property
+    def company(self):
+        from models import db, Company
+        return db.session.get(Company, self.company_id) if self.company_id else None
+
+
+def fetch_transactions(gestiune_id, start_date, end_date, company_id=None, by_company=False):
+    """
+    Transactions of a date range ordered by date (or by company, then date):
+    ORM objects from the hot table plus ArchivedTransaction rows for archived years.
+    """
+    from models import db, Transaction
+    query = Transaction.query.filter(
+        Transaction.gestiune_id == gestiune_id,
+        Transaction.date >= start_date,
+        Transaction.date <= end_date
+    )
+    if company_id:
+        query = query.filter(Transaction.company_id == company_id)
+    order = (Transaction.company_id, Transaction.date) if by_company else (Transaction.date,)
+    transactions = query.order_by(*order).all()
+
+    schemas = _attach_for_range(gestiune_id, start_date, end_date)
+    if not schemas:
+        return transactions
+
+    for schema in schemas:
+        archived = _archived_table(Transaction.__table__, schema)
+        stmt = select(*[archived.c[n] for n in ArchivedTransaction.__slots__]).where(
+            archived.c.gestiune_id == gestiune_id,
+            archived.c.date >= start_date,
+            archived.c.date <= end_date
+        )
+        if company_id:
+            stmt = stmt.where(archived.c.company_id == company_id)
+        transactions.extend(ArchivedTransaction(row) for row in db.session.execute(stmt))
+
+    if by_company:
+        transactions.sort(key=lambda t: (t.company_id or 0, t.date))
+    else:
+        transactions.sort(key=lambda t: t.date)
+    return transactions
@@ -15,16 +15,7 @@ except Exception as e:
     print(f"ERROR: Cannot import services: {e}")
     sys.exit(1)
 
-def format_thousands(value, decimals=0):
-    try:
-        val = float(value)
-        if decimals > 0:
-            fmt = "{:,.%df}" % decimals
-            return fmt.format(val).replace(",", " ").replace(".", ",")
-        else:
-            return "{:,}".format(int(val)).replace(",", " ")
-    except:
-        return value
+from formatting import format_thousands
 
 def test_real_template():
     print("Starting REAL template PDF generation test...")
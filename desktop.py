@@ -4,7 +4,7 @@ import os
 import time
 import subprocess
 import webbrowser
-from app import app
+from app import app, start_background_workers
 
 def start_flask():
     """Start Flask server in a background thread"""
@@ -39,6 +39,7 @@ def open_browser_app(url):
 def main():
     """Main desktop application entry point"""
     print("Starting Fuel Manager...")
+    start_background_workers()
     
     # Start Flask in background thread
     flask_thread = threading.Thread(target=start_flask, daemon=True)
@@ -16,13 +16,6 @@ try:
 except:
     pass
 
-# Import the Flask app factory or app object
-try:
-    from app import app
-except ImportError:
-    print("Error importing Flask app. Make sure app.py is in the same directory.")
-    sys.exit(1)
-
 START_PORT = 5000
 START_URL = f"http://127.0.0.1:{START_PORT}"
 
@@ -61,9 +54,21 @@ def start_flask():
     app.run(host='127.0.0.1', port=START_PORT, debug=False, use_reloader=False)
 
 if __name__ == "__main__":
+    # Frozen builds: let process-pool workers (parallel PDF rendering) start instead of a second app
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
     # Set Desktop Mode flag to disable heartbeat/auto-shutdown
     import os
     os.environ['DESKTOP_MODE'] = '1'
+
+    # Import the Flask app only here, after freeze_support(): pool workers never load it
+    try:
+        from app import app, start_background_workers
+    except ImportError:
+        print("Error importing Flask app. Make sure app.py is in the same directory.")
+        sys.exit(1)
+    start_background_workers()
     
     # 1. Start Flask in a background thread
     server_thread = threading.Thread(target=start_flask)
@@ -1,6 +1,6 @@
 import os
 from flask import Flask
-from models import db, Gestiune, Company, StockOperation, Transaction, Vehicle
+from models import db, Gestiune, Company, StockOperation, Transaction, Vehicle, to_liters
 from extensions import db as db_ext
 from sqlalchemy import func
 
@@ -18,71 +18,71 @@ def run_diag():
             print(f"\n=== GESTIUNE ID: {g.id} ({g.name}) ===")
             gid = g.id
             
-            # Global Metrics (Old Logic)
-            total_consumed = db.session.query(func.sum(Transaction.quantity)).filter_by(gestiune_id=gid).scalar() or 0
-            total_initial = db.session.query(func.sum(StockOperation.quantity)).filter_by(gestiune_id=gid, operation_type='INITIAL').scalar() or 0
-            total_refill = db.session.query(func.sum(StockOperation.quantity)).filter_by(gestiune_id=gid, operation_type='IN').scalar() or 0
-            total_manual_out = db.session.query(func.sum(StockOperation.quantity)).filter_by(gestiune_id=gid, operation_type='OUT').scalar() or 0
+            # Global Metrics (Old Logic) - all sums are exact integer centiliters
+            total_consumed = db.session.query(func.sum(Transaction.quantity_cl)).filter_by(gestiune_id=gid).scalar() or 0
+            total_initial = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(gestiune_id=gid, operation_type='INITIAL').scalar() or 0
+            total_refill = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(gestiune_id=gid, operation_type='IN').scalar() or 0
+            total_manual_out = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(gestiune_id=gid, operation_type='OUT').scalar() or 0
             
             # Calculate components
             # 1. Fully allocated transactions
-            allocated_trans = db.session.query(func.sum(Transaction.quantity))\
+            allocated_trans = db.session.query(func.sum(Transaction.quantity_cl))\
                 .join(Vehicle, Transaction.vehicle_id == Vehicle.id)\
                 .filter(Transaction.gestiune_id == gid,
                         Transaction.company_id != None,
                         Vehicle.category_id != None).scalar() or 0
             
             # 2. Orphans (Assigned to company but no vehicle/cat)
-            orphan_trans = db.session.query(func.sum(Transaction.quantity))\
+            orphan_trans = db.session.query(func.sum(Transaction.quantity_cl))\
                 .outerjoin(Vehicle, Transaction.vehicle_id == Vehicle.id)\
                 .filter(Transaction.gestiune_id == gid,
                         Transaction.company_id != None,
                         db.or_(Transaction.vehicle_id == None, Vehicle.category_id == None)).scalar() or 0
             
             # 3. Direct unallocated (No company)
-            direct_unalloc_trans = db.session.query(func.sum(Transaction.quantity))\
+            direct_unalloc_trans = db.session.query(func.sum(Transaction.quantity_cl))\
                 .filter_by(company_id=None, gestiune_id=gid).scalar() or 0
             
-            print(f"Total Initial: {total_initial}")
-            print(f"Total Refill: {total_refill}")
-            print(f"Total Manual Out: {total_manual_out}")
-            print(f"Total Consumed (All): {total_consumed}")
-            print(f"  - Allocated: {allocated_trans}")
-            print(f"  - Orphans: {orphan_trans}")
-            print(f"  - Direct Unalloc: {direct_unalloc_trans}")
+            print(f"Total Initial: {to_liters(total_initial)}")
+            print(f"Total Refill: {to_liters(total_refill)}")
+            print(f"Total Manual Out: {to_liters(total_manual_out)}")
+            print(f"Total Consumed (All): {to_liters(total_consumed)}")
+            print(f"  - Allocated: {to_liters(allocated_trans)}")
+            print(f"  - Orphans: {to_liters(orphan_trans)}")
+            print(f"  - Direct Unalloc: {to_liters(direct_unalloc_trans)}")
             
             # Check sum
             calculated_total = (total_initial + total_refill) - (total_manual_out + total_consumed)
-            print(f"Calculated Total Stock: {calculated_total}")
+            print(f"Calculated Total Stock: {to_liters(calculated_total)}")
             
             # Check individual companies
             companies = Company.query.filter_by(gestiune_id=gid).all()
             total_company_stock = 0
             for c in companies:
-                c_initial = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='INITIAL').scalar() or 0
-                c_refill = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='IN').scalar() or 0
-                c_manual_out = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='OUT').scalar() or 0
-                c_consumed = db.session.query(func.sum(Transaction.quantity))\
+                c_initial = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='INITIAL').scalar() or 0
+                c_refill = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='IN').scalar() or 0
+                c_manual_out = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=c.id, gestiune_id=gid, operation_type='OUT').scalar() or 0
+                c_consumed = db.session.query(func.sum(Transaction.quantity_cl))\
                     .join(Vehicle, Transaction.vehicle_id == Vehicle.id)\
                     .filter(Transaction.company_id == c.id, 
                             Transaction.gestiune_id == gid,
                             Vehicle.category_id != None).scalar() or 0
                 c_current = c_initial + c_refill - c_manual_out - c_consumed
                 total_company_stock += c_current
-                print(f"  Company {c.name}: {c_current}")
+                print(f"  Company {c.name}: {to_liters(c_current)}")
             
-            print(f"Total Companies Stock: {total_company_stock}")
+            print(f"Total Companies Stock: {to_liters(total_company_stock)}")
             
             # Unallocated balance
-            unalloc_initial = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=None, gestiune_id=gid, operation_type='INITIAL').scalar() or 0
-            unalloc_in = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=None, gestiune_id=gid, operation_type='IN').scalar() or 0
-            unalloc_out = db.session.query(func.sum(StockOperation.quantity)).filter_by(company_id=None, gestiune_id=gid, operation_type='OUT').scalar() or 0
+            unalloc_initial = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=None, gestiune_id=gid, operation_type='INITIAL').scalar() or 0
+            unalloc_in = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=None, gestiune_id=gid, operation_type='IN').scalar() or 0
+            unalloc_out = db.session.query(func.sum(StockOperation.quantity_cl)).filter_by(company_id=None, gestiune_id=gid, operation_type='OUT').scalar() or 0
             unalloc_trans = orphan_trans + direct_unalloc_trans
             
             unalloc_balance = (unalloc_initial + unalloc_in) - (unalloc_out + unalloc_trans)
-            print(f"Unallocated Balance: {unalloc_balance}")
+            print(f"Unallocated Balance: {to_liters(unalloc_balance)}")
             
-            print(f"Sum (Company + Unalloc): {total_company_stock + unalloc_balance}")
+            print(f"Sum (Company + Unalloc): {to_liters(total_company_stock + unalloc_balance)}")
 
 if __name__ == "__main__":
     run_diag()
@@ -0,0 +1,18 @@
+"""
+Number formatting shared by the web templates (format_thousands filter) and
+the native PDF renderers, so both print the same figures.
+"""
+
+
+def format_thousands(value, decimals=0):
+    """Romanian grouping: "1 234,5" (space for thousands, comma for decimals)"""
+    try:
+        val = float(value)
+        if decimals > 0:
+            fmt = "{:,.%df}" % decimals
+            # First replace thousands comma with space, then replace decimal dot with comma
+            return fmt.format(val).replace(",", " ").replace(".", ",")
+        else:
+            return "{:,}".format(int(val)).replace(",", " ")
+    except (ValueError, TypeError):
+        return value
@@ -3,9 +3,47 @@ import unittest
 import os
 import json
 import base64
+from contextlib import contextmanager
+from datetime import datetime
 from app import app, db, DATA_DIR
 from models import Gestiune, Company, Transaction, Vehicle, VehicleCategory
 
+# Schema and rows of a database written before versioned migrations (user_version 0)
+BASELINE_DATABASE = '''
+    CREATE TABLE gestiune (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, site_code VARCHAR(50),
+        default_fuel_type VARCHAR(50), logo_path VARCHAR(200), created_at DATETIME, PRIMARY KEY (id), UNIQUE (name));
+    CREATE TABLE company (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, cui VARCHAR(20), address VARCHAR(200),
+        product_code VARCHAR(50), gestiune_id INTEGER, last_report_start DATETIME, last_report_end DATETIME,
+        PRIMARY KEY (id), CONSTRAINT _company_name_gestiune_uc UNIQUE (name, gestiune_id),
+        FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    CREATE TABLE app_settings (id INTEGER NOT NULL, "key" VARCHAR(50) NOT NULL, value VARCHAR(200), gestiune_id INTEGER,
+        PRIMARY KEY (id), CONSTRAINT _key_gestiune_uc UNIQUE ("key", gestiune_id), FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    CREATE TABLE vehicle_category (id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, description VARCHAR(200), icon VARCHAR(50),
+        gestiune_id INTEGER, PRIMARY KEY (id), CONSTRAINT _category_name_gestiune_uc UNIQUE (name, gestiune_id),
+        FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    CREATE TABLE history_log (id INTEGER NOT NULL, table_name VARCHAR(50), record_id INTEGER, action_type VARCHAR(20),
+        data_snapshot TEXT, pre_update_snapshot TEXT, timestamp DATETIME, is_undone BOOLEAN, gestiune_id INTEGER,
+        PRIMARY KEY (id), FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    CREATE TABLE vehicle (id INTEGER NOT NULL, plate_number VARCHAR(50) NOT NULL, company_id INTEGER, category_id INTEGER,
+        gestiune_id INTEGER, PRIMARY KEY (id), CONSTRAINT _plate_gestiune_uc UNIQUE (plate_number, gestiune_id),
+        FOREIGN KEY(company_id) REFERENCES company (id), FOREIGN KEY(category_id) REFERENCES vehicle_category (id),
+        FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    CREATE TABLE stock_operation (id INTEGER NOT NULL, operation_type VARCHAR(20), quantity FLOAT NOT NULL, date DATETIME,
+        description VARCHAR(200), company_id INTEGER, gestiune_id INTEGER, PRIMARY KEY (id),
+        FOREIGN KEY(company_id) REFERENCES company (id), FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    CREATE TABLE "transaction" (id INTEGER NOT NULL, date DATETIME NOT NULL, vehicle_id INTEGER, company_id INTEGER,
+        quantity FLOAT NOT NULL, gestiune_id INTEGER, PRIMARY KEY (id),
+        CONSTRAINT _date_vehicle_qty_gestiune_uc UNIQUE (date, vehicle_id, quantity, gestiune_id),
+        FOREIGN KEY(vehicle_id) REFERENCES vehicle (id) ON DELETE CASCADE,
+        FOREIGN KEY(company_id) REFERENCES company (id), FOREIGN KEY(gestiune_id) REFERENCES gestiune (id));
+    INSERT INTO gestiune (id, name) VALUES (1, 'VECHE');
+    INSERT INTO company (id, name, gestiune_id) VALUES (1, 'FIRMA', 1);
+    INSERT INTO vehicle (id, plate_number, company_id, gestiune_id) VALUES (1, 'CJ01OLD', 1, 1);
+    INSERT INTO stock_operation VALUES (1, 'INITIAL', 100.0, '2026-01-01 00:00:00.000000', NULL, 1, 1);
+    INSERT INTO "transaction" VALUES (1, '2026-01-02 08:00:00.000000', 1, 1, 10.5, 1);
+'''
+
+
 class FuelManagerFullTest(unittest.TestCase):
     def setUp(self):
         # Use a temporary in-memory database for testing
@@ -27,6 +65,95 @@ class FuelManagerFullTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Fuel Manager', response.data)
 
+    def test_sql_stats_header(self):
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        response = self.client.get('/')
+        self.assertGreater(int(response.headers['X-SQL-Queries']), 0)
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+    def test_request_profiler(self):
+        import pstats
+        profile_dir = os.path.join(DATA_DIR, 'logs', 'profiles')
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        # Off unless asked for
+        response = self.client.get('/')
+        self.assertNotIn('X-Profile-Report', response.headers)
+
+        response = self.client.get('/?_profile=1')
+        self.assertEqual(response.status_code, 200)
+        report = os.path.join(profile_dir, response.headers['X-Profile-Report'])
+        try:
+            with open(report, encoding='utf-8') as f:
+                text = f.read()
+            self.assertIn('Timp cumulat', text)
+            self.assertIn('function calls', text)
+            self.assertGreater(pstats.Stats(report[:-len('.html')] + '.prof').total_calls, 0)
+        finally:
+            for path in (report, report[:-len('.html')] + '.prof'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_metrics_endpoint(self):
+        import re
+        import tempfile
+        import metrics
+        pdf_path = os.path.join(tempfile.mkdtemp(), 'r.pdf')
+        with open(pdf_path, 'wb') as f:
+            f.write(b'%PDF-1.3 /Type /Page /Type /Page')
+
+        @metrics.track_pdf('test')
+        def fake_report(hit):
+            if hit:
+                metrics.note_pdf_cache_hit()
+            return pdf_path, "ok"
+
+        def pages_total():
+            return metrics._counters.get('fuel_pdf_pages_total', {}).get((('report', 'test'),), 0)
+
+        try:
+            fake_report(False)
+            self.assertEqual(pages_total(), 2)
+            # A cache hit is timed under cache="hit" but its pages are not counted again
+            fake_report(True)
+            self.assertEqual(pages_total(), 2)
+        finally:
+            os.remove(pdf_path)
+            os.rmdir(os.path.dirname(pdf_path))
+
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        self.client.get('/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        text = response.get_data(as_text=True)
+        self.assertTrue(text.endswith('\n'))
+
+        sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)'
+                            r'(\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*"(?:,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*")*\})?'
+                            r' (\S+)$')
+        types = {}
+        samples = []
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                continue
+            if line.startswith('# TYPE '):
+                _, _, name, kind = line.split(' ')
+                self.assertIn(kind, ('counter', 'gauge', 'histogram'))
+                types[name] = kind
+                continue
+            m = sample.match(line)
+            self.assertIsNotNone(m, line)
+            float(m.group(3))
+            name = m.group(1)
+            family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in types else name
+            self.assertIn(family, types, line)
+            samples.append(line)
+        self.assertTrue(samples)
+        self.assertTrue(any('cache="hit"' in s and s.startswith('fuel_pdf_generation_seconds_count') for s in samples))
+
     def test_company_color_logic(self):
         with app.app_context():
             c1 = Company(name="TRANSGAT-SORT", gestiune_id=self.gest_id)
@@ -69,10 +196,960 @@ class FuelManagerFullTest(unittest.TestCase):
         # Check if our new Snapshot button exists
         self.assertIn(b'Snapshot', response.data)
 
+    def test_schema_version_current(self):
+        from app import get_database_path
+        from migrations import get_schema_version, has_pending_migrations, SCHEMA_VERSION
+        self.assertEqual(get_schema_version(get_database_path()), SCHEMA_VERSION)
+        self.assertFalse(has_pending_migrations(get_database_path()))
+
+    def test_quantity_centiliters(self):
+        from sqlalchemy import func
+        from models import to_liters
+        with app.app_context():
+            v = Vehicle(plate_number="B01TST", gestiune_id=self.gest_id)
+            db.session.add(v)
+            db.session.flush()
+            for i, qty in enumerate([0.1, 0.2, 26005 / 100.0]):
+                db.session.add(Transaction(date=datetime(2026, 1, 1, 8, i), vehicle_id=v.id, quantity=qty, gestiune_id=self.gest_id))
+            db.session.commit()
+
+            t = Transaction.query.filter_by(vehicle_id=v.id).order_by(Transaction.date).first()
+            self.assertEqual(t.quantity_cl, 10)
+            self.assertEqual(t.quantity, 0.1)
+            total = db.session.query(func.sum(Transaction.quantity_cl)).filter_by(gestiune_id=self.gest_id).scalar()
+            self.assertEqual(total, 26035)
+            self.assertEqual(to_liters(total), 260.35)
+
+    def test_centiliter_migration_keeps_colliding_rows(self):
+        import sqlite3
+        from migrations import _convert_quantities_to_centiliters
+        conn = sqlite3.connect(':memory:')
+        conn.executescript('''
+            CREATE TABLE [transaction] (id INTEGER PRIMARY KEY, date DATETIME NOT NULL, vehicle_id INTEGER,
+                company_id INTEGER, quantity FLOAT, gestiune_id INTEGER,
+                UNIQUE (date, vehicle_id, quantity, gestiune_id));
+            INSERT INTO [transaction] VALUES (1, '2026-01-01 08:00:00', 5, 1, 10.001, 1),
+                                             (2, '2026-01-01 08:00:00', 5, 1, 10.004, 1),
+                                             (3, '2026-01-01 08:00:00', NULL, 1, 10.0, 1),
+                                             (4, '2026-01-01 08:00:00', NULL, 1, 10.0, 1);
+        ''')
+        with self.assertRaises(RuntimeError) as ctx:
+            _convert_quantities_to_centiliters(conn)
+        self.assertIn('1,2', str(ctx.exception))
+        self.assertNotIn('3,4', str(ctx.exception))
+        # Nothing converted, nothing lost
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM [transaction]").fetchone()[0], 4)
+        self.assertIsNone(conn.execute("SELECT name FROM sqlite_master WHERE name = 'transaction_cl_new'").fetchone())
+        conn.close()
+
+    @contextmanager
+    def _swapped_database(self, script):
+        """Run the block with the app's database file replaced by one built from `script`"""
+        import sqlite3
+        from app import DB_PATH
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        saved = DB_PATH + '.saved'
+        os.replace(DB_PATH, saved)
+        try:
+            conn = sqlite3.connect(DB_PATH)
+            conn.executescript(script)
+            conn.close()
+            yield DB_PATH
+        finally:
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+            os.replace(saved, DB_PATH)
+
+    def test_upgrade_baseline_database(self):
+        import sqlite3
+        from app import run_migrations
+        from migrations import SCHEMA_VERSION
+        with self._swapped_database(BASELINE_DATABASE) as db_path:
+            with app.app_context():
+                run_migrations()
+                db.session.remove()
+                db.engine.dispose()
+
+            conn = sqlite3.connect(db_path)
+            try:
+                self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+                self.assertEqual(conn.execute("SELECT id, quantity_cl FROM [transaction]").fetchall(), [(1, 1050)])
+                self.assertEqual(conn.execute("SELECT id, quantity_cl FROM stock_operation").fetchall(), [(1, 10000)])
+                self.assertEqual(conn.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_cl_new'").fetchall(), [])
+                triggers = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+                self.assertIn('trg_vehicle_checkpoint_category', triggers)
+                self.assertIn('trg_transaction_backup_insert', triggers)
+            finally:
+                conn.close()
+
+    def test_upgrade_resumes_interrupted_table_swap(self):
+        import sqlite3
+        from app import run_migrations
+        # Stopped after copying the converted rows and dropping the old table, before the rename
+        script = BASELINE_DATABASE + """
+            CREATE TABLE transaction_cl_new (id INTEGER NOT NULL PRIMARY KEY, date DATETIME NOT NULL,
+                vehicle_id INTEGER, company_id INTEGER, quantity_cl INTEGER NOT NULL, gestiune_id INTEGER,
+                CONSTRAINT _date_vehicle_qty_gestiune_uc UNIQUE (date, vehicle_id, quantity_cl, gestiune_id));
+            INSERT INTO transaction_cl_new
+                SELECT id, date, vehicle_id, company_id, CAST(ROUND(quantity * 100) AS INTEGER), gestiune_id FROM "transaction";
+            DROP TABLE "transaction";
+        """
+        with self._swapped_database(script) as db_path:
+            with app.app_context():
+                run_migrations()
+                db.session.remove()
+                db.engine.dispose()
+
+            conn = sqlite3.connect(db_path)
+            try:
+                self.assertEqual(conn.execute("SELECT id, quantity_cl FROM [transaction]").fetchall(), [(1, 1050)])
+                self.assertEqual(conn.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_cl_new'").fetchall(), [])
+            finally:
+                conn.close()
+
+    def test_migration_failure_blocks_startup(self):
+        import sqlite3
+        import app as app_module
+        # Two fills that only differ below a centilitre collide once rounded: migration v3 must refuse
+        script = BASELINE_DATABASE + """
+            INSERT INTO "transaction" VALUES (2, '2026-01-03 08:00:00.000000', 1, 1, 10.001, 1);
+            INSERT INTO "transaction" VALUES (3, '2026-01-03 08:00:00.000000', 1, 1, 10.004, 1);
+        """
+        try:
+            with self._swapped_database(script) as db_path:
+                app_module.init_profiles()
+                self.assertIn('transaction', app_module.MIGRATION_ERROR)
+                conn = sqlite3.connect(db_path)
+                try:
+                    self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 2)
+                    self.assertIn('quantity', [row[1] for row in conn.execute('PRAGMA table_info("transaction")')])
+                finally:
+                    conn.close()
+
+                response = self.client.get('/')
+                self.assertEqual(response.status_code, 503)
+                self.assertIn('Actualizarea bazei de date a eșuat', response.get_data(as_text=True))
+        finally:
+            app_module.MIGRATION_ERROR = None
+
+    def test_settings_cache(self):
+        from services import SettingsService
+        from models import AppSettings
+        with app.app_context():
+            self.assertEqual(SettingsService.get_tank_capacity(self.gest_id), 27000.0)
+            SettingsService.set_many(self.gest_id, {'tank_capacity': 30000, 'app_theme': 'dark'})
+            self.assertEqual(SettingsService.get_tank_capacity(self.gest_id), 30000.0)
+            self.assertEqual(AppSettings.query.filter_by(key='app_theme', gestiune_id=self.gest_id).first().value, 'dark')
+
+            # Direct writes are only seen after invalidation
+            AppSettings.query.filter_by(key='app_theme', gestiune_id=self.gest_id).update({'value': 'light'})
+            db.session.commit()
+            self.assertEqual(SettingsService.get(self.gest_id, 'app_theme'), 'dark')
+            SettingsService.invalidate(self.gest_id)
+            self.assertEqual(SettingsService.get(self.gest_id, 'app_theme'), 'light')
+
+    def test_archive_closed_period(self):
+        import shutil
+        import sqlite3
+        import tempfile
+        from sqlalchemy import func
+        from app import DB_PATH
+        from archive import close_period, transaction_source, get_archive_dir, get_archive_path
+        from models import StockOperation
+        from profile_export import export_profile
+        from services import SettingsService
+        try:
+            with app.app_context():
+                cat = VehicleCategory(name="VOLA", gestiune_id=self.gest_id)
+                comp = Company(name="ARCH CO", gestiune_id=self.gest_id)
+                db.session.add_all([cat, comp])
+                db.session.flush()
+                v = Vehicle(plate_number="CV01ARH", gestiune_id=self.gest_id, company_id=comp.id, category_id=cat.id)
+                db.session.add(v)
+                db.session.flush()
+                db.session.add(StockOperation(operation_type='INITIAL', quantity=1000, company_id=comp.id, gestiune_id=self.gest_id, date=datetime(2024, 12, 1)))
+                db.session.add(Transaction(date=datetime(2024, 12, 5), vehicle_id=v.id, company_id=comp.id, quantity=100.5, gestiune_id=self.gest_id))
+                db.session.add(Transaction(date=datetime(2025, 1, 5), vehicle_id=v.id, company_id=comp.id, quantity=50, gestiune_id=self.gest_id))
+                # Unallocated rows: no company balance carries them forward
+                loose = Vehicle(plate_number="CV02ARH", gestiune_id=self.gest_id, company_id=comp.id)
+                db.session.add(loose)
+                db.session.flush()
+                db.session.add(Transaction(date=datetime(2024, 11, 5), vehicle_id=loose.id, company_id=comp.id, quantity=7, gestiune_id=self.gest_id))
+                db.session.add(StockOperation(operation_type='OUT', quantity=3, gestiune_id=self.gest_id, date=datetime(2024, 11, 6)))
+                db.session.commit()
+                comp_id, vehicle_id, loose_id = comp.id, v.id, loose.id
+                db.session.remove()
+
+                summary = close_period(DB_PATH, self.gest_id, datetime(2025, 1, 1))
+                SettingsService.invalidate(self.gest_id)
+                self.assertEqual(summary['years'], [2024])
+                self.assertEqual(summary['transactions'], 1)
+
+                # Hot tables keep only the open period plus the carried-forward balance...
+                self.assertEqual(Transaction.query.filter_by(gestiune_id=self.gest_id, vehicle_id=vehicle_id).count(), 1)
+                opening = StockOperation.query.filter_by(gestiune_id=self.gest_id, operation_type='INITIAL').one()
+                self.assertEqual((opening.company_id, opening.quantity_cl), (comp_id, 89950))
+                # ...and the unallocated rows, whatever their date
+                self.assertEqual(Transaction.query.filter_by(gestiune_id=self.gest_id, vehicle_id=loose_id).count(), 1)
+                self.assertEqual(StockOperation.query.filter_by(gestiune_id=self.gest_id, company_id=None).count(), 1)
+
+                # Ranges reaching into the archive union the attached year file
+                start, end = datetime(2024, 1, 1), datetime(2025, 12, 31)
+                src = transaction_source(self.gest_id, start, end)
+                total = db.session.query(func.sum(src.c.quantity_cl)).filter(
+                    src.c.gestiune_id == self.gest_id, src.c.date >= start, src.c.date <= end).scalar()
+                self.assertEqual(total, 15750)
+                self.assertEqual(SettingsService.get(self.gest_id, 'archive_years'), '2024')
+                db.session.remove()
+
+                # Exports hold the hot rows only, so they must not carry the archive cutoff either
+                export_path = os.path.join(tempfile.mkdtemp(), 'export.db')
+                export_profile(DB_PATH, self.gest_id, export_path)
+                conn = sqlite3.connect(export_path)
+                try:
+                    self.assertEqual(conn.execute("SELECT COUNT(*) FROM app_settings WHERE key LIKE 'archive_%'").fetchone()[0], 0)
+                    self.assertEqual(conn.execute("SELECT COUNT(*) FROM [transaction]").fetchone()[0], 2)
+                finally:
+                    conn.close()
+
+                # A missing year file fails the query instead of dropping the year from the totals
+                db.engine.dispose()
+                os.remove(get_archive_path(DB_PATH, 2024))
+                with self.assertRaises(RuntimeError):
+                    transaction_source(self.gest_id, None, end)
+                db.session.remove()
+        finally:
+            shutil.rmtree(get_archive_dir(DB_PATH), ignore_errors=True)
+
+    def test_series_codes(self):
+        from services import assign_series_code, get_series_codes
+        with app.app_context():
+            other = Gestiune(name="Serii")
+            db.session.add(other)
+            db.session.flush()
+            first = Company(name="TRANSGAT SORT", gestiune_id=self.gest_id)
+            second = Company(name="TRANSGAT-SORT", gestiune_id=other.id)
+            short = Company(name="AB", gestiune_id=self.gest_id)
+            for c in (first, second, short):
+                db.session.add(c)
+                assign_series_code(c)
+            db.session.commit()
+            # Codes stay unique across gestiuni; short names print "---"
+            self.assertEqual((first.series_code, second.series_code, short.series_code), ("TRT", "TST", None))
+            self.assertEqual(get_series_codes(self.gest_id), {first.id: "TRT"})
+
+            # Renaming recomputes only the renamed company; missing codes are filled on read
+            first.name = "VINATI"
+            assign_series_code(first)
+            second.series_code = None
+            db.session.commit()
+            self.assertEqual(first.series_code, "VII")
+            self.assertEqual(get_series_codes(other.id), {second.id: "TRT"})
+            db.session.remove()
+
+    def test_report_cache_key(self):
+        import shutil
+        import tempfile
+        import report_cache
+        with app.app_context():
+            comp = Company(name="CACHE CO", gestiune_id=self.gest_id)
+            db.session.add(comp)
+            db.session.flush()
+            v = Vehicle(plate_number="CJ01CAC", gestiune_id=self.gest_id, company_id=comp.id)
+            db.session.add(v)
+            db.session.flush()
+            t = Transaction(date=datetime(2026, 2, 3), vehicle_id=v.id, company_id=comp.id, quantity=40, gestiune_id=self.gest_id)
+            db.session.add(t)
+            db.session.commit()
+
+            start, end = datetime(2026, 2, 1), datetime(2026, 2, 28, 23, 59)
+            key = lambda: report_cache.make_key('lunar', self.gest_id, start=start, end=end,
+                                                data=report_cache.data_version(self.gest_id, start, end, stock=True))
+            first = key()
+            self.assertEqual(first, key())
+            t.quantity = 41
+            db.session.commit()
+            self.assertNotEqual(first, key())
+
+            # Edits that keep the plain sums (swapped quantities, a moved date) still change the key
+            other = Transaction(date=datetime(2026, 2, 4), vehicle_id=v.id, company_id=comp.id, quantity=30, gestiune_id=self.gest_id)
+            db.session.add(other)
+            db.session.commit()
+            before = key()
+            t.quantity, other.quantity = 30, 41
+            db.session.commit()
+            swapped = key()
+            self.assertNotEqual(before, swapped)
+            t.date = datetime(2026, 2, 5)
+            db.session.commit()
+            self.assertNotEqual(swapped, key())
+
+            # Stored files are copied to the requested path on every hit
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                pdf_path = os.path.join(tmp_dir, 'r.pdf')
+                copy_path = os.path.join(tmp_dir, 'copy.pdf')
+                with open(pdf_path, 'wb') as f:
+                    f.write(b'%PDF-1.3 test')
+                self.assertIsNone(report_cache.fetch('lunar', first, pdf_path))
+                report_cache.store(first, pdf_path, "ok")
+                # The earlier delivered file was changed since (same size): not served
+                with open(pdf_path, 'wb') as f:
+                    f.write(b'%PDF-1.3 edit')
+                self.assertEqual(report_cache.fetch('lunar', first, copy_path), (copy_path, "ok"))
+                os.remove(pdf_path)
+                self.assertEqual(report_cache.fetch('lunar', first, pdf_path), (pdf_path, "ok"))
+                for path in (pdf_path, copy_path):
+                    with open(path, 'rb') as f:
+                        self.assertEqual(f.read(), b'%PDF-1.3 test')
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                shutil.rmtree(report_cache.get_cache_dir(), ignore_errors=True)
+            db.session.remove()
+
+    def test_report_job_queue(self):
+        import time
+        import report_jobs
+
+        def fake_report(pages):
+            report_jobs.set_progress(pages=pages, total_pages=pages)
+            return os.path.join(DATA_DIR, 'raport.pdf'), "gata"
+
+        job_id = report_jobs.submit(app, 'test', self.gest_id, fake_report, 3)
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        for _ in range(100):
+            job = self.client.get(f'/admin/report_jobs/{job_id}').get_json()
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.02)
+        self.assertEqual((job['status'], job['pages'], job['filename'], job['message']),
+                         ('success', 3, 'raport.pdf', "gata"))
+        self.assertEqual(self.client.get('/admin/report_jobs/unknown').status_code, 404)
+
+    def test_analysis_pdf_native(self):
+        import tempfile
+        from metrics import count_pdf_pages
+        from pdf_analysis import render_analysis_pdf
+        row = {'category': 'EXCAVATOR', 'fuel': 1200.5, 'mc_val': 3000.0, 'basis_name': 'TOTAL BALAST SORTAT', 'efficiency': 0.4}
+        data = dict(gestiune_name='Test Profile', logo_base64=None, start_date='01.01.2026', end_date='31.01.2026',
+                    net_fuel=1200.5, eff_vanduti=0.4, mc_vanduti=3000, eff_sortati=0.4, mc_sortati=3000,
+                    total_fuel_ghid=80, eff_ghid=0.1, mc_ghid=800, generated_at='01.02.2026 08:00:00',
+                    budila_data=[row], ghidfalau_data=[dict(row, category='GHIDFALAU')])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, 'analiza.pdf')
+            render_analysis_pdf(data, filepath)
+            self.assertEqual(count_pdf_pages(filepath), 2)
+            data['ghidfalau_data'] = []
+            render_analysis_pdf(data, filepath)
+            self.assertEqual(count_pdf_pages(filepath), 1)
+
+    def test_slips_parallel_matches_sequential(self):
+        import tempfile
+        from types import SimpleNamespace
+        from unittest import mock
+        from pypdf import PdfReader
+        import pdf_slips
+        from services import build_slips
+
+        rows = []
+        for company_id, size in ((1, 7), (2, 30), (3, 3), (4, 11)):
+            company = SimpleNamespace(name=f"FIRMA {company_id}", cui=f"RO{company_id}", address="-")
+            rows += [(company_id, company, f"CJ{i:02d}ABC", datetime(2026, 1, 1 + i % 28), 10.5 + i)
+                     for i in range(size)]
+        slips = build_slips(rows, {1: 'AAA', 2: 'BBB'})
+
+        chunks = pdf_slips.partition_slips(slips, 4)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], len(slips))
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(start % pdf_slips.SLIPS_PER_PAGE, 0)
+
+        def pages(path):
+            return [page.extract_text() for page in PdfReader(path).pages]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sequential = os.path.join(tmp_dir, 'seq.pdf')
+            parallel = os.path.join(tmp_dir, 'par.pdf')
+            pdf_slips.write_slips_pdf(slips, "12", sequential)
+            with mock.patch.object(pdf_slips, 'PARALLEL_MIN_SLIPS', 1), \
+                    mock.patch.object(pdf_slips.os, 'cpu_count', return_value=4):
+                pdf_slips.write_slips_pdf(slips, "12", parallel)
+            expected, merged = pages(sequential), pages(parallel)
+
+        self.assertEqual(len(expected), -(-len(slips) // pdf_slips.SLIPS_PER_PAGE))
+        self.assertEqual(len(merged), len(expected))
+        for number, (a, b) in enumerate(zip(expected, merged), 1):
+            self.assertIn(f"Pagina {number}", b)
+            self.assertEqual(a, b)
+
+    def test_slip_blocks_replay(self):
+        import tempfile
+        from types import SimpleNamespace
+        from unittest import mock
+        from pypdf import PdfReader
+        import pdf_slips
+        from services import build_slips
+
+        rows = []
+        for company_id, size in ((1, 3), (2, 4)):
+            company = SimpleNamespace(name=f"FIRMĂ {company_id}", cui=None, address="Str. Șoseaua")
+            rows += [(company_id, company, f"CJ{i:02d}BLK", datetime(2026, 3, 1 + i), 20 + i * 1.25)
+                     for i in range(size)]
+        slips = build_slips(rows, {1: 'BLK'})
+
+        def render(path):
+            pdf_slips.render_slips(slips, "7").output(path)
+            return [page.extract_text() for page in PdfReader(path).pages]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            replayed = render(os.path.join(tmp_dir, 'replayed.pdf'))
+            # Every block drawn from scratch, as before the recorded templates
+            with mock.patch.object(pdf_slips.SlipPDF, 'block', lambda pdf, key, draw: draw()):
+                drawn = render(os.path.join(tmp_dir, 'drawn.pdf'))
+
+        self.assertEqual(len(replayed), 4)
+        self.assertEqual(replayed, drawn)
+        self.assertIn("FIRMA 2", replayed[-1])
+        self.assertIn("Semnatura Sofer:", replayed[-1])
+
+    def test_month_close_snapshot(self):
+        from models import StockOperation
+        from month_close import PeriodSnapshot
+        with app.app_context():
+            cat = VehicleCategory(name="EXCAVATOR", gestiune_id=self.gest_id)
+            comp = Company(name="CLOSE CO", gestiune_id=self.gest_id)
+            db.session.add_all([cat, comp])
+            db.session.flush()
+            v = Vehicle(plate_number="CV01CLS", gestiune_id=self.gest_id, company_id=comp.id, category_id=cat.id)
+            db.session.add(v)
+            db.session.flush()
+            db.session.add_all([
+                Transaction(date=datetime(2026, 5, 3), vehicle_id=v.id, company_id=comp.id, quantity=20.5, gestiune_id=self.gest_id),
+                Transaction(date=datetime(2026, 5, 2), vehicle_id=v.id, company_id=comp.id, quantity=10, gestiune_id=self.gest_id),
+                Transaction(date=datetime(2026, 6, 1), vehicle_id=v.id, company_id=comp.id, quantity=5, gestiune_id=self.gest_id),
+                StockOperation(operation_type='INITIAL', quantity=100, date=datetime(2026, 1, 1), company_id=comp.id, gestiune_id=self.gest_id),
+                StockOperation(operation_type='IN', quantity=50, date=datetime(2026, 5, 10), company_id=comp.id, gestiune_id=self.gest_id),
+                StockOperation(operation_type='OUT', quantity=7, date=datetime(2026, 6, 10), company_id=comp.id, gestiune_id=self.gest_id),
+            ])
+            db.session.commit()
+
+            snap = PeriodSnapshot(self.gest_id, datetime(2026, 5, 1), datetime(2026, 5, 31, 23, 59))
+            self.assertEqual(len(snap), 2)
+            self.assertEqual(snap.company_sums()[comp.id], (10000, 5000, 0, 3050))
+            self.assertEqual(snap.slip_rows()[comp.id], [("CV01CLS", datetime(2026, 5, 2), 10.0),
+                                                         ("CV01CLS", datetime(2026, 5, 3), 20.5)])
+            self.assertEqual(snap.category_fuel(), [("EXCAVATOR", 30.5)])
+            self.assertEqual([row['company'] for row in snap.chronological()], ["CLOSE CO", "CLOSE CO"])
+            db.session.remove()
+
+    def test_month_close_zip_entries(self):
+        import zipfile
+        from month_close import generate_month_close
+        with app.app_context():
+            # Both names sanitize to "A_B_SRL"
+            comp_dot = Company(name="A.B SRL", gestiune_id=self.gest_id)
+            comp_dash = Company(name="A-B SRL", gestiune_id=self.gest_id)
+            db.session.add_all([comp_dot, comp_dash])
+            db.session.flush()
+            for i, comp in enumerate((comp_dot, comp_dash, None)):
+                v = Vehicle(plate_number=f"CV0{i}ZIP", gestiune_id=self.gest_id, company_id=comp.id if comp else None)
+                db.session.add(v)
+                db.session.flush()
+                db.session.add(Transaction(date=datetime(2026, 5, 2 + i), vehicle_id=v.id, company_id=v.company_id,
+                                           quantity=10 + i, gestiune_id=self.gest_id))
+            db.session.commit()
+
+            filepath, _ = generate_month_close(datetime(2026, 5, 1), datetime(2026, 5, 31, 23, 59), self.gest_id)
+            try:
+                with zipfile.ZipFile(filepath) as zf:
+                    names = zf.namelist()
+            finally:
+                os.remove(filepath)
+            self.assertEqual(names, ["Bonuri_NECUNOSCUT.pdf", f"Bonuri_{comp_dot.id}_A_B_SRL.pdf",
+                                     f"Bonuri_{comp_dash.id}_A_B_SRL.pdf", "Raport_Lunar.pdf"])
+            db.session.remove()
+
+    def test_month_close_rejects_bad_series(self):
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        response = self.client.post('/admin/month_close', data={
+            'start_date': '2026-05-01T00:00', 'end_date': '2026-05-31T23:59', 'initial_series': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['status'], 'error')
+
+    def test_month_close_render_fallback(self):
+        import shutil
+        import tempfile
+        from unittest import mock
+        from month_close import _render_all
+        work_dir = tempfile.mkdtemp()
+        try:
+            # A renderer error propagates instead of re-rendering every report sequentially
+            with self.assertRaises(FileNotFoundError):
+                _render_all([('done', os.mkdir, ()), ('missing', os.rmdir, ())], work_dir)
+
+            # No pool at all: everything is rendered in this process
+            with mock.patch('month_close.ProcessPoolExecutor', side_effect=OSError('no worker processes')):
+                paths = _render_all([('a', os.mkdir, ()), ('b', os.mkdir, ())], work_dir)
+            self.assertTrue(all(os.path.isdir(path) for path in paths.values()))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def test_monthly_company_stats(self):
+        import shutil
+        from unittest import mock
+        import report_cache
+        from models import StockOperation
+        from month_close import PeriodSnapshot
+        from services import generate_monthly_report_pdf, monthly_company_stats
+        with app.app_context():
+            comp_a = Company(name="LUNAR A", gestiune_id=self.gest_id)
+            comp_b = Company(name="LUNAR B", gestiune_id=self.gest_id)
+            comp_c = Company(name="LUNAR C", gestiune_id=self.gest_id)
+            db.session.add_all([comp_a, comp_b, comp_c])
+            db.session.flush()
+            va = Vehicle(plate_number="LN01AAA", gestiune_id=self.gest_id, company_id=comp_a.id)
+            vb = Vehicle(plate_number="LN01BBB", gestiune_id=self.gest_id, company_id=comp_b.id)
+            db.session.add_all([va, vb])
+            db.session.flush()
+
+            def trans(day, vehicle, quantity):
+                return Transaction(date=day, vehicle_id=vehicle.id, company_id=vehicle.company_id,
+                                   quantity=quantity, gestiune_id=self.gest_id)
+
+            def op(kind, day, company, quantity):
+                return StockOperation(operation_type=kind, date=day, company_id=company.id,
+                                      quantity=quantity, gestiune_id=self.gest_id)
+
+            db.session.add_all([
+                # INITIAL entries count whatever their date
+                op('INITIAL', datetime(2026, 1, 1), comp_a, 100),
+                op('INITIAL', datetime(2026, 4, 30), comp_a, 20.25),
+                op('IN', datetime(2026, 5, 10), comp_a, 50),
+                op('IN', datetime(2026, 6, 2), comp_a, 30),
+                op('OUT', datetime(2026, 5, 20), comp_a, 7.5),
+                op('IN', datetime(2026, 5, 31, 23, 0), comp_b, 40.1),
+                trans(datetime(2026, 5, 2), va, 10),
+                trans(datetime(2026, 5, 3), va, 20.5),
+                trans(datetime(2026, 6, 1), va, 5),
+                trans(datetime(2026, 5, 4), vb, 0.1),
+                trans(datetime(2026, 5, 5), vb, 0.2),
+            ])
+            db.session.commit()
+
+            # Hand-computed: out = manual OUT + consumption, final = initial + in - out
+            expected = [
+                {'name': "LUNAR A", 'stock_initial': 120.25, 'total_in': 50.0, 'total_out': 38.0, 'stock_final': 132.25},
+                {'name': "LUNAR B", 'stock_initial': 0.0, 'total_in': 40.1, 'total_out': 0.3, 'stock_final': 39.8},
+                {'name': "LUNAR C", 'stock_initial': 0.0, 'total_in': 0.0, 'total_out': 0.0, 'stock_final': 0.0},
+            ]
+            start, end = datetime(2026, 5, 1), datetime(2026, 5, 31, 23, 59)
+
+            rendered = {}
+
+            def fake_render(start_date, end_date, company_stats, total_in, total_out, combined,
+                            initial_series, final_series, filepath):
+                rendered.update(stats=company_stats, totals=(total_in, total_out), rows=len(combined))
+                with open(filepath, 'wb') as f:
+                    f.write(b'%PDF-1.3 test')
+
+            with mock.patch('pdf_monthly.render_monthly_pdf', fake_render):
+                try:
+                    filepath, _ = generate_monthly_report_pdf(start, end, self.gest_id)
+                    os.remove(filepath)
+                finally:
+                    shutil.rmtree(report_cache.get_cache_dir(), ignore_errors=True)
+            self.assertEqual(rendered['stats'], expected)
+            self.assertEqual(rendered['totals'], (90.1, 38.3))
+            self.assertEqual(rendered['rows'], 4)
+
+            # The month-close batch derives the same figures from its snapshot
+            snap = PeriodSnapshot(self.gest_id, start, end)
+            self.assertEqual(monthly_company_stats(snap.companies, snap.company_sums()),
+                             (expected, 90.1, 38.3))
+            db.session.remove()
+
+    def test_logo_resource_cache(self):
+        import tempfile
+        import time
+        from PIL import Image
+        from pdf_resources import logo_resource, LOGO_MAX_PX
+        with tempfile.TemporaryDirectory() as tmp_dir, app.app_context():
+            path = os.path.join(tmp_dir, 'logo.png')
+            Image.new('RGBA', (1200, 600), (10, 20, 30, 128)).save(path)
+            data_uri, prepared = logo_resource(path)
+            self.assertTrue(data_uri.startswith('data:image/png;base64,'))
+            with Image.open(prepared) as img:
+                self.assertEqual((img.size, img.mode), ((LOGO_MAX_PX * 2, LOGO_MAX_PX), 'RGB'))
+            self.assertEqual(logo_resource(path), (data_uri, prepared))
+
+            # A new upload at the same path is picked up
+            time.sleep(0.01)
+            Image.new('RGB', (100, 100), (255, 0, 0)).save(path)
+            self.assertNotEqual(logo_resource(path)[0], data_uri)
+            os.remove(prepared)
+
+    def test_history_changeset_bulk_delete(self):
+        from models import HistoryLog
+        from services import HistoryService
+        with app.app_context():
+            v = Vehicle(plate_number="CV01HIS", gestiune_id=self.gest_id)
+            db.session.add(v)
+            db.session.flush()
+            ids = []
+            for day in (1, 2, 3):
+                t = Transaction(date=datetime(2026, 7, day), vehicle_id=v.id, quantity=day, gestiune_id=self.gest_id)
+                db.session.add(t)
+                db.session.flush()
+                ids.append(t.id)
+            db.session.commit()
+            vehicle_id = v.id
+
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        self.client.post('/admin/stock/delete_bulk', data={'operation_ids': [f'trans:{i}' for i in ids]})
+
+        with app.app_context():
+            logs = HistoryLog.query.filter_by(gestiune_id=self.gest_id).all()
+            self.assertEqual(len(logs), 3)
+            self.assertEqual({log.changeset_id for log in logs}, {min(log.id for log in logs)})
+            count = lambda: Transaction.query.filter_by(vehicle_id=vehicle_id).count()
+            self.assertEqual(count(), 0)
+
+            # One undo step restores the whole batch, one redo deletes it again
+            self.assertTrue(HistoryService.undo(self.gest_id)[0])
+            self.assertEqual(count(), 3)
+            self.assertTrue(HistoryService.redo(self.gest_id)[0])
+            self.assertEqual(count(), 0)
+            db.session.remove()
+
+    def test_history_redo_scoped_to_gestiune(self):
+        from sqlalchemy import text
+        from models import StockOperation
+        from services import HistoryService
+        with app.app_context():
+            other = Gestiune(name="Redo")
+            db.session.add(other)
+            db.session.commit()
+            for gid in (self.gest_id, other.id):
+                op = StockOperation(operation_type='IN', quantity=10, date=datetime(2026, 8, 1), gestiune_id=gid)
+                db.session.add(op)
+                db.session.commit()
+                HistoryService.log_action('StockOperation', op.id, 'CREATE', op, gestiune_id=gid)
+            self.assertTrue(HistoryService.undo(self.gest_id)[0])
+
+            # A new action in another profile leaves this profile's redo stack alone
+            op = StockOperation(operation_type='IN', quantity=5, date=datetime(2026, 8, 2), gestiune_id=other.id)
+            db.session.add(op)
+            db.session.commit()
+            HistoryService.log_action('StockOperation', op.id, 'CREATE', op, gestiune_id=other.id)
+            self.assertTrue(HistoryService.redo(self.gest_id)[0])
+
+            plan = db.session.execute(text(
+                "EXPLAIN QUERY PLAN SELECT id FROM history_log WHERE gestiune_id = 1 AND is_undone = 1 ORDER BY id DESC LIMIT 1"
+            )).fetchall()
+            self.assertIn('ix_history_log_gestiune_undone', ' '.join(str(row[-1]) for row in plan))
+            db.session.remove()
+
+    def test_history_diff_snapshots(self):
+        import history_codec
+        from models import HistoryLog
+        from services import HistoryService
+        values = {'id': 7, 'quantity_cl': -150, 'date': datetime(2026, 8, 3, 6, 30, 15, 250), 'description': 'Ștefan',
+                  'flag': True, 'ratio': 0.5, 'company_id': None}
+        self.assertEqual(history_codec.decode(history_codec.encode(values)), values)
+
+        with app.app_context():
+            c1 = Company(name="DIFF ONE", gestiune_id=self.gest_id)
+            c2 = Company(name="DIFF TWO", gestiune_id=self.gest_id)
+            db.session.add_all([c1, c2])
+            db.session.flush()
+            t = Transaction(date=datetime(2026, 8, 3), quantity=40, company_id=c1.id, gestiune_id=self.gest_id)
+            db.session.add(t)
+            db.session.commit()
+            c1_id, c2_id, t_id = c1.id, c2.id, t.id
+
+            # Logged before the change, like the edit routes: only the changed column is stored
+            HistoryService.log_action('Transaction', t.id, 'UPDATE', t, gestiune_id=self.gest_id)
+            t.company_id = c2_id
+            db.session.commit()
+            log = HistoryLog.query.filter_by(gestiune_id=self.gest_id, action_type='UPDATE').one()
+            self.assertEqual(history_codec.decode(log.pre_update_snapshot), {'id': t_id, 'company_id': c1_id})
+            self.assertEqual(history_codec.decode(log.data_snapshot), {'id': t_id, 'company_id': c2_id})
+            self.assertLess(len(log.data_snapshot), 24)
+
+            self.assertTrue(HistoryService.undo(self.gest_id)[0])
+            self.assertEqual(db.session.get(Transaction, t_id).company_id, c1_id)
+            self.assertTrue(HistoryService.redo(self.gest_id)[0])
+            self.assertEqual(db.session.get(Transaction, t_id).company_id, c2_id)
+
+            # An update that changes nothing leaves no undo step and keeps the redo stack
+            self.assertTrue(HistoryService.undo(self.gest_id)[0])
+            HistoryService.log_action('Transaction', t_id, 'UPDATE', db.session.get(Transaction, t_id), gestiune_id=self.gest_id)
+            db.session.commit()
+            self.assertEqual(HistoryLog.query.filter_by(gestiune_id=self.gest_id).count(), 1)
+            self.assertEqual(HistoryLog.query.filter_by(gestiune_id=self.gest_id, is_undone=True).count(), 1)
+
+            # A real change clears it
+            t = db.session.get(Transaction, t_id)
+            HistoryService.log_action('Transaction', t_id, 'UPDATE', t, gestiune_id=self.gest_id)
+            t.quantity = 41
+            db.session.commit()
+            self.assertEqual(HistoryLog.query.filter_by(gestiune_id=self.gest_id, is_undone=True).count(), 0)
+            self.assertEqual(HistoryLog.query.filter_by(gestiune_id=self.gest_id).count(), 1)
+            db.session.remove()
+
+    def test_history_retention(self):
+        from app import DB_PATH
+        from models import HistoryLog, StockOperation
+        from services import HistoryService, SettingsService
+        from history_retention import KEEP_ACTIONS_KEY, KEEP_DAYS_KEY, compact, history_stats
+        with app.app_context():
+            gest = Gestiune(name="Retention")
+            db.session.add(gest)
+            db.session.commit()
+            gid = gest.id
+            ops = [StockOperation(operation_type='IN', quantity=i + 1, date=datetime(2026, 8, 1), gestiune_id=gid)
+                   for i in range(5)]
+            db.session.add_all(ops)
+            db.session.commit()
+            HistoryService.log_action('StockOperation', ops[0].id, 'CREATE', ops[0], gestiune_id=gid)
+            # One bulk action of three entries, then a newer single action
+            with HistoryService.changeset(gid):
+                for op in ops[1:4]:
+                    HistoryService.log_action('StockOperation', op.id, 'CREATE', op, gestiune_id=gid)
+                db.session.commit()
+            HistoryService.log_action('StockOperation', ops[4].id, 'CREATE', ops[4], gestiune_id=gid)
+            op_ids = [op.id for op in ops]
+            self.assertEqual(history_stats(DB_PATH, gid)['rows'], 5)
+
+            # Keep the last two actions: the bulk action survives whole, the oldest entry goes
+            SettingsService.set_many(gid, {KEEP_ACTIONS_KEY: 2, KEEP_DAYS_KEY: 0})
+            db.session.remove()
+            self.assertEqual(compact(DB_PATH, [gid])['deleted'], 1)
+            kept = sorted(log.record_id for log in HistoryLog.query.filter_by(gestiune_id=gid))
+            self.assertEqual(kept, op_ids[1:])
+
+            stats = history_stats(DB_PATH, gid)
+            self.assertEqual(stats['rows'], 4)
+            self.assertGreater(stats['bytes'], 0)
+            self.assertEqual(stats['policy'], (2, 0))
+            db.session.remove()
+
+    def test_stock_as_of_checkpoints(self):
+        from models import StockOperation, StockCheckpoint
+        from stock_checkpoints import balances_as_of, build_checkpoints
+        with app.app_context():
+            cat = VehicleCategory(name="ASOF", gestiune_id=self.gest_id)
+            comp = Company(name="ASOF CO", gestiune_id=self.gest_id)
+            db.session.add_all([cat, comp])
+            db.session.flush()
+            v = Vehicle(plate_number="CV01AOF", gestiune_id=self.gest_id, company_id=comp.id, category_id=cat.id)
+            db.session.add(v)
+            db.session.flush()
+            db.session.add(StockOperation(operation_type='INITIAL', quantity=1000, company_id=comp.id, gestiune_id=self.gest_id, date=datetime(2026, 3, 1, 8)))
+            db.session.add(StockOperation(operation_type='IN', quantity=500, company_id=comp.id, gestiune_id=self.gest_id, date=datetime(2026, 3, 3, 9)))
+            for day, qty in ((2, 100), (3, 50.5), (5, 200)):
+                db.session.add(Transaction(date=datetime(2026, 3, day, 12), vehicle_id=v.id, company_id=comp.id, quantity=qty, gestiune_id=self.gest_id))
+            db.session.commit()
+            comp_id, vehicle_id = comp.id, v.id
+
+            self.assertEqual(build_checkpoints(self.gest_id, until=datetime(2026, 4, 1)), 4)
+            expected = {datetime(2026, 3, 1, 7): 0, datetime(2026, 3, 2, 12): 90000, datetime(2026, 3, 3, 6): 90000,
+                        datetime(2026, 3, 4): 134950, datetime(2026, 3, 5, 12): 114950, datetime(2026, 5, 1): 114950}
+            for moment, balance in expected.items():
+                self.assertEqual(balances_as_of(self.gest_id, moment)[0].get(comp_id, 0), balance, moment)
+            self.assertEqual(balances_as_of(self.gest_id, datetime(2026, 3, 5, 12))[1], datetime(2026, 3, 4))
+
+            # A backdated edit drops the checkpoints after it; the next build restores them
+            db.session.add(Transaction(date=datetime(2026, 3, 2, 18), vehicle_id=vehicle_id, company_id=comp_id, quantity=10, gestiune_id=self.gest_id))
+            db.session.commit()
+            self.assertEqual(db.session.query(StockCheckpoint.at).filter_by(gestiune_id=self.gest_id).distinct().count(), 1)
+            build_checkpoints(self.gest_id, until=datetime(2026, 4, 1))
+            self.assertEqual(balances_as_of(self.gest_id, datetime(2026, 3, 5, 12))[0][comp_id], 113950)
+            db.session.remove()
+
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        data = self.client.get('/api/stock/as_of?at=2026-03-04T00:00').get_json()
+        self.assertEqual(data['companies'][0]['stock'], 1339.5)
+        self.assertEqual(self.client.get('/api/stock/as_of?at=bad').status_code, 400)
+
+        # A build losing a race with the nightly worker still answers from the existing checkpoints
+        from unittest import mock
+        from sqlalchemy.exc import IntegrityError
+        with mock.patch('stock_checkpoints.build_checkpoints', side_effect=IntegrityError('INSERT', {}, Exception())):
+            response = self.client.get('/api/stock/as_of?at=2026-03-04T00:00')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['companies'][0]['stock'], 1339.5)
+
+    def test_profile_export_remaps_ids(self):
+        import sqlite3
+        import tempfile
+        from app import DB_PATH
+        from profile_export import export_profile
+        with app.app_context():
+            cat = VehicleCategory(name="EXPC", gestiune_id=self.gest_id)
+            comp = Company(name="EXPORT CO", gestiune_id=self.gest_id)
+            db.session.add_all([cat, comp])
+            db.session.flush()
+            v = Vehicle(plate_number="CV01EXP", gestiune_id=self.gest_id, company_id=comp.id, category_id=cat.id)
+            db.session.add(v)
+            db.session.flush()
+            db.session.add(Transaction(date=datetime(2026, 4, 2), vehicle_id=v.id, company_id=comp.id, quantity=12.5, gestiune_id=self.gest_id))
+            # Orphaned transaction: its vehicle is not part of the profile
+            db.session.add(Transaction(date=datetime(2026, 4, 3), vehicle_id=v.id + 1000, company_id=comp.id, quantity=1, gestiune_id=self.gest_id))
+            db.session.commit()
+            db.session.remove()
+
+        export_path = os.path.join(tempfile.mkdtemp(), 'export.db')
+        counts = export_profile(DB_PATH, self.gest_id, export_path)
+        self.assertEqual((counts['vehicle'], counts['transaction']), (1, 1))
+        conn = sqlite3.connect(export_path)
+        row = conn.execute('''
+            SELECT v.plate_number, c.name, k.name, t.quantity_cl FROM [transaction] t
+            JOIN vehicle v ON v.id = t.vehicle_id JOIN company c ON c.id = t.company_id
+            JOIN vehicle_category k ON k.id = v.category_id AND v.company_id = c.id
+        ''').fetchone()
+        conn.close()
+        self.assertEqual(row, ("CV01EXP", "EXPORT CO", "EXPC", 1250))
+
+    def test_incremental_backup_chain(self):
+        import sqlite3
+        import tempfile
+        from app import DB_PATH
+        from models import StockOperation
+        from profile_diff import export_base, export_diff, rebuild_profile
+        with app.app_context():
+            comp = Company(name="DIFF CO", gestiune_id=self.gest_id)
+            db.session.add(comp)
+            db.session.flush()
+            v = Vehicle(plate_number="CV01DIF", gestiune_id=self.gest_id, company_id=comp.id)
+            db.session.add(v)
+            db.session.flush()
+            t1 = Transaction(date=datetime(2026, 6, 1), vehicle_id=v.id, company_id=comp.id, quantity=10, gestiune_id=self.gest_id)
+            t2 = Transaction(date=datetime(2026, 6, 2), vehicle_id=v.id, company_id=comp.id, quantity=20, gestiune_id=self.gest_id)
+            db.session.add_all([t1, t2])
+            db.session.commit()
+            ids = (v.id, comp.id, t1.id, t2.id)
+            db.session.remove()
+
+        folder = tempfile.mkdtemp()
+        paths = [os.path.join(folder, name) for name in ('base.db', 'diff1.db', 'diff2.db', 'full.db')]
+        export_base(DB_PATH, self.gest_id, paths[0])
+        with self.assertRaises(ValueError):
+            rebuild_profile([paths[0], paths[0]], paths[3])
+
+        with app.app_context():
+            db.session.get(Transaction, ids[2]).quantity = 15
+            db.session.commit()
+        first = export_diff(DB_PATH, self.gest_id, paths[1])
+        self.assertEqual((first['transaction'], first['deleted']), (1, 0))
+
+        with app.app_context():
+            db.session.delete(db.session.get(Transaction, ids[3]))
+            db.session.add(Transaction(date=datetime(2026, 6, 3), vehicle_id=ids[0], company_id=ids[1], quantity=30, gestiune_id=self.gest_id))
+            db.session.add(StockOperation(operation_type='IN', quantity=500, date=datetime(2026, 6, 1), company_id=ids[1], gestiune_id=self.gest_id))
+            db.session.commit()
+            db.session.remove()
+        second = export_diff(DB_PATH, self.gest_id, paths[2])
+        self.assertEqual(second['info']['from_seq'], first['info']['to_seq'])
+        self.assertEqual((second['stock_operation'], second['vehicle']), (1, 0))
+
+        # Diffs in any order; the chain must be complete
+        with self.assertRaises(ValueError):
+            rebuild_profile([paths[0], paths[2]], paths[3])
+        self.assertEqual(rebuild_profile([paths[2], paths[0], paths[1]], paths[3]), 2)
+        conn = sqlite3.connect(paths[3])
+        quantities = [q for (q,) in conn.execute("SELECT quantity_cl FROM [transaction] ORDER BY date")]
+        stock = conn.execute("SELECT COUNT(*) FROM stock_operation").fetchone()[0]
+        conn.close()
+        self.assertEqual((quantities, stock), ([1500, 3000], 1))
+
+    def test_profile_import_batches_and_remaps(self):
+        import sqlite3
+        from profile_import import import_profile
+        # Old single-profile backup: no gestiune table, quantities in liters
+        src = sqlite3.connect(':memory:')
+        src.executescript('''
+            CREATE TABLE vehicle_category (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE company (id INTEGER PRIMARY KEY, name TEXT, cui TEXT);
+            CREATE TABLE vehicle (id INTEGER PRIMARY KEY, plate_number TEXT, company_id INTEGER, category_id INTEGER);
+            CREATE TABLE [transaction] (id INTEGER PRIMARY KEY, date TEXT, vehicle_id INTEGER, company_id INTEGER, quantity REAL);
+            INSERT INTO vehicle_category VALUES (7, 'IMPC');
+            INSERT INTO company VALUES (40, 'IMPORT ALPHA', 'RO1'), (41, 'IMPORT BETA', NULL);
+            INSERT INTO vehicle VALUES (90, 'CV01IMP', 41, 7), (91, 'CV02IMP', 40, NULL);
+            INSERT INTO [transaction] VALUES (1, '2026-05-02 10:00:00', 90, 41, 12.5),
+                                             (2, '2026-05-03 10:00:00', 91, 40, 3),
+                                             (3, '2026-05-04 10:00:00', 999, 40, 1);
+        ''')
+        with app.app_context():
+            counts = import_profile(src, self.gest_id, batch_size=1)
+            db.session.commit()
+            self.assertEqual((counts['categories'], counts['companies'], counts['vehicles'], counts['trans']), (1, 2, 2, 2))
+            v = Vehicle.query.filter_by(plate_number="CV01IMP", gestiune_id=self.gest_id).one()
+            self.assertEqual((v.company.name, v.category.name), ("IMPORT BETA", "IMPC"))
+            t = Transaction.query.filter_by(vehicle_id=v.id).one()
+            self.assertEqual((t.quantity_cl, t.company_id, t.date), (1250, v.company_id, datetime(2026, 5, 2, 10)))
+            codes = [c.series_code for c in Company.query.filter_by(gestiune_id=self.gest_id)]
+            self.assertTrue(all(codes) and len(set(codes)) == 2)
+        src.close()
+
+    def test_export_transactions_csv(self):
+        with app.app_context():
+            cat = VehicleCategory(name="EXCAVATOR", gestiune_id=self.gest_id)
+            comp = Company(name="EXPORT CO", gestiune_id=self.gest_id)
+            db.session.add_all([cat, comp])
+            db.session.flush()
+            v1 = Vehicle(plate_number="CV01EXP", gestiune_id=self.gest_id, company_id=comp.id, category_id=cat.id)
+            v2 = Vehicle(plate_number="CV02EXP", gestiune_id=self.gest_id, company_id=comp.id)
+            db.session.add_all([v1, v2])
+            db.session.flush()
+            db.session.add(Transaction(date=datetime(2026, 3, 2, 9, 30), vehicle_id=v1.id, company_id=comp.id, quantity=25.5, gestiune_id=self.gest_id))
+            db.session.add(Transaction(date=datetime(2026, 3, 1, 8, 0), vehicle_id=v2.id, company_id=comp.id, quantity=10, gestiune_id=self.gest_id))
+            db.session.add(Transaction(date=datetime(2026, 4, 1, 8, 0), vehicle_id=v2.id, company_id=comp.id, quantity=5, gestiune_id=self.gest_id))
+            db.session.commit()
+            cat_id = cat.id
+
+        with self.client.session_transaction() as sess:
+            sess['gestiune_id'] = self.gest_id
+        response = self.client.get('/export/transactions?start=2026-03-01&end=2026-03-31')
+        lines = response.get_data(as_text=True).lstrip('\ufeff').splitlines()
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        self.assertEqual(lines[1:], ['2026-03-01 08:00,CV02EXP,EXPORT CO,,10.00',
+                                     '2026-03-02 09:30,CV01EXP,EXPORT CO,EXCAVATOR,25.50'])
+
+        response = self.client.get(f'/export/transactions?category_id={cat_id}')
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 2)
+
+        # Keyset batches: same-date rows are neither lost nor repeated across batch
+        # boundaries, and no read transaction stays open while a batch is consumed
+        from services import iter_transaction_rows
+        with app.app_context():
+            v = Vehicle.query.filter_by(plate_number="CV02EXP").one()
+            for minute in range(4):
+                db.session.add(Transaction(date=datetime(2026, 3, 1, 8, 0), vehicle_id=v.id, company_id=v.company_id,
+                                           quantity=1 + minute, gestiune_id=self.gest_id))
+            db.session.commit()
+            rows = iter_transaction_rows(self.gest_id, batch_size=2)
+            first = next(rows)
+            self.assertFalse(db.session().in_transaction())
+            quantities = [first[4]] + [row[4] for row in rows]
+            self.assertEqual(quantities, [10.0, 1.0, 2.0, 3.0, 4.0, 25.5, 5.0])
+            db.session.remove()
+
     def tearDown(self):
+        from services import SettingsService
         with app.app_context():
             db.session.remove()
             db.drop_all()
+        SettingsService.invalidate()
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,184 @@
+"""
+Retention and compaction of the undo/redo history (history_log).
+
+Each gestiune keeps its last HISTORY_KEEP_ACTIONS actions or the actions of
+its last HISTORY_KEEP_DAYS days, whichever reaches further back (app settings
+history_keep_actions / history_keep_days, 0 disables a limit). A bulk action
+(changeset) counts as one action and is kept or dropped as a whole, so undo
+never meets a half-pruned step.
+
+compact() deletes the expired entries in small committed batches, so the app
+keeps writing in between, then returns the freed pages to the file system:
+incrementally when the database already uses auto_vacuum=INCREMENTAL,
+otherwise with one full VACUUM that also switches it to incremental mode.
+A daemon thread (start_compaction_worker) runs it for every gestiune every
+COMPACTION_INTERVAL seconds.
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+KEEP_ACTIONS_KEY = 'history_keep_actions'
+KEEP_DAYS_KEY = 'history_keep_days'
+HISTORY_KEEP_ACTIONS = 1000
+HISTORY_KEEP_DAYS = 90
+
+DELETE_BATCH = 2000
+# A full VACUUM (non-incremental databases) only pays off past this much free space
+VACUUM_MIN_FREE_BYTES = 4 * 1024 * 1024
+COMPACTION_DELAY = 120
+COMPACTION_INTERVAL = 6 * 3600
+
+_worker = None
+_lock = threading.Lock()
+
+# Entries of one changeset share its first id; single actions are their own key
+_ACTION_KEY = "COALESCE(changeset_id, id)"
+
+
+def _connect(db_path):
+    # Autocommit: batches open their own short write transactions
+    return sqlite3.connect(db_path, timeout=30, isolation_level=None)
+
+
+def get_policy(conn, gestiune_id):
+    """(keep_actions, keep_days) of a gestiune, defaults for missing or invalid settings"""
+    values = dict(conn.execute("SELECT key, value FROM app_settings WHERE gestiune_id = ? AND key IN (?, ?)",
+                               (gestiune_id, KEEP_ACTIONS_KEY, KEEP_DAYS_KEY)).fetchall())
+    policy = []
+    for key, default in ((KEEP_ACTIONS_KEY, HISTORY_KEEP_ACTIONS), (KEEP_DAYS_KEY, HISTORY_KEEP_DAYS)):
+        try:
+            policy.append(max(0, int(values[key])))
+        except (KeyError, TypeError, ValueError):
+            policy.append(default)
+    return tuple(policy)
+
+
+def _keep_from(conn, gestiune_id, keep_actions, keep_days, now=None):
+    """Smallest action key still kept under the policy; None when nothing expires"""
+    bounds = []
+    if keep_actions:
+        row = conn.execute(f"""
+            SELECT {_ACTION_KEY} AS k FROM history_log WHERE gestiune_id = ?
+            GROUP BY k ORDER BY k DESC LIMIT 1 OFFSET ?
+        """, (gestiune_id, keep_actions - 1)).fetchone()
+        if row is None:
+            return None  # fewer actions than the limit
+        bounds.append(row[0])
+    if keep_days:
+        since = ((now or datetime.utcnow()) - timedelta(days=keep_days)).strftime('%Y-%m-%d %H:%M:%S')
+        row = conn.execute(f"SELECT MIN({_ACTION_KEY}) FROM history_log WHERE gestiune_id = ? AND timestamp >= ?",
+                           (gestiune_id, since)).fetchone()
+        # No entry inside the window: the day limit keeps nothing
+        bounds.append(row[0] if row[0] is not None else float('inf'))
+    if not bounds:
+        return None
+    return min(bounds)
+
+
+def prune(conn, gestiune_id, keep_actions, keep_days, now=None, batch_size=DELETE_BATCH):
+    """Delete the expired entries of one gestiune in committed batches; returns the number deleted"""
+    keep_from = _keep_from(conn, gestiune_id, keep_actions, keep_days, now)
+    if keep_from is None:
+        return 0
+
+    deleted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            count = conn.execute(f"""
+                DELETE FROM history_log WHERE id IN (
+                    SELECT id FROM history_log WHERE gestiune_id = ? AND {_ACTION_KEY} < ? LIMIT ?)
+            """, (gestiune_id, keep_from, batch_size)).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def reclaim(conn):
+    """Give free pages back to the file system; returns the bytes released"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not free_before:
+        return 0
+
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        conn.execute("PRAGMA incremental_vacuum")
+    elif free_before * page_size >= VACUUM_MIN_FREE_BYTES:
+        # auto_vacuum only changes on a VACUUM; later runs are incremental
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        return 0
+    return (free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]) * page_size
+
+
+def compact(db_path, gestiune_ids=None, now=None):
+    """
+    Apply the retention policy to `gestiune_ids` (every gestiune when None)
+    and reclaim the freed space. Returns {'deleted': n, 'reclaimed_bytes': n}.
+    """
+    conn = _connect(db_path)
+    try:
+        if gestiune_ids is None:
+            gestiune_ids = [gid for (gid,) in conn.execute("SELECT id FROM gestiune ORDER BY id")]
+        deleted = 0
+        for gid in gestiune_ids:
+            deleted += prune(conn, gid, *get_policy(conn, gid), now=now)
+        reclaimed = reclaim(conn) if deleted else 0
+        if deleted:
+            print(f"[HISTORY] Compaction: {deleted} entries deleted, {reclaimed} bytes reclaimed")
+        return {'deleted': deleted, 'reclaimed_bytes': reclaimed}
+    finally:
+        conn.close()
+
+
+def history_stats(db_path, gestiune_id):
+    """
+    Size of the history of one gestiune: rows, snapshot bytes, oldest entry,
+    plus the database file size and its free (reclaimable) bytes.
+    """
+    conn = _connect(db_path)
+    try:
+        rows, payload, oldest = conn.execute("""
+            SELECT COUNT(*),
+                   COALESCE(SUM(LENGTH(CAST(data_snapshot AS BLOB)) + COALESCE(LENGTH(CAST(pre_update_snapshot AS BLOB)), 0)), 0),
+                   MIN(timestamp)
+            FROM history_log WHERE gestiune_id = ?
+        """, (gestiune_id,)).fetchone()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            'rows': rows,
+            'bytes': payload,
+            'oldest': datetime.fromisoformat(oldest[:19]) if oldest else None,
+            'db_bytes': conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+            'free_bytes': conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+            'policy': get_policy(conn, gestiune_id),
+        }
+    finally:
+        conn.close()
+
+
+def start_compaction_worker(db_path, delay=COMPACTION_DELAY, interval=COMPACTION_INTERVAL):
+    """Run compact() for every gestiune in a daemon thread, `delay` s after start and then every `interval` s"""
+    global _worker
+
+    def loop():
+        time.sleep(delay)
+        while True:
+            try:
+                compact(db_path)
+            except Exception as e:
+                print(f"[HISTORY] Compaction failed: {e}")
+            time.sleep(interval)
+
+    with _lock:
+        if _worker is None:
+            _worker = threading.Thread(target=loop, name='history-compaction', daemon=True)
+            _worker.start()
+    return _worker
@@ -0,0 +1,185 @@
+"""
+In-process metrics exposed at /metrics in the Prometheus text format (0.0.4).
+
+No client library: counters, gauges and histograms are plain dicts guarded by
+one lock. Metrics live in memory and reset when the application restarts.
+"""
+import functools
+import os
+import re
+import threading
+import time
+
+# Seconds; requests and PDF jobs share the same bucket layout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_histograms = {}  # name -> {labels_tuple: [bucket_counts..., sum, count]}
+_counters = {}    # name -> {labels_tuple: value}
+_gauges = {}      # name -> {labels_tuple: value}
+_help = {}
+# Per-thread state of the PDF generation being tracked (see track_pdf)
+_pdf_state = threading.local()
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, help_text, buckets=LATENCY_BUCKETS, **labels):
+    key = _labels_key(labels)
+    with _lock:
+        _help.setdefault(name, (help_text, 'histogram', buckets))
+        series = _histograms.setdefault(name, {})
+        data = series.get(key)
+        if data is None:
+            data = series[key] = [0] * len(buckets) + [0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+def inc(name, help_text, amount=1, **labels):
+    key = _labels_key(labels)
+    with _lock:
+        _help.setdefault(name, (help_text, 'counter', None))
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def set_gauge(name, value, help_text, **labels):
+    with _lock:
+        _help.setdefault(name, (help_text, 'gauge', None))
+        _gauges.setdefault(name, {})[_labels_key(labels)] = value
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """All metrics in Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for name in sorted(_help):
+            help_text, kind, buckets = _help[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for key, data in sorted(_histograms.get(name, {}).items()):
+                    for i, bound in enumerate(buckets):
+                        lines.append(f'{name}_bucket{_format_labels(key, [("le", bound)])} {data[i]}')
+                    lines.append(f'{name}_bucket{_format_labels(key, [("le", "+Inf")])} {data[-1]}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {_format_value(data[-2])}')
+                    lines.append(f'{name}_count{_format_labels(key)} {data[-1]}')
+            else:
+                source = _counters if kind == 'counter' else _gauges
+                for key, value in sorted(source.get(name, {}).items()):
+                    lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- Application-specific helpers ---
+
+def count_pdf_pages(filepath):
+    """Page count of a generated PDF (page objects in the file)"""
+    try:
+        with open(filepath, 'rb') as f:
+            return len(re.findall(rb'/Type\s*/Page(?![a-zA-Z])', f.read()))
+    except OSError:
+        return 0
+
+
+def note_pdf_cache_hit():
+    """Called by report_cache on a hit: the tracked generator returns an existing file"""
+    _pdf_state.cache_hit = True
+
+
+def track_pdf(report):
+    """
+    Decorator for the PDF generators returning (filepath, message): records the
+    generation time under report=<report>, cache=hit|miss and, for PDFs
+    actually rendered, the page count.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _pdf_state.cache_hit = False
+            t0 = time.perf_counter()
+            result = func(*args, **kwargs)
+            cache_hit = _pdf_state.cache_hit
+            observe('fuel_pdf_generation_seconds', time.perf_counter() - t0,
+                    'PDF generation duration', report=report, cache='hit' if cache_hit else 'miss')
+            filepath = result[0] if isinstance(result, tuple) else None
+            if filepath and not cache_hit and os.path.exists(filepath):
+                pages = count_pdf_pages(filepath)
+                inc('fuel_pdf_pages_total', 'Pages written by PDF generators', pages, report=report)
+                set_gauge('fuel_pdf_last_page_count', pages, 'Page count of the last generated PDF', report=report)
+                inc('fuel_pdf_generated_total', 'Generated PDF files', report=report)
+            return result
+        return wrapper
+    return decorator
+
+
+def record_csv_import(rows, seconds):
+    inc('fuel_csv_import_rows_total', 'CSV rows processed by imports', rows)
+    observe('fuel_csv_import_seconds', seconds, 'CSV import duration')
+    if seconds > 0:
+        set_gauge('fuel_csv_import_rows_per_second', rows / seconds, 'Throughput of the last CSV import')
+
+
+def update_database_gauges(db_path):
+    """Refresh the gauges read at scrape time: DB file size and HistoryLog rows"""
+    from models import db, HistoryLog
+    try:
+        size = os.path.getsize(db_path)
+        for suffix in ('-wal', '-journal'):
+            if os.path.exists(db_path + suffix):
+                size += os.path.getsize(db_path + suffix)
+        set_gauge('fuel_db_size_bytes', size, 'Size of the SQLite database file(s)')
+    except OSError:
+        pass
+    set_gauge('fuel_history_log_rows', db.session.query(HistoryLog.id).count(), 'Rows in history_log')
+
+
+def init_request_metrics(app):
+    """
+    Request latency and SQL time per endpoint. Register after
+    init_sql_instrumentation: after_request hooks run in reverse order, so
+    this one still sees the per-request SQL stats.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g._metrics_t0 = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        t0 = g.pop('_metrics_t0', None)
+        if t0 is None or request.endpoint == 'static':
+            return response
+        endpoint = request.endpoint or 'unknown'
+        observe('fuel_http_request_duration_seconds', time.perf_counter() - t0,
+                'Request latency per endpoint', endpoint=endpoint, method=request.method)
+        inc('fuel_http_requests_total', 'Requests per endpoint and status',
+            endpoint=endpoint, status=str(response.status_code))
+        sql_stats = g.get('_sql_stats')
+        if sql_stats is not None:
+            observe('fuel_sql_request_seconds', sql_stats['time'],
+                    'Database time per request', endpoint=endpoint)
+            observe('fuel_sql_request_statements', sql_stats['count'], 'SQL statements per request',
+                    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000), endpoint=endpoint)
+        return response
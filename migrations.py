@@ -0,0 +1,325 @@
+"""
+Versioned schema migrations for the Fuel Manager SQLite database.
+
+The schema version lives in the database header (PRAGMA user_version), so a
+warm startup only reads one integer and skips all schema work when the
+database is already at SCHEMA_VERSION. Pending steps are applied in order and
+the version is bumped after each step, so an interrupted upgrade resumes at
+the first step that did not finish.
+
+Every step receives a raw sqlite3 connection and must be idempotent: a legacy
+database (user_version = 0) may already contain some of the changes.
+"""
+import os
+import sqlite3
+
+
+def _table_exists(cursor, table):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cursor.fetchone() is not None
+
+
+def _table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info([{table}])")
+    return [info[1] for info in cursor.fetchall()]
+
+
+def run_in_batches(conn, sql, table, params=(), batch_size=5000, start_id=0):
+    """
+    Run a data backfill over `table` in id-range batches, committing after each.
+
+    `sql` must end its WHERE clause with `id > ? AND id <= ?`; the range bounds
+    are appended to `params`. Returns the total number of affected rows.
+    """
+    max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM [{table}]").fetchone()[0]
+    total = 0
+    low = start_id
+    while low < max_id:
+        high = low + batch_size
+        cursor = conn.execute(sql, tuple(params) + (low, high))
+        conn.commit()
+        total += max(cursor.rowcount, 0)
+        low = high
+    return total
+
+
+# --- Migration steps ---
+
+def _migrate_multi_profile_columns(conn):
+    """Columns and app_settings constraint for the multi-profile upgrade (pre-versioning schema)"""
+    cursor = conn.cursor()
+
+    # Format: (table_name, column_name, column_definition)
+    columns = [
+        ('gestiune', 'default_fuel_type', "TEXT DEFAULT 'Motorină'"),
+        ('gestiune', 'logo_path', "TEXT"),
+        ('company', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('app_settings', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('vehicle_category', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('vehicle_category', 'icon', "TEXT DEFAULT 'bi-tag-fill'"),
+        ('vehicle', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('stock_operation', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('transaction', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('history_log', 'gestiune_id', "INTEGER REFERENCES gestiune(id)"),
+        ('history_log', 'pre_update_snapshot', "TEXT"),
+        ('company', 'last_report_start', "TIMESTAMP"),
+        ('company', 'last_report_end', "TIMESTAMP"),
+    ]
+
+    # 1. Add columns if missing
+    for table, column, definition in columns:
+        existing = _table_columns(cursor, table)
+        if existing and column not in existing:
+            cursor.execute(f"ALTER TABLE [{table}] ADD COLUMN [{column}] {definition}")
+            print(f"Migration: Added {column} to {table}")
+
+    # 2. app_settings: replace the old single-column UNIQUE(key) with UNIQUE(key, gestiune_id)
+    # (after step 1, so the copied table already has gestiune_id)
+    if _table_exists(cursor, 'app_settings'):
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='app_settings'")
+        create_sql = cursor.fetchone()[0]
+        if 'key" UNIQUE' in create_sql or 'key VARCHAR(50) UNIQUE' in create_sql:
+            print("Migration: Detected old UNIQUE constraint on app_settings. Performing table migration...")
+            # SQLite doesn't support ALTER TABLE DROP CONSTRAINT, so we must recreate
+            cursor.executescript("""
+                BEGIN;
+                ALTER TABLE app_settings RENAME TO app_settings_old;
+                CREATE TABLE app_settings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key VARCHAR(50) NOT NULL,
+                    value VARCHAR(200),
+                    gestiune_id INTEGER REFERENCES gestiune(id),
+                    UNIQUE(key, gestiune_id)
+                );
+                INSERT INTO app_settings (id, key, value, gestiune_id)
+                SELECT id, key, value, gestiune_id FROM app_settings_old;
+                DROP TABLE app_settings_old;
+                COMMIT;
+            """)
+            print("Migration: app_settings table migration complete.")
+
+
+def _create_query_indexes(conn):
+    """Indexes backing the per-gestiune balance, report and analysis queries"""
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS ix_transaction_gestiune_date ON [transaction] (gestiune_id, date);
+        CREATE INDEX IF NOT EXISTS ix_transaction_company ON [transaction] (company_id, gestiune_id);
+        CREATE INDEX IF NOT EXISTS ix_transaction_vehicle ON [transaction] (vehicle_id);
+        CREATE INDEX IF NOT EXISTS ix_stock_operation_company ON stock_operation (company_id, gestiune_id, operation_type);
+        CREATE INDEX IF NOT EXISTS ix_stock_operation_gestiune_date ON stock_operation (gestiune_id, date);
+        CREATE INDEX IF NOT EXISTS ix_vehicle_category ON vehicle (category_id);
+    """)
+
+
+_CENTILITERS_SQL = 'CAST(ROUND(ROUND(quantity, 2) * 100) AS INTEGER)'
+
+
+def _centiliter_collisions(conn, table, unique):
+    """Id groups of `table` that would share the `unique` key once quantities are rounded to centiliters"""
+    key = ', '.join(_CENTILITERS_SQL if c == 'quantity_cl' else c for c in unique)
+    # NULLs never collide in a UNIQUE constraint
+    not_null = ' AND '.join(f"{'quantity' if c == 'quantity_cl' else c} IS NOT NULL" for c in unique)
+    return [ids for (ids,) in conn.execute(f"""
+        SELECT GROUP_CONCAT(id) FROM [{table}] WHERE {not_null} GROUP BY {key} HAVING COUNT(*) > 1
+    """)]
+
+
+def _swap_rebuilt_table(conn, table, new_table, indexes):
+    """Replace `table` with its rebuilt copy in one transaction, so no crash leaves the rows only in `new_table`"""
+    conn.commit()
+    conn.execute("BEGIN")
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS [{table}]")
+        conn.execute(f"ALTER TABLE [{new_table}] RENAME TO [{table}]")
+        for index_sql in indexes:
+            conn.execute(index_sql)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _rebuild_with_centiliters(conn, table, create_sql, columns, indexes, unique=None):
+    """
+    Rebuild `table` with an INTEGER quantity_cl column (centiliters) instead of
+    the FLOAT quantity column. Rows are copied in id order and in batches, so an
+    interrupted copy resumes where it stopped, and a copy interrupted before the
+    table swap is finished on the next run. Fails without touching the table
+    when rows would collide on the `unique` key after rounding: fuel records
+    are never dropped by a migration.
+    """
+    cursor = conn.cursor()
+    new_table = f"{table}_cl_new"
+    existing = _table_columns(cursor, table)
+    if _table_exists(cursor, new_table) and (
+            not existing or not conn.execute(f"SELECT 1 FROM [{table}] LIMIT 1").fetchone()):
+        # A previous run copied the rows but stopped before the rename; the
+        # (empty) table may since have been recreated at head schema by create_all
+        kept = conn.execute(f"SELECT COUNT(*) FROM [{new_table}]").fetchone()[0]
+        _swap_rebuilt_table(conn, table, new_table, indexes)
+        print(f"Migration: Finished interrupted conversion of {table}.quantity ({kept} rows)")
+        return
+    if not existing or 'quantity_cl' in existing:
+        return  # Fresh database (created at head schema) or already converted
+
+    if unique:
+        collisions = _centiliter_collisions(conn, table, unique)
+        if collisions:
+            raise RuntimeError(f"{len(collisions)} groups of {table} rows become duplicates when rounded to "
+                               f"centiliters; resolve them before upgrading (ids: {'; '.join(collisions)})")
+
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS [{new_table}] {create_sql}")
+    conn.commit()
+
+    col_list = ', '.join(columns)
+    src_list = ', '.join(_CENTILITERS_SQL if c == 'quantity_cl' else c for c in columns)
+    # Resume after the last copied row if a previous attempt was interrupted
+    resume_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM [{new_table}]").fetchone()[0]
+    run_in_batches(conn, f"""
+        INSERT INTO [{new_table}] ({col_list})
+        SELECT {src_list} FROM [{table}]
+        WHERE id > ? AND id <= ?
+    """, table, start_id=resume_id)
+    kept = conn.execute(f"SELECT COUNT(*) FROM [{new_table}]").fetchone()[0]
+
+    _swap_rebuilt_table(conn, table, new_table, indexes)
+    print(f"Migration: Converted {table}.quantity to centiliters ({kept} rows)")
+
+
+def _convert_quantities_to_centiliters(conn):
+    """Store Transaction/StockOperation quantities as integer centiliters"""
+    _rebuild_with_centiliters(
+        conn, 'stock_operation',
+        """(
+            id INTEGER NOT NULL PRIMARY KEY,
+            operation_type VARCHAR(20),
+            quantity_cl INTEGER NOT NULL,
+            date DATETIME,
+            description VARCHAR(200),
+            company_id INTEGER REFERENCES company(id),
+            gestiune_id INTEGER REFERENCES gestiune(id)
+        )""",
+        ['id', 'operation_type', 'quantity_cl', 'date', 'description', 'company_id', 'gestiune_id'],
+        [
+            "CREATE INDEX IF NOT EXISTS ix_stock_operation_company ON stock_operation (company_id, gestiune_id, operation_type)",
+            "CREATE INDEX IF NOT EXISTS ix_stock_operation_gestiune_date ON stock_operation (gestiune_id, date)",
+        ])
+    _rebuild_with_centiliters(
+        conn, 'transaction',
+        """(
+            id INTEGER NOT NULL PRIMARY KEY,
+            date DATETIME NOT NULL,
+            vehicle_id INTEGER REFERENCES vehicle(id) ON DELETE CASCADE,
+            company_id INTEGER REFERENCES company(id),
+            quantity_cl INTEGER NOT NULL,
+            gestiune_id INTEGER REFERENCES gestiune(id),
+            CONSTRAINT _date_vehicle_qty_gestiune_uc UNIQUE (date, vehicle_id, quantity_cl, gestiune_id)
+        )""",
+        ['id', 'date', 'vehicle_id', 'company_id', 'quantity_cl', 'gestiune_id'],
+        [
+            "CREATE INDEX IF NOT EXISTS ix_transaction_gestiune_date ON [transaction] (gestiune_id, date)",
+            "CREATE INDEX IF NOT EXISTS ix_transaction_company ON [transaction] (company_id, gestiune_id)",
+            "CREATE INDEX IF NOT EXISTS ix_transaction_vehicle ON [transaction] (vehicle_id)",
+        ],
+        unique=['date', 'vehicle_id', 'quantity_cl', 'gestiune_id'])
+
+
+def _store_series_codes(conn):
+    """company.series_code, backfilled with the codes the slips printed so far"""
+    from series_codes import assign_missing
+
+    cursor = conn.cursor()
+    if 'series_code' not in _table_columns(cursor, 'company'):
+        cursor.execute("ALTER TABLE company ADD COLUMN series_code VARCHAR(3)")
+
+    # Same greedy pass over every company in id order as the report used to run
+    cursor.execute("SELECT series_code FROM company WHERE series_code IS NOT NULL")
+    taken = {row[0] for row in cursor.fetchall()}
+    cursor.execute("SELECT id, name FROM company WHERE series_code IS NULL")
+    assigned = assign_missing(cursor.fetchall(), taken)
+    cursor.executemany("UPDATE company SET series_code = ? WHERE id = ?",
+                       [(code, cid) for cid, code in assigned.items() if code])
+
+
+def _add_history_changesets(conn):
+    """history_log.changeset_id: bulk actions are undone/redone as one step"""
+    cursor = conn.cursor()
+    if 'changeset_id' not in _table_columns(cursor, 'history_log'):
+        cursor.execute("ALTER TABLE history_log ADD COLUMN changeset_id INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_history_log_changeset ON history_log (changeset_id)")
+
+
+def _index_history_stacks(conn):
+    """Undo/redo lookups and redo pruning walk (gestiune_id, is_undone) by id"""
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_history_log_gestiune_undone ON history_log (gestiune_id, is_undone, id)")
+
+
+def _add_stock_checkpoint_triggers(conn):
+    """Triggers dropping stale stock_checkpoint rows (table created by create_all)"""
+    from stock_checkpoints import CHECKPOINT_TRIGGERS
+    for statement in CHECKPOINT_TRIGGERS:
+        conn.execute(statement)
+
+
+def _add_backup_change_triggers(conn):
+    """Triggers logging profile changes for incremental backups (tables created by create_all)"""
+    from profile_diff import CHANGE_TRIGGERS
+    for statement in CHANGE_TRIGGERS:
+        conn.execute(statement)
+
+
+# (version, description, step). Append only - never renumber or edit a released step.
+MIGRATIONS = [
+    (1, 'Multi-profile columns and app_settings composite key', _migrate_multi_profile_columns),
+    (2, 'Indexes for per-gestiune queries', _create_query_indexes),
+    (3, 'Quantities as integer centiliters', _convert_quantities_to_centiliters),
+    (4, 'Stored slip series codes per company', _store_series_codes),
+    (5, 'History changesets for bulk actions', _add_history_changesets),
+    (6, 'Index for per-gestiune undo/redo stacks', _index_history_stacks),
+    (7, 'Stock checkpoint invalidation triggers', _add_stock_checkpoint_triggers),
+    (8, 'Change log triggers for incremental backups', _add_backup_change_triggers),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(db_path):
+    """Read the stored schema version (0 for legacy or missing databases)"""
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def has_pending_migrations(db_path):
+    return get_schema_version(db_path) < SCHEMA_VERSION
+
+
+def apply_migrations(db_path):
+    """
+    Apply every migration step newer than the stored schema version.
+    Returns the list of applied versions.
+    """
+    conn = sqlite3.connect(db_path)
+    applied = []
+    try:
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"Migration: Applying v{version} - {description}")
+            try:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+                applied.append(version)
+            except Exception as e:
+                conn.rollback()
+                print(f"Migration Error on v{version}: {e}")
+                raise
+    finally:
+        conn.close()
+    return applied
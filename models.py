@@ -1,5 +1,42 @@
 from extensions import db
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import event
+from sqlalchemy.ext.hybrid import hybrid_property
+
+# Fuel quantities are stored as integer centiliters so sums and duplicate
+# checks are exact; the `quantity` attribute keeps the liter API.
+CENTILITERS_PER_LITER = 100
+
+def to_centiliters(liters):
+    """Convert liters (float, str or Decimal) to integer centiliters, rounding half up"""
+    if liters is None:
+        return None
+    cl = Decimal(str(liters)) * CENTILITERS_PER_LITER
+    return int(cl.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def to_liters(centiliters):
+    """Convert integer centiliters (e.g. a SUM() result, possibly None) to liters"""
+    return (centiliters or 0) / CENTILITERS_PER_LITER
+
+class LiterQuantityMixin:
+    """Liter `quantity` API over the integer `quantity_cl` column.
+    Aggregate on quantity_cl (exact) and convert once with to_liters()."""
+
+    @hybrid_property
+    def quantity(self):
+        """Quantity in liters"""
+        if self.quantity_cl is None:
+            return None
+        return to_liters(self.quantity_cl)
+
+    @quantity.setter
+    def quantity(self, value):
+        self.quantity_cl = to_centiliters(value)
+
+    @quantity.expression
+    def quantity(cls):
+        return cls.quantity_cl / float(CENTILITERS_PER_LITER)
 
 class Gestiune(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -24,6 +61,9 @@ class Company(db.Model):
     last_report_start = db.Column(db.DateTime, nullable=True)
     last_report_end = db.Column(db.DateTime, nullable=True)
 
+    # Slip series code, unique across gestiuni (see series_codes.py); None prints "---"
+    series_code = db.Column(db.String(3), nullable=True)
+
     __table_args__ = (db.UniqueConstraint('name', 'gestiune_id', name='_company_name_gestiune_uc'),)
 
     @property
@@ -87,36 +127,14 @@ class AppSettings(db.Model):
     @staticmethod
     def get_tank_capacity(gestiune_id=None):
         """Get the total tank capacity in liters for a specific gestiune"""
-        query = AppSettings.query.filter_by(key='tank_capacity')
-        if gestiune_id:
-            query = query.filter_by(gestiune_id=gestiune_id)
-        else:
-            query = query.filter(AppSettings.gestiune_id == None)
-            
-        setting = query.first()
-        if setting and setting.value:
-            try:
-                return float(setting.value)
-            except:
-                return 27000.0  # Default
-        return 27000.0
+        from services import SettingsService
+        return SettingsService.get_tank_capacity(gestiune_id)
     
     @staticmethod
     def set_tank_capacity(capacity, gestiune_id=None):
         """Set the total tank capacity for a specific gestiune"""
-        query = AppSettings.query.filter_by(key='tank_capacity')
-        if gestiune_id:
-            query = query.filter_by(gestiune_id=gestiune_id)
-        else:
-            query = query.filter(AppSettings.gestiune_id == None)
-            
-        setting = query.first()
-        if not setting:
-            setting = AppSettings(key='tank_capacity', value=str(capacity), gestiune_id=gestiune_id)
-            db.session.add(setting)
-        else:
-            setting.value = str(capacity)
-        db.session.commit()
+        from services import SettingsService
+        SettingsService.set_tank_capacity(capacity, gestiune_id)
 
 
 class VehicleCategory(db.Model):
@@ -137,12 +155,15 @@ class Vehicle(db.Model):
     
     category = db.relationship('VehicleCategory', backref=db.backref('vehicles', order_by='Vehicle.plate_number'), lazy=True)
     
-    __table_args__ = (db.UniqueConstraint('plate_number', 'gestiune_id', name='_plate_gestiune_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('plate_number', 'gestiune_id', name='_plate_gestiune_uc'),
+        db.Index('ix_vehicle_category', 'category_id'),
+    )
 
-class StockOperation(db.Model):
+class StockOperation(LiterQuantityMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     operation_type = db.Column(db.String(20)) # 'IN' (Refill), 'INITIAL', 'OUT' (Correction)
-    quantity = db.Column(db.Float, nullable=False)
+    quantity_cl = db.Column(db.Integer, nullable=False) # Centiliters, see `quantity` for liters
     date = db.Column(db.DateTime, default=datetime.utcnow)
     description = db.Column(db.String(200))
     company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=True)
@@ -150,27 +171,103 @@ class StockOperation(db.Model):
     
     company = db.relationship('Company', backref='stock_operations', lazy=True)
 
-class Transaction(db.Model):
+    __table_args__ = (
+        db.Index('ix_stock_operation_company', 'company_id', 'gestiune_id', 'operation_type'),
+        db.Index('ix_stock_operation_gestiune_date', 'gestiune_id', 'date'),
+    )
+
+class Transaction(LiterQuantityMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, nullable=False)
     vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id', ondelete='CASCADE'))
     company_id = db.Column(db.Integer, db.ForeignKey('company.id'))
-    quantity = db.Column(db.Float, nullable=False)
+    quantity_cl = db.Column(db.Integer, nullable=False) # Centiliters, see `quantity` for liters
     gestiune_id = db.Column(db.Integer, db.ForeignKey('gestiune.id'), nullable=True)
     
     vehicle = db.relationship('Vehicle', backref='transactions', lazy=True)
     
     # Preventing duplicates within same gestiune
-    __table_args__ = (db.UniqueConstraint('date', 'vehicle_id', 'quantity', 'gestiune_id', name='_date_vehicle_qty_gestiune_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('date', 'vehicle_id', 'quantity_cl', 'gestiune_id', name='_date_vehicle_qty_gestiune_uc'),
+        db.Index('ix_transaction_gestiune_date', 'gestiune_id', 'date'),
+        db.Index('ix_transaction_company', 'company_id', 'gestiune_id'),
+        db.Index('ix_transaction_vehicle', 'vehicle_id'),
+    )
+
+class StockCheckpoint(db.Model):
+    """Company balance (centiliters) of the rows dated before `at`, see stock_checkpoints.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    gestiune_id = db.Column(db.Integer, db.ForeignKey('gestiune.id'), nullable=False)
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=False)
+    at = db.Column(db.DateTime, nullable=False)
+    balance_cl = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('gestiune_id', 'at', 'company_id', name='_checkpoint_gestiune_at_company_uc'),
+    )
+
+def _schema_is_current(connection):
+    """
+    False while migrations are pending (run_migrations calls create_all first):
+    the trigger bodies read tables that migration v3 still rebuilds, so on an
+    upgrade they are left to migrations v7/v8.
+    """
+    from migrations import SCHEMA_VERSION
+    return connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_checkpoint_triggers(target, connection, **kw):
+    from stock_checkpoints import CHECKPOINT_TRIGGERS
+    if not _schema_is_current(connection):
+        return
+    for statement in CHECKPOINT_TRIGGERS:
+        connection.exec_driver_sql(statement)
+
+class BackupMark(db.Model):
+    """High-water mark (last backup_change.seq) of a gestiune's incremental backup chain, see profile_diff.py"""
+    gestiune_id = db.Column(db.Integer, db.ForeignKey('gestiune.id'), primary_key=True, autoincrement=False)
+    chain_id = db.Column(db.String(32), nullable=False)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+    exported_at = db.Column(db.DateTime, default=datetime.now)
+
+class BackupChange(db.Model):
+    """Profile row inserted, updated or deleted since the last backup (written by triggers)"""
+    seq = db.Column(db.Integer, primary_key=True)
+    gestiune_id = db.Column(db.Integer, nullable=False)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_backup_change_gestiune', 'gestiune_id', 'table_name', 'seq'),
+        # seq never goes back after the exported changes are pruned
+        {'sqlite_autoincrement': True},
+    )
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_backup_change_triggers(target, connection, **kw):
+    from profile_diff import CHANGE_TRIGGERS
+    if not _schema_is_current(connection):
+        return
+    for statement in CHANGE_TRIGGERS:
+        connection.exec_driver_sql(statement)
 
 class HistoryLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     table_name = db.Column(db.String(50)) # 'StockOperation' or 'Transaction'
     record_id = db.Column(db.Integer)
     action_type = db.Column(db.String(20)) # 'CREATE', 'UPDATE', 'DELETE'
-    data_snapshot = db.Column(db.Text) # JSON string of the state (post-update for UPDATE)
-    pre_update_snapshot = db.Column(db.Text) # JSON string of pre-update state (for UPDATE actions)
+    # history_codec blobs: the row (CREATE/DELETE) or the changed columns + id (UPDATE);
+    # JSON text in entries written before the binary format
+    data_snapshot = db.Column(db.LargeBinary) # post-update values for UPDATE
+    pre_update_snapshot = db.Column(db.LargeBinary) # pre-update values (for UPDATE actions)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     is_undone = db.Column(db.Boolean, default=False)
     gestiune_id = db.Column(db.Integer, db.ForeignKey('gestiune.id'), nullable=True)
+    # Entries of one bulk action share the id of its first entry (None for single actions)
+    changeset_id = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_history_log_gestiune_undone', 'gestiune_id', 'is_undone', 'id'),
+        db.Index('ix_history_log_changeset', 'changeset_id'),
+    )
 
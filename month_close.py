@@ -0,0 +1,259 @@
+"""
+Month-close batch: every report of a period built in one pass, as one ZIP.
+
+The period's transactions (with plate and category joined in) and stock
+movements are read once into a PeriodSnapshot, kept column-wise. The bon
+batch of each company, the monthly report and the analysis report are derived
+from that snapshot, rendered side by side in a process pool (the renderers
+need no database access) and packed into
+<timestamp>_Inchidere_<gestiune>_<start>_<end>.zip in Downloads.
+"""
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pathlib import Path
+
+from metrics import count_pdf_pages
+from report_jobs import set_progress
+
+TRANSACTION_COLUMNS = ('id', 'date', 'vehicle_id', 'company_id', 'quantity_cl', 'plate', 'category')
+
+
+class PeriodSnapshot:
+    """
+    Rows of one gestiune and period, loaded once. `transactions` maps each of
+    TRANSACTION_COLUMNS to a list (rows ordered by date, id); `movements`
+    holds the (company_id, kind, quantity_cl) stock operations of the monthly
+    summary: every INITIAL entry plus IN/OUT within the period.
+    """
+
+    def __init__(self, gestiune_id, start_date, end_date):
+        from models import db, Company, Vehicle, VehicleCategory, StockOperation
+        from archive import transaction_source, stock_operation_source
+        from sqlalchemy import select, union_all
+
+        self.gestiune_id = gestiune_id
+        self.start_date = start_date
+        self.end_date = end_date
+
+        # Hot table plus archived years in range, plate and category joined in
+        trans_src = transaction_source(gestiune_id, start_date, end_date)
+        rows = db.session.query(
+            trans_src.c.id, trans_src.c.date, trans_src.c.vehicle_id, trans_src.c.company_id,
+            trans_src.c.quantity_cl, Vehicle.plate_number, VehicleCategory.name
+        ).select_from(trans_src)\
+         .outerjoin(Vehicle, Vehicle.id == trans_src.c.vehicle_id)\
+         .outerjoin(VehicleCategory, VehicleCategory.id == Vehicle.category_id)\
+         .filter(trans_src.c.gestiune_id == gestiune_id, trans_src.c.date >= start_date, trans_src.c.date <= end_date)\
+         .order_by(trans_src.c.date, trans_src.c.id).all()
+        columns = [list(col) for col in zip(*rows)] if rows else [[] for _ in TRANSACTION_COLUMNS]
+        self.transactions = dict(zip(TRANSACTION_COLUMNS, columns))
+
+        ops_src = stock_operation_source(gestiune_id, start_date, end_date)
+        movements = union_all(
+            select(StockOperation.company_id, StockOperation.operation_type, StockOperation.quantity_cl).where(
+                StockOperation.gestiune_id == gestiune_id,
+                StockOperation.operation_type == 'INITIAL'
+            ),
+            select(ops_src.c.company_id, ops_src.c.operation_type, ops_src.c.quantity_cl).where(
+                ops_src.c.gestiune_id == gestiune_id,
+                ops_src.c.operation_type.in_(('IN', 'OUT')),
+                ops_src.c.date >= start_date,
+                ops_src.c.date <= end_date
+            )
+        )
+        self.movements = [tuple(row) for row in db.session.execute(movements)]
+
+        self.companies = Company.query.filter_by(gestiune_id=gestiune_id).order_by(Company.id).all()
+
+    def __len__(self):
+        return len(self.transactions['id'])
+
+    def company_sums(self):
+        """{company_id: (initial, in, out, consumed)} centiliter totals, as monthly_company_stats expects"""
+        sums = {}
+        for company_id, kind, quantity_cl in self.movements:
+            totals = sums.setdefault(company_id, [0, 0, 0, 0])
+            totals[('INITIAL', 'IN', 'OUT').index(kind)] += quantity_cl
+        for company_id, quantity_cl in zip(self.transactions['company_id'], self.transactions['quantity_cl']):
+            sums.setdefault(company_id, [0, 0, 0, 0])[3] += quantity_cl
+        return {company_id: tuple(totals) for company_id, totals in sums.items()}
+
+    def chronological(self):
+        """Istoric Cronologic rows of the monthly report"""
+        from models import to_liters
+        names = {c.id: c.name for c in self.companies}
+        t = self.transactions
+        return [{
+            'date': date,
+            'type': 'CONSUM',
+            'vehicle': plate or 'N/A',
+            'quantity': to_liters(quantity_cl),
+            'company': names.get(company_id) or 'N/A'
+        } for date, plate, company_id, quantity_cl in zip(t['date'], t['plate'], t['company_id'], t['quantity_cl'])]
+
+    def slip_rows(self):
+        """{company_id: [(plate, date, quantity)]} in date order, for build_slips"""
+        from models import to_liters
+        t = self.transactions
+        by_company = {}
+        for company_id, plate, date, quantity_cl in zip(t['company_id'], t['plate'], t['date'], t['quantity_cl']):
+            by_company.setdefault(company_id, []).append((plate, date, to_liters(quantity_cl)))
+        return by_company
+
+    def category_fuel(self):
+        """(category name, liters) consumption per vehicle category, as analysis_report_context expects"""
+        from models import to_liters
+        totals = {}
+        for category, quantity_cl in zip(self.transactions['category'], self.transactions['quantity_cl']):
+            if category is not None:
+                totals[category] = totals.get(category, 0) + quantity_cl
+        return [(name, to_liters(totals[name])) for name in sorted(totals)]
+
+
+def _write_slips(slips, bon_number, filepath):
+    """Process pool entry point for one company's bon batch"""
+    from pdf_slips import render_slips
+    render_slips(slips, bon_number).output(filepath)
+
+
+def _write_monthly(args, filepath):
+    from pdf_monthly import render_monthly_pdf
+    render_monthly_pdf(*args, filepath)
+
+
+def _write_analysis(data, filepath):
+    from pdf_analysis import render_analysis_pdf
+    render_analysis_pdf(data, filepath)
+
+
+def _safe_name(text):
+    from pdf_slips import clean_to_ascii
+    return re.sub(r'[^A-Za-z0-9]+', '_', clean_to_ascii(text)).strip('_') or 'Firma'
+
+
+def _render_all(tasks, work_dir):
+    """
+    Render (arcname, func, args) tasks into `work_dir` in a process pool.
+    When the pool cannot start or breaks, the tasks it did not finish are
+    rendered sequentially; errors raised by a renderer propagate.
+    Returns {arcname: path}.
+    """
+    paths = {arcname: os.path.join(work_dir, arcname) for arcname, _, _ in tasks}
+    pages = 0
+    done = set()
+    failed = None
+    try:
+        with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(func, *args, paths[arcname]): arcname for arcname, func, args in tasks}
+            for future in as_completed(futures):
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    raise error
+                if error is not None:
+                    failed = error
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    break
+                done.add(futures[future])
+                pages += count_pdf_pages(paths[futures[future]])
+                set_progress(pages=pages)
+    except (BrokenProcessPool, OSError) as e:
+        print(f"[PDF] Process pool unavailable, rendering {len(tasks) - len(done)} month-close reports sequentially: {e}")
+    if failed is not None:
+        raise failed
+
+    for arcname, func, args in tasks:
+        if arcname in done:
+            continue
+        func(*args, paths[arcname])
+        pages += count_pdf_pages(paths[arcname])
+        set_progress(pages=pages)
+    return paths
+
+
+def generate_month_close(start_date, end_date, gestiune_id, bon_number="", initial_series=None,
+                         final_series=None, analysis_context=None):
+    """
+    Build the bon batches (one per company), the monthly report and, with
+    `analysis_context` (called with stats=...), the analysis report of the
+    period from one PeriodSnapshot and pack them into one ZIP.
+    Returns (filepath, message) like the other report generators.
+    """
+    from models import db, Gestiune
+    from services import build_slips, get_series_codes, monthly_company_stats
+
+    if isinstance(start_date, str):
+        try:
+            start_date = datetime.strptime(start_date, '%Y-%m-%dT%H:%M')
+        except ValueError:
+            start_date = datetime.strptime(start_date, '%Y-%m-%d')
+    if isinstance(end_date, str):
+        try:
+            end_date = datetime.strptime(end_date, '%Y-%m-%dT%H:%M')
+        except ValueError:
+            end_date = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+
+    gest = Gestiune.query.get(gestiune_id)
+    gest_name = gest.name.replace(" ", "_") if gest else "Gestiune"
+    series_map = get_series_codes(gestiune_id)
+
+    snapshot = PeriodSnapshot(gestiune_id, start_date, end_date)
+    print(f"[PDF] Month close {gest_name}: {len(snapshot)} transactions, {len(snapshot.movements)} stock operations")
+
+    # 1. One bon batch per company (transactions without a company together)
+    tasks = []
+    companies = {c.id: c for c in snapshot.companies}
+    slip_rows = snapshot.slip_rows()
+    for company_id in sorted(slip_rows, key=lambda cid: cid or 0):
+        company = companies.get(company_id)
+        slips = build_slips(((company_id, company, plate, date, quantity)
+                             for plate, date, quantity in slip_rows[company_id]), series_map)
+        # Names can sanitize to the same text ("A.B" / "A-B"): the id keeps the entries apart
+        name = _safe_name(company.name) if company else 'NECUNOSCUT'
+        arcname = f"Bonuri_{company_id}_{name}.pdf" if company_id else f"Bonuri_{name}.pdf"
+        tasks.append((arcname, _write_slips, (slips, bon_number)))
+
+    # 2. Monthly report
+    company_stats, total_in, total_out = monthly_company_stats(snapshot.companies, snapshot.company_sums())
+    tasks.append(("Raport_Lunar.pdf", _write_monthly,
+                  ((start_date, end_date, company_stats, total_in, total_out, snapshot.chronological(),
+                    initial_series, final_series),)))
+
+    # 3. Analysis report
+    if analysis_context is not None:
+        data = dict(analysis_context(stats=snapshot.category_fuel()),
+                    generated_at=datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+        tasks.append(("Analiza.pdf", _write_analysis, (data,)))
+
+    # Remember the interval on every company that got a bon batch, like /admin/report does
+    for company_id in slip_rows:
+        if company_id in companies:
+            companies[company_id].last_report_start = start_date
+            companies[company_id].last_report_end = end_date
+    db.session.commit()
+
+    downloads_path = Path.home() / "Downloads"
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+    filename = f"{timestamp}_Inchidere_{gest_name}_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.zip"
+    filepath = str(downloads_path / filename)
+
+    work_dir = tempfile.mkdtemp(prefix='month_close_')
+    try:
+        paths = _render_all(tasks, work_dir)
+        tmp_path = filepath + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for arcname, _, _ in tasks:
+                zf.write(paths[arcname], arcname)
+        os.replace(tmp_path, filepath)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    message = f"Închidere lună: {len(slip_rows)} loturi de bonuri ({len(snapshot)} bonuri), raport lunar" + \
+              (" și analiză." if analysis_context is not None else ".")
+    print(f"[PDF] Month close written to {filepath}")
+    return filepath, message
@@ -0,0 +1,250 @@
+"""
+Native FPDF renderer for the efficiency analysis report (analysis_pdf).
+
+Draws the same report as templates/analysis_pdf.html (A4 landscape: header,
+KPI boxes, Budila table, and a second page with the Ghidfalau KPIs and table)
+directly with FPDF, from the values analysis_pdf() prepares for the template.
+generate_analysis_report_pdf falls back to the xhtml2pdf/HTML pipeline when
+this renderer fails or FUEL_ANALYSIS_PDF_ENGINE=xhtml2pdf.
+"""
+import base64
+import os
+import tempfile
+
+from fpdf import FPDF
+
+from formatting import format_thousands
+from pdf_slips import clean_to_ascii
+from report_jobs import set_progress
+
+# Palette of analysis_pdf.html
+SLATE_900 = (15, 23, 42)
+SLATE_800 = (30, 41, 59)
+SLATE_700 = (51, 65, 85)
+SLATE_600 = (71, 85, 105)
+SLATE_500 = (100, 116, 139)
+SLATE_400 = (148, 163, 184)
+SLATE_200 = (226, 232, 240)
+SLATE_100 = (241, 245, 249)
+SLATE_50 = (248, 250, 252)
+BLUE = (59, 130, 246)
+ACCENT = (37, 99, 235)
+AMBER = (245, 158, 11)
+WARNING = (217, 119, 6)
+
+MARGIN = 10
+# Data table columns: share of the page width, header, alignment
+TABLE_COLUMNS = (
+    (0.30, "Categorie Utilaj", 'L'),
+    (0.15, "Litri Consumati", 'R'),
+    (0.15, "Valoare Baza", 'R'),
+    (0.25, "Baza de calcul selectata", 'L'),
+    (0.15, "Eficienta (L/MC)", 'R'),
+)
+ROW_H = 8
+BULLET = chr(149)  # WinAnsi bullet of the core fonts
+
+
+class AnalysisPDF(FPDF):
+    def __init__(self, gestiune_name):
+        super().__init__('L', 'mm', 'A4')
+        self.gestiune_name = gestiune_name
+        self.set_margins(MARGIN, MARGIN, MARGIN)
+        self.set_auto_page_break(auto=True, margin=15)
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_draw_color(*SLATE_200)
+        self.line(MARGIN, self.get_y(), self.w - MARGIN, self.get_y())
+        self.set_font('Helvetica', '', 8)
+        self.set_text_color(*SLATE_400)
+        self.cell(0, 8, f"Analiza Performanta Operationala Flota {BULLET} {self.gestiune_name} {BULLET} Pagina {self.page_no()}", 0, 0, 'C')
+        set_progress(pages=self.page_no())
+
+
+def _logo_file(logo_base64):
+    """Write a data-URI logo to a temporary file FPDF can read; None if unusable"""
+    if not logo_base64 or not logo_base64.startswith('data:image/'):
+        return None
+    try:
+        header, payload = logo_base64.split(',', 1)
+        ext = header[len('data:image/'):].split(';')[0].lower()
+        if ext not in ('png', 'jpg', 'jpeg'):
+            return None
+        fd, path = tempfile.mkstemp(suffix='.' + ext)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(payload))
+        return path
+    except (ValueError, OSError):
+        return None
+
+
+def _draw_header(pdf, data, logo_path):
+    top = MARGIN
+    drawn_logo = False
+    if logo_path:
+        try:
+            pdf.image(logo_path, MARGIN, top, h=13)
+            drawn_logo = True
+        except Exception as e:
+            print(f"[PDF] Analysis logo skipped: {e}")
+    if not drawn_logo:
+        pdf.set_xy(MARGIN, top)
+        pdf.set_font('Helvetica', 'B', 16)
+        pdf.set_text_color(*SLATE_700)
+        pdf.cell(60, 8, clean_to_ascii(data['gestiune_name']), 0, 0, 'L')
+
+    # Title and period, centred
+    pdf.set_xy(MARGIN, top)
+    pdf.set_font('Helvetica', 'B', 18)
+    pdf.set_text_color(*SLATE_900)
+    pdf.cell(0, 9, "RAPORT ANALIZA EFICIENTA", 0, 2, 'C')
+
+    label = "Perioada: "
+    period = f"{data['start_date']} - {data['end_date']}"
+    pdf.set_font('Helvetica', '', 10)
+    label_w = pdf.get_string_width(label)
+    pdf.set_font('Helvetica', 'B', 10)
+    period_w = pdf.get_string_width(period)
+    pdf.set_x((pdf.w - label_w - period_w) / 2)
+    pdf.set_font('Helvetica', '', 10)
+    pdf.set_text_color(*SLATE_600)
+    pdf.cell(label_w, 5, label, 0, 0, 'L')
+    pdf.set_font('Helvetica', 'B', 10)
+    pdf.cell(period_w, 5, period, 0, 0, 'L')
+
+    # Generation time, top right
+    pdf.set_xy(pdf.w - MARGIN - 60, top)
+    pdf.set_font('Helvetica', '', 8)
+    pdf.set_text_color(*SLATE_400)
+    pdf.cell(60, 4, f"Generat la: {data.get('generated_at', '')}", 0, 0, 'R')
+
+    pdf.set_y(top + 19)
+
+
+def _draw_kpi_boxes(pdf, boxes):
+    """boxes: (label, value, unit, value_color, top_color or None, basis line or None)"""
+    gap = 3
+    y = pdf.get_y()
+    width = (pdf.w - 2 * MARGIN - gap * (len(boxes) - 1)) / len(boxes)
+    height = 24
+    for i, (label, value, unit, value_color, top_color, basis) in enumerate(boxes):
+        value = str(value)  # format_thousands passes non-numbers through unchanged
+        x = MARGIN + i * (width + gap)
+        pdf.set_fill_color(*SLATE_50)
+        pdf.set_draw_color(*SLATE_200)
+        pdf.rect(x, y, width, height, 'DF')
+        if top_color:
+            pdf.set_fill_color(*top_color)
+            pdf.rect(x, y, width, 1, 'F')
+
+        pdf.set_xy(x + 3, y + 3)
+        pdf.set_font('Helvetica', 'B', 8)
+        pdf.set_text_color(*SLATE_500)
+        pdf.cell(width - 6, 4, label.upper(), 0, 2, 'L')
+
+        pdf.set_font('Helvetica', 'B', 16)
+        pdf.set_text_color(*value_color)
+        value_w = pdf.get_string_width(value) + 2
+        pdf.cell(value_w, 9, value, 0, 0, 'L')
+        pdf.set_font('Helvetica', '', 9)
+        pdf.set_text_color(*SLATE_400)
+        pdf.cell(20, 9, unit, 0, 2, 'L')
+
+        if basis:
+            pdf.set_x(x + 3)
+            pdf.set_font('Helvetica', '', 8)
+            pdf.set_text_color(*SLATE_500)
+            pdf.cell(width - 6, 4, basis, 0, 0, 'L')
+    pdf.set_y(y + height + 5)
+
+
+def _draw_section_header(pdf, title, bar_color):
+    y = pdf.get_y()
+    pdf.set_fill_color(*SLATE_100)
+    pdf.rect(MARGIN, y, pdf.w - 2 * MARGIN, 9, 'F')
+    pdf.set_fill_color(*bar_color)
+    pdf.rect(MARGIN, y, 1.4, 9, 'F')
+    pdf.set_xy(MARGIN + 4, y)
+    pdf.set_font('Helvetica', 'B', 11)
+    pdf.set_text_color(*SLATE_800)
+    pdf.cell(0, 9, title, 0, 1, 'L')
+    pdf.ln(2)
+
+
+def _draw_table_header(pdf, widths):
+    pdf.set_x(MARGIN)
+    pdf.set_fill_color(*SLATE_700)
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font('Helvetica', 'B', 9)
+    for w, (_, title, align) in zip(widths, TABLE_COLUMNS):
+        pdf.cell(w, ROW_H, title, 0, 0, align, fill=True)
+    pdf.ln()
+
+
+def _draw_table(pdf, rows, efficiency_color):
+    widths = [share * (pdf.w - 2 * MARGIN) for share, _, _ in TABLE_COLUMNS]
+    _draw_table_header(pdf, widths)
+    pdf.set_draw_color(*SLATE_200)
+    for item in rows:
+        if pdf.get_y() + ROW_H > pdf.page_break_trigger:
+            pdf.add_page()
+            _draw_table_header(pdf, widths)
+            pdf.set_draw_color(*SLATE_200)
+        pdf.set_x(MARGIN)
+        pdf.set_font('Helvetica', '', 10)
+        pdf.set_text_color(*SLATE_800)
+        pdf.cell(widths[0], ROW_H, clean_to_ascii(item['category']), 'B', 0, 'L')
+        pdf.cell(widths[1], ROW_H, f"{format_thousands(item['fuel'], 1)} L", 'B', 0, 'R')
+        pdf.cell(widths[2], ROW_H, f"{format_thousands(item['mc_val'], 1)} MC", 'B', 0, 'R')
+        pdf.set_font('Helvetica', '', 9)
+        pdf.set_text_color(*SLATE_500)
+        pdf.cell(widths[3], ROW_H, clean_to_ascii(item['basis_name']), 'B', 0, 'L')
+        pdf.set_font('Helvetica', 'B', 10)
+        pdf.set_text_color(*efficiency_color)
+        pdf.cell(widths[4], ROW_H, f"{format_thousands(item['efficiency'], 4)}", 'B', 1, 'R')
+
+
+def render_analysis_pdf(data, filepath):
+    """
+    Write the analysis report to `filepath`. `data` holds the analysis_pdf.html
+    template values (gestiune_name, logo_base64 and logo_file, start_date,
+    end_date, the fuel totals, mc_* bases, eff_* scores, budila_data,
+    ghidfalau_data, generated_at).
+    """
+    pdf = AnalysisPDF(clean_to_ascii(data['gestiune_name']))
+    # Prepared logo from pdf_resources when available, else a decoded copy of the data URI
+    logo_path = data.get('logo_file')
+    temp_logo = None
+    if not (logo_path and os.path.exists(logo_path)):
+        logo_path = temp_logo = _logo_file(data.get('logo_base64'))
+    try:
+        # Page 1: general (Budila) figures
+        pdf.add_page()
+        _draw_header(pdf, data, logo_path)
+        _draw_kpi_boxes(pdf, [
+            ("Consum total (net)", format_thousands(data['net_fuel'], 1), "LTR", SLATE_900, None, None),
+            ("Scor / total mc vanduti", format_thousands(data['eff_vanduti'], 4), "L/MC", ACCENT, BLUE,
+             f"Baza: Total Vanduti ({format_thousands(data['mc_vanduti'], 0)} MC)"),
+            ("Scor / total balast sortat", format_thousands(data['eff_sortati'], 4), "L/MC", ACCENT, BLUE,
+             f"Baza: Balast Sortat ({format_thousands(data['mc_sortati'], 0)} MC)"),
+        ])
+        _draw_section_header(pdf, "DETALIU CATEGORII - BUDILA", BLUE)
+        _draw_table(pdf, data['budila_data'], ACCENT)
+
+        # Page 2: Ghidfalau, only when it has categories
+        if data['ghidfalau_data']:
+            pdf.add_page()
+            _draw_header(pdf, data, logo_path)
+            _draw_kpi_boxes(pdf, [
+                ("Consum total Ghidfalau", format_thousands(data['total_fuel_ghid'], 0), "LTR", SLATE_900, None, None),
+                ("Scor / nisip exploatat Ghidfalau", format_thousands(data['eff_ghid'], 4), "L/MC", WARNING, AMBER,
+                 f"Baza: Nisip Exploatat ({format_thousands(data['mc_ghid'], 0)} MC)"),
+            ])
+            _draw_section_header(pdf, "DETALIU CATEGORII - GHIDFALAU", AMBER)
+            _draw_table(pdf, data['ghidfalau_data'], WARNING)
+
+        pdf.output(filepath)
+    finally:
+        if temp_logo:
+            os.remove(temp_logo)
@@ -0,0 +1,127 @@
+"""
+Rendering of the monthly fuel report (generate_monthly_report_pdf).
+
+The report arrives fully computed (per-company summary in liters, totals and
+the chronological consumption list), so rendering needs no database access
+and can run in worker processes (month_close).
+"""
+from fpdf import FPDF
+
+from pdf_slips import clean_to_ascii
+from report_jobs import set_progress
+
+
+class MonthlyPDF(FPDF):
+    def header(self):
+        pass
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Helvetica', 'I', 8)
+        self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
+        set_progress(pages=self.page_no())
+
+
+def render_monthly_pdf(start_date, end_date, company_stats, total_in, total_out, combined,
+                       initial_series, final_series, filepath):
+    """
+    Write the monthly report to `filepath`. `company_stats` holds one dict per
+    company (name, stock_initial, total_in, total_out, stock_final in liters),
+    `combined` the consumption rows (date, type, vehicle, quantity, company).
+    """
+    pdf = MonthlyPDF()
+    pdf.add_page()
+    pdf.set_font('Helvetica', 'B', 16)
+
+    # Title
+    pdf.cell(0, 10, clean_to_ascii('Raport Lunar - Gestiune Motorina'), 0, 1, 'C')
+    pdf.set_font('Helvetica', '', 10)
+    pdf.cell(0, 6, f"Perioada: {start_date.strftime('%d.%m.%Y %H:%M')} - {end_date.strftime('%d.%m.%Y %H:%M')}", 0, 1, 'C')
+    pdf.ln(5)
+
+    # Summary Table
+    pdf.set_font('Helvetica', 'B', 12)
+    pdf.cell(0, 8, clean_to_ascii('Sumar Statistic'), 0, 1, 'L')
+    pdf.set_font('Helvetica', 'B', 8)
+
+    # Table header
+    pdf.cell(60, 6, 'Firma', 1, 0, 'C')
+    pdf.cell(30, 6, 'Stoc Initial', 1, 0, 'C')
+    pdf.cell(30, 6, 'Total Intrat', 1, 0, 'C')
+    pdf.cell(30, 6, 'Total Iesit', 1, 0, 'C')
+    pdf.cell(30, 6, 'Stoc Final', 1, 1, 'C')
+
+    pdf.set_font('Helvetica', '', 8)
+    for stat in company_stats:
+        pdf.cell(60, 6, stat['name'], 1, 0, 'L')
+        pdf.cell(30, 6, f"{stat['stock_initial']:.2f} L", 1, 0, 'R')
+        pdf.cell(30, 6, f"{stat['total_in']:.2f} L", 1, 0, 'R')
+        pdf.cell(30, 6, f"{stat['total_out']:.2f} L", 1, 0, 'R')
+        pdf.cell(30, 6, f"{stat['stock_final']:.2f} L", 1, 1, 'R')
+
+    # Overall totals
+    pdf.set_font('Helvetica', 'B', 8)
+    pdf.cell(60, 6, 'TOTAL GENERAL', 1, 0, 'L')
+    # pdf.cell(30, 6, f"{total_initial_stock:.2f} L", 1, 0, 'R') # Removed to fit
+    pdf.cell(30, 6, f"{total_in:.2f} L", 1, 0, 'R')
+    pdf.cell(60, 6, f"{total_out:.2f} L", 1, 0, 'R')
+    # pdf.cell(30, 6, f"{total_final_stock:.2f} L", 1, 1, 'R')
+    pdf.ln(10)
+
+    # PUMP SERIES SECTION
+    if initial_series is not None and final_series is not None:
+        pdf.set_font('Helvetica', 'B', 10)
+        pdf.cell(0, 8, clean_to_ascii('Verificare Contoare Pompa'), 0, 1, 'L')
+        pdf.set_font('Helvetica', '', 9)
+
+        series_diff = final_series - initial_series
+
+        # Simple grid
+        pdf.cell(50, 6, 'Serie Initiala:', 0, 0, 'L')
+        pdf.cell(40, 6, f"{initial_series:.2f}", 0, 1, 'L')
+
+        pdf.cell(50, 6, 'Serie Finala:', 0, 0, 'L')
+        pdf.cell(40, 6, f"{final_series:.2f}", 0, 1, 'L')
+
+        pdf.set_font('Helvetica', 'B', 9)
+        pdf.cell(50, 6, 'Diferenta Serii:', 0, 0, 'L')
+        pdf.cell(40, 6, f"{series_diff:.2f} L", 0, 1, 'L')
+
+        pdf.cell(50, 6, 'Total Iesit (Calculat):', 0, 0, 'L')
+        pdf.cell(40, 6, f"{total_out:.2f} L", 0, 1, 'L')
+
+        # Match Check
+        match_diff = abs(series_diff - total_out)
+        if match_diff < 1.0: # Tolerance of 1 liter
+            pdf.set_text_color(0, 128, 0)
+            pdf.cell(0, 6, clean_to_ascii(f"OK (Diferenta: {match_diff:.2f} L)"), 0, 1, 'L')
+        else:
+            pdf.set_text_color(255, 0, 0)
+            pdf.cell(0, 6, clean_to_ascii(f"DISCREPANTA (Diferenta: {match_diff:.2f} L)"), 0, 1, 'L')
+
+        pdf.set_text_color(0, 0, 0) # Reset
+        pdf.ln(5)
+
+    pdf.ln(5)
+
+    # Detailed Transactions
+    pdf.set_font('Helvetica', 'B', 12)
+    pdf.cell(0, 8, clean_to_ascii('Istoric Cronologic'), 0, 1, 'L')
+    pdf.set_font('Helvetica', 'B', 8)
+
+    # Table header
+    pdf.cell(35, 6, 'Data/Ora', 1, 0, 'C')
+    pdf.cell(50, 6, 'Firma', 1, 0, 'C')
+    pdf.cell(25, 6, 'Tip', 1, 0, 'C')
+    pdf.cell(50, 6, 'Vehicul/Detalii', 1, 0, 'C')
+    pdf.cell(30, 6, 'Cantitate', 1, 1, 'C')
+
+    pdf.set_font('Helvetica', '', 7)
+    for item in combined:
+        pdf.cell(35, 5, item['date'].strftime('%d.%m.%Y %H:%M'), 1, 0, 'L')
+        pdf.cell(50, 5, clean_to_ascii(item['company'][:20]), 1, 0, 'L')
+        pdf.cell(25, 5, item['type'], 1, 0, 'C')
+        pdf.cell(50, 5, clean_to_ascii(item['vehicle'][:25]), 1, 0, 'L')
+        pdf.cell(30, 5, f"{item['quantity']:.2f} L", 1, 1, 'R')
+
+    pdf.output(filepath)
@@ -0,0 +1,110 @@
+"""
+Image resources shared by the PDF reports, prepared once per file change.
+
+A logo is read, downsized to LOGO_MAX_PX (Pillow), flattened onto white (FPDF
+1.7 cannot draw PNG alpha channels) and base64-encoded the first time it is
+used; the result is kept in memory keyed by path, mtime and size, so a new
+upload is picked up on the next report. The prepared file is also written to
+cache/resources next to the database, which lets the native renderers (and
+their worker processes) hand FPDF a path instead of decoding the data URI.
+"""
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+# Logos are drawn 13 mm (PDF) / 50 px (HTML) high: 300 px stays sharp in print
+LOGO_MAX_PX = 300
+RESOURCE_DIRNAME = os.path.join('cache', 'resources')
+
+_logos = {}  # abs path -> (mtime_ns, size, data_uri, prepared file)
+_lock = threading.Lock()
+
+
+def get_resource_dir():
+    """cache/resources next to the database file (temp dir for in-memory databases)"""
+    from models import db
+    db_path = db.engine.url.database
+    if not db_path or db_path == ':memory:':
+        return os.path.join(tempfile.gettempdir(), 'fuel_manager_resources')
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), RESOURCE_DIRNAME)
+
+
+def _prepare(path):
+    """(bytes, ext) of the downsized logo; the original bytes when Pillow is missing or fails"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    ext = os.path.splitext(path)[1][1:].lower()
+    ext = 'jpg' if ext == 'jpeg' else ext
+    try:
+        from PIL import Image
+    except ImportError:
+        return raw, ext
+
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img.load()
+        if img.height > LOGO_MAX_PX:
+            img = img.resize((max(1, round(img.width * LOGO_MAX_PX / img.height)), LOGO_MAX_PX), Image.LANCZOS)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            flat = Image.new('RGB', img.size, (255, 255, 255))
+            flat.paste(img, mask=img.getchannel('A'))
+            img = flat
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        out = io.BytesIO()
+        if ext == 'jpg':
+            img.save(out, 'JPEG', quality=90, optimize=True)
+        else:
+            img.save(out, 'PNG', optimize=True)
+            ext = 'png'
+        return out.getvalue(), ext
+    except Exception as e:
+        print(f"[PDF] Logo {path} not downsized: {e}")
+        return raw, ext
+
+
+def logo_resource(path):
+    """
+    (data URI, prepared file path) of the logo at `path`, built once per
+    change of the file; (None, None) when it does not exist or is unreadable.
+    """
+    path = os.path.abspath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+
+    with _lock:
+        entry = _logos.get(path)
+        if entry and entry[:2] == (st.st_mtime_ns, st.st_size) and os.path.exists(entry[3]):
+            return entry[2], entry[3]
+
+    try:
+        data, ext = _prepare(path)
+    except OSError as e:
+        print(f"[PDF] Logo {path} unreadable: {e}")
+        return None, None
+    data_uri = f"data:image/{ext};base64,{base64.b64encode(data).decode()}"
+
+    resource_dir = get_resource_dir()
+    name = hashlib.sha256(path.encode('utf-8')).hexdigest()[:16]
+    prepared = os.path.join(resource_dir, f"logo_{name}.{ext}")
+    try:
+        os.makedirs(resource_dir, exist_ok=True)
+        tmp_path = prepared + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, prepared)
+    except OSError as e:
+        print(f"[PDF] Could not cache logo {path}: {e}")
+        prepared = None
+
+    with _lock:
+        if prepared:
+            _logos[path] = (st.st_mtime_ns, st.st_size, data_uri, prepared)
+    return data_uri, prepared
@@ -0,0 +1,334 @@
+"""
+Rendering of "BON DE ALIMENTARE" fuel slips (generate_pdf_report).
+
+Slips arrive as plain dicts with every field already resolved (company header,
+series, anexa number, plate, quantity), so rendering needs no database access
+and can run in worker processes. The static parts of a slip are drawn once
+per report and replayed from the recorded page content (SlipPDF.block), so
+per slip only the variable fields go through FPDF. Very large reports are split into page-aligned
+chunks along company boundaries, rendered across a process pool and merged
+with pypdf; the result is page-for-page identical to a sequential render.
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fpdf import FPDF
+
+from report_jobs import set_progress
+
+SLIPS_PER_PAGE = 2
+# Below this many slips the pool start-up/merge overhead outweighs the gain
+# (a single process renders roughly 10k slips/s with the recorded blocks)
+PARALLEL_MIN_SLIPS = 4000
+
+
+def clean_to_ascii(text):
+    """Replaces Romanian diacritics with ASCII equivalents to prevent PDF errors."""
+    if text is None:
+        return ""
+    if not isinstance(text, str):
+        return str(text)
+
+    replacements = {
+        'ă': 'a', 'Ă': 'A',
+        'â': 'a', 'Â': 'A',
+        'î': 'i', 'Î': 'I',
+        'ș': 's', 'Ș': 'S',
+        'ț': 't', 'Ț': 'T',
+        '–': '-', '”': '"', '„': '"'
+    }
+    for k, v in replacements.items():
+        text = text.replace(k, v)
+
+    # Fallback for anything else
+    try:
+        return text.encode('latin-1', 'replace').decode('latin-1')
+    except:
+        return text
+
+
+class _DocumentBuffer:
+    """
+    Stand-in for FPDF's `buffer` string. FPDF appends every object of the
+    finished document with `self.buffer += ...`, which copies the whole file
+    on each append; collecting the parts keeps output() linear in the page count.
+    """
+    def __init__(self):
+        self._parts = []
+        self._length = 0
+
+    def __iadd__(self, text):
+        self._parts.append(text)
+        self._length += len(text)
+        return self
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        return ''.join(self._parts)
+
+    def encode(self, *args):
+        return str(self).encode(*args)
+
+
+# Page state restored after replaying a recorded block
+_BLOCK_STATE = ('x', 'y', 'lasth', 'font_family', 'font_style', 'font_size_pt', 'font_size',
+                'current_font', 'underline', 'draw_color', 'fill_color', 'text_color', 'color_flag')
+
+
+class SlipPDF(FPDF):
+    def __init__(self, page_offset=0):
+        super().__init__()
+        # Pages rendered before this chunk, so merged chunks keep global page numbers
+        self.page_offset = page_offset
+        self.buffer = _DocumentBuffer()
+        self._blocks = {}
+
+    def header(self):
+        pass
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Helvetica', 'I', 8)
+        self.cell(0, 10, f'Pagina {self.page_no() + self.page_offset}', 0, 0, 'C')
+        set_progress(pages=self.page_no() + self.page_offset)
+
+    def block(self, key, draw):
+        """
+        Emit the content drawn by `draw()` at the current position. The first
+        call for `key` draws normally and records the page content it produced
+        and the resulting cursor/font state; later calls append the recorded
+        content as-is. The caller must reach the block in the same state each
+        time (same key = same position), and `draw` must select its font first.
+        """
+        recorded = self._blocks.get(key)
+        if recorded is None:
+            before = {name: getattr(self, name, None) for name in _BLOCK_STATE}
+            self.font_family = ''  # force the font selection into the recording
+            start = len(self.pages[self.page])
+            draw()
+            if not self.font_family:
+                self.font_family = before['font_family']  # block drew no text
+            changed = {name: getattr(self, name) for name in _BLOCK_STATE
+                       if getattr(self, name) != before[name]}
+            self._blocks[key] = (self.pages[self.page][start:], changed)
+        else:
+            content, changed = recorded
+            self.pages[self.page] += content
+            self.__dict__.update(changed)
+
+
+# Static texts, converted once per process instead of once per slip
+TITLE_TXT = clean_to_ascii("BON DE ALIMENTARE COMBUSTIBIL")
+ANEXA_LABEL = clean_to_ascii("Număr Anexă")
+COL_W = [35, 60, 45, 15, 35]
+COL_H = [clean_to_ascii("Data"), clean_to_ascii("Vehicul"), clean_to_ascii("Produs"), "U.M.", clean_to_ascii("Cantitate")]
+PRODUCT_TXT = clean_to_ascii("Motorina")
+SIGNATURE_TXT = (clean_to_ascii("Semnătură Șofer:"), clean_to_ascii("Semnătură Gestionar:"))
+
+
+def _draw_separator(pdf):
+    pdf.set_draw_color(200, 200, 200)
+    pdf.line(10, 140, 200, 140)
+    pdf.set_draw_color(0, 0, 0) # Reset
+
+
+def _draw_company(pdf, slip, y_start):
+    # Left Side: Company Details
+    pdf.set_y(y_start)
+    pdf.set_font('Helvetica', 'B', 12)
+    pdf.cell(100, 6, slip['company_name'], 0, 1, 'L')
+
+    pdf.set_font('Helvetica', '', 9)
+    pdf.cell(100, 5, f"CUI: {slip['cui']}", 0, 1, 'L')
+    pdf.cell(100, 5, f"Adresa: {slip['address']}", 0, 1, 'L')
+
+
+def _draw_title(pdf, bon_txt):
+    pdf.set_font('Helvetica', '', 10)
+    if bon_txt:
+        pdf.set_x(110)
+        pdf.cell(80, 6, bon_txt, 0, 1, 'R')
+
+    pdf.ln(10)
+
+    # Title of the Ticket
+    pdf.set_font('Helvetica', 'B', 14)
+    pdf.cell(0, 10, TITLE_TXT, 0, 1, 'C')
+    pdf.ln(5)
+
+    # --- Transaction Data (Table) ---
+    # Header Row
+    pdf.set_x(10) # Margin
+    pdf.set_font('Helvetica', 'B', 10)
+
+    for i in range(5):
+        pdf.cell(COL_W[i], 8, COL_H[i], 1, 0, 'C', fill=True)
+    pdf.ln()
+
+
+def _draw_product(pdf):
+    pdf.set_font('Helvetica', '', 10)
+    pdf.cell(COL_W[2], 8, PRODUCT_TXT, 1, 0, 'C')
+    pdf.cell(COL_W[3], 8, "L", 1, 0, 'C')
+
+
+def _draw_signatures(pdf):
+    pdf.set_font('Helvetica', 'B', 10)
+
+    # Signatures
+    pdf.ln(15)
+
+    y_sig = pdf.get_y()
+    pdf.set_x(20)
+    pdf.cell(60, 5, SIGNATURE_TXT[0], 0, 0, 'C')
+    pdf.cell(60, 5, SIGNATURE_TXT[1], 0, 0, 'C')
+
+    pdf.set_y(y_sig + 10)
+    pdf.set_x(20)
+    pdf.cell(60, 5, "..........................", 0, 0, 'C')
+    pdf.cell(60, 5, "..........................", 0, 0, 'C')
+
+    # Footer of slip
+    pdf.ln(5)
+    pdf.set_font('Helvetica', '', 9)
+    pdf.cell(0, 5, 'Pret unitar: 0.00 RON | Valoare: 0.00 RON', 0, 1, 'L')
+
+
+def render_slips(slips, bon_number="", page_offset=0):
+    """
+    Draw `slips` (two per A4 page) into a new SlipPDF and return it.
+    The static parts of a slip (title, table header, product cells,
+    signatures) are drawn once per slot and replayed, company header blocks
+    once per company and slot; only date, series/anexa, plate and quantity
+    are drawn per slip.
+    """
+    pdf = SlipPDF(page_offset)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    # Table header fill, set before the first page so every page starts with it
+    pdf.set_fill_color(240, 240, 240)
+    bon_txt = clean_to_ascii(f"Atașat la Bon Consum: {bon_number}") if bon_number else ""
+    series_txt = {}
+
+    for count, slip in enumerate(slips):
+        if count % SLIPS_PER_PAGE == 0:
+            pdf.add_page()
+            y_start = 10
+        else:
+            # Second slip starts at 148mm (approx half page)
+            y_start = 150
+            # Separator line between the two slips
+            pdf.block('separator', lambda: _draw_separator(pdf))
+
+        # --- Header Section ---
+        pdf.block(('company', slip['company_id'], y_start), lambda: _draw_company(pdf, slip, y_start))
+
+        # Right Side: Date, Series, Number
+        pdf.set_y(y_start)
+        pdf.set_x(110)
+
+        pdf.set_font('Helvetica', '', 10)
+        date_txt = slip['date'].strftime('%d.%m.%Y')
+        pdf.cell(80, 6, f"Data: {date_txt}", 0, 1, 'R')
+
+        series = series_txt.get(slip['series'])
+        if series is None:
+            series = series_txt[slip['series']] = clean_to_ascii(f"Seria {slip['series']}")
+        pdf.set_x(110)
+        pdf.cell(80, 6, f"{series}  |  {ANEXA_LABEL}: {slip['anexa_nr']}", 0, 1, 'R')
+
+        pdf.block(('title', y_start), lambda: _draw_title(pdf, bon_txt))
+
+        # Data Row
+        pdf.set_x(10)
+        pdf.set_font('Helvetica', '', 10)
+        pdf.cell(COL_W[0], 8, date_txt, 1, 0, 'C')
+        pdf.cell(COL_W[1], 8, slip['plate'], 1, 0, 'C')
+        pdf.block(('product', y_start), lambda: _draw_product(pdf))
+        pdf.set_font('Helvetica', 'B', 10)
+        pdf.cell(COL_W[4], 8, f"{slip['quantity']:.2f}", 1, 1, 'C')
+
+        pdf.block(('signatures', y_start), lambda: _draw_signatures(pdf))
+
+    return pdf
+
+
+def _render_chunk(args):
+    """Process pool entry point: render one chunk and return the PDF bytes"""
+    slips, bon_number, page_offset = args
+    return render_slips(slips, bon_number, page_offset).output(dest='S').encode('latin-1')
+
+
+def partition_slips(slips, parts):
+    """
+    Split `slips` into about `parts` contiguous chunks of whole companies;
+    only a company larger than two chunks is split internally. Cuts are moved
+    to an even index so no A4 page is shared between two chunks.
+    Returns a list of (start, end) index pairs.
+    """
+    total = len(slips)
+    target = max(SLIPS_PER_PAGE, -(-total // max(parts, 1)))
+    target += target % SLIPS_PER_PAGE
+
+    company_ends = []
+    for i in range(1, total):
+        if slips[i]['company_id'] != slips[i - 1]['company_id']:
+            company_ends.append(min(i + i % SLIPS_PER_PAGE, total))
+    company_ends.append(total)
+
+    bounds = [0]
+    seg_start = 0
+    for seg_end in company_ends:
+        if seg_end <= seg_start:
+            continue
+        if seg_end - seg_start > 2 * target:
+            # Dominant company: close the running chunk, then cut it in chunk-sized pieces
+            if seg_start > bounds[-1]:
+                bounds.append(seg_start)
+            while seg_end - bounds[-1] > target:
+                bounds.append(bounds[-1] + target)
+        if seg_end - bounds[-1] >= target:
+            bounds.append(seg_end)
+        seg_start = seg_end
+    if bounds[-1] < total:
+        bounds.append(total)
+    return list(zip(bounds, bounds[1:]))
+
+
+def write_slips_pdf(slips, bon_number, filepath):
+    """
+    Render `slips` to `filepath`. Large multi-chunk reports are rendered in
+    parallel when pypdf is available for the merge; otherwise sequentially.
+    """
+    total_pages = -(-len(slips) // SLIPS_PER_PAGE)
+    set_progress(total_pages=total_pages)
+    workers = os.cpu_count() or 1
+    chunks = partition_slips(slips, workers) if len(slips) >= PARALLEL_MIN_SLIPS and workers > 1 else []
+
+    if len(chunks) > 1:
+        try:
+            from pypdf import PdfWriter
+        except ImportError:
+            PdfWriter = None
+        if PdfWriter is not None:
+            jobs = [(slips[a:b], bon_number, a // SLIPS_PER_PAGE) for a, b in chunks]
+            try:
+                # Scoped like the month-close pool: no worker processes outlive the report
+                with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+                    parts = list(pool.map(_render_chunk, jobs))
+            except (BrokenProcessPool, OSError) as e:
+                # The pool could not start or a worker was killed: fall back to rendering here
+                print(f"[PDF] Parallel slip rendering failed, rendering sequentially: {e}")
+            else:
+                writer = PdfWriter()
+                for part in parts:
+                    writer.append(io.BytesIO(part))
+                with open(filepath, 'wb') as f:
+                    writer.write(f)
+                set_progress(pages=total_pages)
+                return
+
+    render_slips(slips, bon_number).output(filepath)
@@ -0,0 +1,275 @@
+"""
+Incremental (differential) backups of one profile (gestiune).
+
+A backup chain starts with a base: a full export in which every row keeps its
+id. From then on, triggers (CHANGE_TRIGGERS) append the (table, id) of every
+profile row inserted, updated or deleted to backup_change, and backup_mark
+holds the high-water mark: the last backup_change.seq already exported. The
+tables have no updated_at columns, so this change log stands in for
+per-table id/timestamp marks and also catches edits and deletions.
+
+A diff contains the current version of every row changed since the mark and
+a deleted_row entry for every row gone from the profile, then moves the mark
+and drops the exported changes. Backup files carry a backup_info table
+(kind, chain_id, gestiune_id, from_seq, to_seq), so apply_diff() only
+accepts the diff that continues a base and rebuild_profile() turns a base
+plus its chain of diffs back into a full profile file for the normal import.
+"""
+import os
+import shutil
+import sqlite3
+import uuid
+from datetime import datetime
+
+from archive import ARCHIVE_SETTING_KEYS
+from profile_export import EXPORT_SCHEMA, copy_profile, create_export_file, drop_mappings
+
+# Profile tables followed by the change log, parents first
+TRACKED_TABLES = ('vehicle_category', 'company', 'vehicle', 'stock_operation', 'transaction', 'app_settings')
+
+# Columns of each table in backup files (as written by profile_export.copy_profile)
+_COLUMNS = {
+    'gestiune': 'id, name, site_code, default_fuel_type, logo_path, created_at',
+    'vehicle_category': 'id, name, description, icon, gestiune_id',
+    'company': 'id, name, cui, address, product_code, gestiune_id',
+    'vehicle': 'id, plate_number, company_id, category_id, gestiune_id',
+    'stock_operation': 'id, operation_type, quantity_cl, date, description, company_id, gestiune_id',
+    'transaction': 'id, date, vehicle_id, company_id, quantity_cl, gestiune_id',
+    'app_settings': 'id, key, value, gestiune_id',
+}
+
+BACKUP_SCHEMA = EXPORT_SCHEMA + '''
+    CREATE TABLE IF NOT EXISTS backup_info (
+        key VARCHAR(50) PRIMARY KEY,
+        value VARCHAR(200)
+    );
+    CREATE TABLE IF NOT EXISTS deleted_row (
+        table_name VARCHAR(50) NOT NULL,
+        row_id INTEGER NOT NULL,
+        PRIMARY KEY (table_name, row_id)
+    );
+'''
+
+
+def _change_triggers():
+    """
+    Log writes to the profile tables of gestiuni with a backup chain; an
+    update moving a row between gestiuni is logged for both.
+    """
+    statements = []
+    for table in TRACKED_TABLES:
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            gestiuni = "OLD.gestiune_id, NEW.gestiune_id" if event == 'UPDATE' else f"{row}.gestiune_id"
+            statements.append(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_backup_{event.lower()} AFTER {event} ON [{table}] BEGIN
+                    INSERT INTO backup_change (gestiune_id, table_name, row_id)
+                    SELECT gestiune_id, '{table}', {row}.id FROM backup_mark WHERE gestiune_id IN ({gestiuni});
+                END""")
+    return statements
+
+
+# Created by migration v8 and, for databases already at the current schema
+# version that create_all rebuilds (e.g. tests), by models.py
+CHANGE_TRIGGERS = _change_triggers()
+
+
+def read_backup_info(path):
+    """backup_info of a backup file as a dict (ints for ids/seqs); None for plain exports"""
+    conn = sqlite3.connect(path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='backup_info'").fetchone() is None:
+            return None
+        info = dict(conn.execute("SELECT key, value FROM backup_info").fetchall())
+    finally:
+        conn.close()
+    for key in ('gestiune_id', 'from_seq', 'to_seq'):
+        info[key] = int(info[key])
+    return info
+
+
+def _write_info(conn, schema, info):
+    conn.executemany(f"INSERT OR REPLACE INTO {schema}.backup_info (key, value) VALUES (?, ?)",
+                     [(key, str(value)) for key, value in info.items()])
+
+
+def _last_seq(conn):
+    """Highest backup_change.seq ever written (kept by AUTOINCREMENT across pruning)"""
+    row = conn.execute("SELECT seq FROM main.sqlite_sequence WHERE name = 'backup_change'").fetchone()
+    return row[0] if row else 0
+
+
+def _export(db_path, export_path, write):
+    """Run write(conn) in one write transaction with the new backup file ATTACHed as `export`"""
+    create_export_file(export_path, BACKUP_SCHEMA)
+    # Manual transaction control: ATTACH is not allowed inside a transaction
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS export", (export_path,))
+        # IMMEDIATE: no write may slip in between the copied rows and the new mark
+        conn.execute("BEGIN IMMEDIATE")
+        result = write(conn)
+        conn.execute("COMMIT")
+        return result
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if os.path.exists(export_path):
+            os.remove(export_path)
+        raise
+    finally:
+        drop_mappings(conn)
+        try: conn.execute("DROP TABLE IF EXISTS temp.changed")
+        except sqlite3.Error: pass
+        try: conn.execute("DETACH DATABASE export")
+        except sqlite3.Error: pass
+        conn.close()
+
+
+def export_base(db_path, gestiune_id, export_path):
+    """
+    Write a full backup of `gestiune_id` (ids kept) to `export_path` and start
+    a new chain from it. Returns the row counts per table plus the backup info.
+    """
+    def write(conn):
+        counts = copy_profile(conn, gestiune_id, keep_ids=True)
+        seq = _last_seq(conn)
+        info = {'kind': 'base', 'chain_id': uuid.uuid4().hex, 'gestiune_id': gestiune_id,
+                'from_seq': seq, 'to_seq': seq, 'created_at': datetime.now()}
+        conn.execute("INSERT OR REPLACE INTO main.backup_mark (gestiune_id, chain_id, seq, exported_at) VALUES (?, ?, ?, ?)",
+                     (gestiune_id, info['chain_id'], info['to_seq'], datetime.now()))
+        conn.execute("DELETE FROM main.backup_change WHERE gestiune_id = ?", (gestiune_id,))
+        _write_info(conn, 'export', info)
+        counts['info'] = info
+        return counts
+
+    return _export(db_path, export_path, write)
+
+
+def export_diff(db_path, gestiune_id, export_path):
+    """
+    Write the rows of `gestiune_id` inserted, updated or deleted since the last
+    backup of its chain to `export_path` and move the mark. Returns the row
+    counts per table, 'deleted' and the backup info. Raises ValueError when
+    the gestiune has no base backup yet.
+    """
+    def write(conn):
+        mark = conn.execute("SELECT chain_id, seq FROM main.backup_mark WHERE gestiune_id = ?", (gestiune_id,)).fetchone()
+        if mark is None:
+            raise ValueError("Profilul nu are un backup complet de bază. Descărcați mai întâi un backup de bază.")
+        chain_id, from_seq = mark
+        to_seq = _last_seq(conn)
+
+        conn.execute("DROP TABLE IF EXISTS temp.changed")
+        conn.execute("CREATE TEMP TABLE changed (table_name TEXT NOT NULL, row_id INTEGER NOT NULL, PRIMARY KEY (table_name, row_id))")
+        conn.execute("""
+            INSERT OR IGNORE INTO temp.changed (table_name, row_id)
+            SELECT table_name, row_id FROM main.backup_change WHERE gestiune_id = ? AND seq > ? AND seq <= ?
+        """, (gestiune_id, from_seq, to_seq))
+
+        conn.execute(f"INSERT INTO export.gestiune ({_COLUMNS['gestiune']}) SELECT {_COLUMNS['gestiune']} FROM main.gestiune WHERE id = ?",
+                     (gestiune_id,))
+        counts = {'deleted': 0}
+        for table in TRACKED_TABLES:
+            columns = _COLUMNS[table]
+            # Changed rows still in the profile are written as they are now
+            # (except the archive settings, left out of every backup like the archived rows)...
+            skipped = ARCHIVE_SETTING_KEYS if table == 'app_settings' else ()
+            skip_sql = f" AND key NOT IN ({', '.join('?' for _ in skipped)})" if skipped else ""
+            counts[table] = conn.execute(f"""
+                INSERT INTO export.[{table}] ({columns})
+                SELECT {columns} FROM main.[{table}]
+                WHERE gestiune_id = ? AND id IN (SELECT row_id FROM temp.changed WHERE table_name = ?){skip_sql}
+            """, (gestiune_id, table) + skipped).rowcount
+            # ...the others were deleted (or moved to another gestiune)
+            counts['deleted'] += conn.execute(f"""
+                INSERT INTO export.deleted_row (table_name, row_id)
+                SELECT c.table_name, c.row_id FROM temp.changed c
+                WHERE c.table_name = ? AND NOT EXISTS (
+                    SELECT 1 FROM main.[{table}] r WHERE r.id = c.row_id AND r.gestiune_id = ?)
+            """, (table, gestiune_id)).rowcount
+
+        info = {'kind': 'diff', 'chain_id': chain_id, 'gestiune_id': gestiune_id,
+                'from_seq': from_seq, 'to_seq': to_seq, 'created_at': datetime.now()}
+        conn.execute("UPDATE main.backup_mark SET seq = ?, exported_at = ? WHERE gestiune_id = ?",
+                     (to_seq, datetime.now(), gestiune_id))
+        conn.execute("DELETE FROM main.backup_change WHERE gestiune_id = ? AND seq <= ?", (gestiune_id, to_seq))
+        _write_info(conn, 'export', info)
+        counts['info'] = info
+        return counts
+
+    return _export(db_path, export_path, write)
+
+
+def apply_diff(base_path, diff_path):
+    """
+    Apply the diff at `diff_path` to the base backup at `base_path` (in place).
+    The diff must continue the base: same chain, starting at the base's mark.
+    """
+    base, diff = read_backup_info(base_path), read_backup_info(diff_path)
+    if base is None or base['kind'] != 'base':
+        raise ValueError(f"{os.path.basename(base_path)} nu este un backup de bază.")
+    if diff is None or diff['kind'] != 'diff':
+        raise ValueError(f"{os.path.basename(diff_path)} nu este un backup incremental.")
+    if diff['chain_id'] != base['chain_id']:
+        raise ValueError(f"{os.path.basename(diff_path)} aparține altui backup de bază.")
+    if diff['from_seq'] != base['to_seq']:
+        raise ValueError(f"{os.path.basename(diff_path)} nu continuă backup-ul (lipsește un backup incremental anterior).")
+
+    conn = sqlite3.connect(base_path, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS diff", (diff_path,))
+        conn.execute("BEGIN")
+        conn.execute(f"INSERT OR REPLACE INTO main.gestiune ({_COLUMNS['gestiune']}) SELECT {_COLUMNS['gestiune']} FROM diff.gestiune")
+        for table in TRACKED_TABLES:
+            columns = _COLUMNS[table]
+            conn.execute(f"DELETE FROM main.[{table}] WHERE id IN (SELECT row_id FROM diff.deleted_row WHERE table_name = ?)",
+                         (table,))
+            conn.execute(f"INSERT OR REPLACE INTO main.[{table}] ({columns}) SELECT {columns} FROM diff.[{table}]")
+        _write_info(conn, 'main', {'to_seq': diff['to_seq']})
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        try: conn.execute("DETACH DATABASE diff")
+        except sqlite3.Error: pass
+        conn.close()
+
+
+def rebuild_profile(paths, output_path):
+    """
+    Rebuild a full profile file at `output_path` from backup files: one base
+    plus its diffs, in any order. Returns the number of diffs applied.
+    """
+    base_path, diffs = None, []
+    for path in paths:
+        info = read_backup_info(path)
+        if info is None:
+            raise ValueError(f"{os.path.basename(path)} nu face parte dintr-un backup incremental.")
+        if info['kind'] == 'base':
+            if base_path is not None:
+                raise ValueError("Selectați un singur backup de bază.")
+            base_path = path
+        else:
+            diffs.append((info['from_seq'], path))
+    if base_path is None:
+        raise ValueError("Lipsește backup-ul de bază al backup-urilor incrementale.")
+
+    shutil.copyfile(base_path, output_path)
+    for _, diff_path in sorted(diffs):
+        apply_diff(output_path, diff_path)
+    return len(diffs)
+
+
+def backup_status(gestiune_id):
+    """{'exported_at', 'pending'} of the chain of a gestiune (pending: row changes not yet backed up), or None"""
+    from models import db, BackupMark, BackupChange
+    from sqlalchemy import func
+
+    mark = db.session.get(BackupMark, gestiune_id)
+    if mark is None:
+        return None
+    pending = db.session.query(func.count(BackupChange.seq))\
+        .filter(BackupChange.gestiune_id == gestiune_id, BackupChange.seq > mark.seq).scalar()
+    return {'exported_at': mark.exported_at, 'pending': pending}
@@ -0,0 +1,207 @@
+"""
+Export of one profile (gestiune) into a standalone SQLite file.
+
+The export file is ATTACHed to a connection on the main database and filled
+with set-based INSERT ... SELECT statements, so rows never pass through
+Python. Categories, companies and vehicles get new ids (1..n in the order of
+their old ids, as in an empty database); the old -> new pairs are kept in
+TEMP mapping tables and foreign keys are remapped by joining them. Orphaned
+transactions (vehicle missing from the profile) are left out, as before.
+Rows already moved to archive files (archive.py) are not exported.
+"""
+import os
+import sqlite3
+
+from archive import ARCHIVE_SETTING_KEYS
+
+# Schema of the export file, mirroring the tables a profile import reads
+EXPORT_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS gestiune (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR(100) NOT NULL,
+        site_code VARCHAR(20),
+        default_fuel_type VARCHAR(20) DEFAULT 'Motorină',
+        logo_path VARCHAR(200),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS vehicle_category (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR(50) NOT NULL,
+        description VARCHAR(200),
+        icon VARCHAR(50) DEFAULT 'bi-tag-fill',
+        gestiune_id INTEGER REFERENCES gestiune(id)
+    );
+    CREATE TABLE IF NOT EXISTS company (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR(100) NOT NULL,
+        cui VARCHAR(20),
+        address VARCHAR(200),
+        product_code VARCHAR(50),
+        gestiune_id INTEGER REFERENCES gestiune(id),
+        last_report_start TIMESTAMP,
+        last_report_end TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS vehicle (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        plate_number VARCHAR(50) NOT NULL,
+        company_id INTEGER,
+        category_id INTEGER,
+        gestiune_id INTEGER REFERENCES gestiune(id)
+    );
+    CREATE TABLE IF NOT EXISTS stock_operation (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        operation_type VARCHAR(20),
+        quantity_cl INTEGER NOT NULL,
+        date DATETIME,
+        description VARCHAR(200),
+        company_id INTEGER,
+        gestiune_id INTEGER REFERENCES gestiune(id)
+    );
+    CREATE TABLE IF NOT EXISTS [transaction] (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date DATETIME NOT NULL,
+        vehicle_id INTEGER,
+        company_id INTEGER,
+        quantity_cl INTEGER NOT NULL,
+        gestiune_id INTEGER REFERENCES gestiune(id)
+    );
+    CREATE TABLE IF NOT EXISTS app_settings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key VARCHAR(50) NOT NULL,
+        value VARCHAR(200),
+        gestiune_id INTEGER REFERENCES gestiune(id)
+    );
+'''
+
+# table -> TEMP mapping table of its remapped ids
+_MAPPED = {'vehicle_category': 'map_category', 'company': 'map_company', 'vehicle': 'map_vehicle'}
+
+
+def _map_ids(conn, table, gestiune_id, keep_ids=False):
+    """
+    Fill TEMP map_<table> (new_id 1..n in old id order, as AUTOINCREMENT would,
+    or new_id = old_id with `keep_ids`) and return n
+    """
+    mapping = _MAPPED[table]
+    conn.execute(f"DROP TABLE IF EXISTS temp.{mapping}")
+    conn.execute(f"CREATE TEMP TABLE {mapping} (new_id INTEGER PRIMARY KEY, old_id INTEGER NOT NULL UNIQUE)")
+    columns, values = ("new_id, old_id", "id, id") if keep_ids else ("old_id", "id")
+    return conn.execute(f"INSERT INTO temp.{mapping} ({columns}) SELECT {values} FROM main.[{table}] WHERE gestiune_id = ? ORDER BY id",
+                        (gestiune_id,)).rowcount
+
+
+def create_export_file(export_path, schema=EXPORT_SCHEMA):
+    """Create a new, empty export file (replacing any existing one)"""
+    if os.path.exists(export_path):
+        os.remove(export_path)
+    dst_conn = sqlite3.connect(export_path)
+    try:
+        dst_conn.executescript(schema)
+    finally:
+        dst_conn.close()
+
+
+def copy_profile(conn, gestiune_id, keep_ids=False):
+    """
+    Copy gestiune `gestiune_id` of `main` into the ATTACHed `export` schema,
+    inside the caller's transaction. With `keep_ids` every row keeps its id
+    (incremental backups, see profile_diff.py). Returns the row counts per table.
+    """
+    counts = {}
+    # Stock operations and transactions are renumbered by AUTOINCREMENT unless ids are kept
+    row_id = "id, " if keep_ids else ""
+
+    # 0. The profile itself keeps its id
+    conn.execute("""
+        INSERT INTO export.gestiune (id, name, site_code, default_fuel_type, logo_path, created_at)
+        SELECT id, name, site_code, default_fuel_type, logo_path, created_at FROM main.gestiune WHERE id = ?
+    """, (gestiune_id,))
+
+    # 1. Categories, 2. Companies
+    counts['vehicle_category'] = _map_ids(conn, 'vehicle_category', gestiune_id, keep_ids)
+    conn.execute("""
+        INSERT INTO export.vehicle_category (id, name, description, icon, gestiune_id)
+        SELECT m.new_id, c.name, c.description, c.icon, c.gestiune_id
+        FROM main.vehicle_category c JOIN temp.map_category m ON m.old_id = c.id
+        ORDER BY m.new_id
+    """)
+    counts['company'] = _map_ids(conn, 'company', gestiune_id, keep_ids)
+    conn.execute("""
+        INSERT INTO export.company (id, name, cui, address, product_code, gestiune_id)
+        SELECT m.new_id, c.name, c.cui, c.address, c.product_code, c.gestiune_id
+        FROM main.company c JOIN temp.map_company m ON m.old_id = c.id
+        ORDER BY m.new_id
+    """)
+
+    # 3. Vehicles (remap company_id and category_id)
+    counts['vehicle'] = _map_ids(conn, 'vehicle', gestiune_id, keep_ids)
+    conn.execute("""
+        INSERT INTO export.vehicle (id, plate_number, company_id, category_id, gestiune_id)
+        SELECT m.new_id, v.plate_number, mc.new_id, mk.new_id, v.gestiune_id
+        FROM main.vehicle v JOIN temp.map_vehicle m ON m.old_id = v.id
+        LEFT JOIN temp.map_company mc ON mc.old_id = v.company_id
+        LEFT JOIN temp.map_category mk ON mk.old_id = v.category_id
+        ORDER BY m.new_id
+    """)
+
+    # 4. Stock Operations (remap company_id)
+    counts['stock_operation'] = conn.execute(f"""
+        INSERT INTO export.stock_operation ({row_id}operation_type, quantity_cl, date, description, company_id, gestiune_id)
+        SELECT {'o.id, ' if keep_ids else ''}o.operation_type, o.quantity_cl, o.date, o.description, mc.new_id, o.gestiune_id
+        FROM main.stock_operation o LEFT JOIN temp.map_company mc ON mc.old_id = o.company_id
+        WHERE o.gestiune_id = ?
+        ORDER BY o.date, o.id
+    """, (gestiune_id,)).rowcount
+
+    # 5. Transactions (remap vehicle_id and company_id; orphaned transactions are skipped)
+    counts['transaction'] = conn.execute(f"""
+        INSERT INTO export.[transaction] ({row_id}date, vehicle_id, company_id, quantity_cl, gestiune_id)
+        SELECT {'t.id, ' if keep_ids else ''}t.date, mv.new_id, mc.new_id, t.quantity_cl, t.gestiune_id
+        FROM main.[transaction] t JOIN temp.map_vehicle mv ON mv.old_id = t.vehicle_id
+        LEFT JOIN temp.map_company mc ON mc.old_id = t.company_id
+        WHERE t.gestiune_id = ?
+        ORDER BY t.date, t.id
+    """, (gestiune_id,)).rowcount
+
+    # 6. App Settings (tank capacity, etc.); archived years are not exported, so neither is the archive cutoff
+    try:
+        counts['app_settings'] = conn.execute(f"""
+            INSERT INTO export.app_settings ({row_id}key, value, gestiune_id)
+            SELECT {row_id}key, value, gestiune_id FROM main.app_settings
+            WHERE gestiune_id = ? AND key NOT IN ({', '.join('?' for _ in ARCHIVE_SETTING_KEYS)})
+        """, (gestiune_id,) + ARCHIVE_SETTING_KEYS).rowcount
+    except sqlite3.OperationalError:
+        counts['app_settings'] = 0  # Table might not exist in older DBs
+    return counts
+
+
+def drop_mappings(conn):
+    for mapping in _MAPPED.values():
+        try: conn.execute(f"DROP TABLE IF EXISTS temp.{mapping}")
+        except sqlite3.Error: pass
+
+
+def export_profile(db_path, gestiune_id, export_path):
+    """
+    Write gestiune `gestiune_id` of the database at `db_path` into a new
+    SQLite file at `export_path`. Returns the row counts per table.
+    """
+    create_export_file(export_path)
+
+    # Manual transaction control: ATTACH is not allowed inside a transaction
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS export", (export_path,))
+        conn.execute("BEGIN")
+        counts = copy_profile(conn, gestiune_id)
+        conn.execute("COMMIT")
+        return counts
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        drop_mappings(conn)
+        try: conn.execute("DETACH DATABASE export")
+        except sqlite3.Error: pass
+        conn.close()
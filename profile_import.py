@@ -0,0 +1,190 @@
+"""
+Import of a profile backup (an export file, or an older single-profile
+database) into the active gestiune.
+
+Source rows are read with fetchmany() in batches of IMPORT_BATCH and written
+with one executemany INSERT per batch, so memory stays bounded and no row
+goes through the ORM unit of work. Categories, companies and vehicles get
+explicit new ids (following the current MAX(id) of their table, in source
+order), so the old -> new maps are built in memory without a flush per row;
+vehicles, stock operations and transactions are remapped through them.
+Orphaned transactions (vehicle missing from the backup) are skipped.
+
+The caller deletes the previous data of the gestiune and commits: everything
+runs in the current db.session transaction.
+"""
+from datetime import datetime
+
+from archive import ARCHIVE_SETTING_KEYS
+
+IMPORT_BATCH = 5000
+
+
+def parse_sqlite_date(d_str):
+    if not d_str: return datetime.utcnow()
+    try: return datetime.strptime(d_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
+    except Exception:
+        try: return datetime.strptime(d_str, '%Y-%m-%d')
+        except Exception: return datetime.utcnow()
+
+
+class _Source:
+    """Schema probing of the uploaded database"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._gestiune_id = self._detect_gestiune_id()
+
+    def table_exists(self, table_name):
+        return self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                 (table_name,)).fetchone() is not None
+
+    def get_columns(self, table_name):
+        try:
+            return [info[1] for info in self.conn.execute(f"PRAGMA table_info([{table_name}])").fetchall()]
+        except Exception:
+            return []
+
+    def _detect_gestiune_id(self):
+        """gestiune_id of the backup; None for old single-profile databases (no gestiune table)"""
+        try:
+            if self.table_exists('gestiune'):
+                row = self.conn.execute("SELECT id FROM gestiune LIMIT 1").fetchone()
+                if row:
+                    return row[0]
+        except Exception:
+            pass
+        return None
+
+    def rows(self, table_name, select_cols, batch_size=IMPORT_BATCH):
+        """Yield lists of {column: value} dicts of the backup's profile, `batch_size` at a time"""
+        where, params = "", ()
+        if self._gestiune_id is not None and 'gestiune_id' in self.get_columns(table_name):
+            where, params = " WHERE gestiune_id = ?", (self._gestiune_id,)
+        cursor = self.conn.execute(f"SELECT {', '.join(select_cols)} FROM [{table_name}]{where} ORDER BY rowid", params)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return
+            yield [dict(zip(select_cols, row)) for row in batch]
+
+
+def _next_id(model):
+    from models import db
+    from sqlalchemy import func
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _insert(model, rows):
+    from models import db
+    from sqlalchemy import insert
+    if rows:
+        db.session.execute(insert(model), rows)
+
+
+def import_profile(src_conn, gestiune_id, batch_size=IMPORT_BATCH):
+    """
+    Insert the profile stored in the sqlite3 connection `src_conn` into
+    `gestiune_id`. Returns the counts of imported rows (categories, companies,
+    vehicles, stock, trans, settings).
+    """
+    from models import db, Company, Vehicle, Transaction, StockOperation, VehicleCategory, AppSettings, to_centiliters
+    from series_codes import pick_series_code
+
+    src = _Source(src_conn)
+    company_map = {}   # src_id -> new_id
+    category_map = {}  # src_id -> new_id
+    vehicle_map = {}   # src_id -> new_id
+    counts = {"categories": 0, "companies": 0, "vehicles": 0, "stock": 0, "trans": 0, "settings": 0}
+
+    # 1. Categories
+    if src.table_exists("vehicle_category"):
+        cols = src.get_columns("vehicle_category")
+        select_cols = ["id", "name"] + [c for c in ("description", "icon") if c in cols]
+        next_id = _next_id(VehicleCategory)
+        for batch in src.rows("vehicle_category", select_cols, batch_size):
+            rows = []
+            for r in batch:
+                category_map[r['id']] = next_id
+                rows.append({'id': next_id, 'name': r['name'], 'description': r.get('description'),
+                             'icon': r.get('icon', 'bi-tag-fill'), 'gestiune_id': gestiune_id})
+                next_id += 1
+            _insert(VehicleCategory, rows)
+            counts["categories"] += len(rows)
+
+    # 2. Companies (series codes against every other company, as assign_series_code)
+    if src.table_exists("company"):
+        cols = src.get_columns("company")
+        select_cols = ["id", "name"] + [c for c in ("cui", "address", "product_code") if c in cols]
+        taken = {code for (code,) in db.session.query(Company.series_code).filter(Company.series_code.isnot(None))}
+        next_id = _next_id(Company)
+        for batch in src.rows("company", select_cols, batch_size):
+            rows = []
+            for r in batch:
+                code = pick_series_code(r['name'], taken)
+                if code:
+                    taken.add(code)
+                company_map[r['id']] = next_id
+                rows.append({'id': next_id, 'name': r['name'], 'cui': r.get('cui'), 'address': r.get('address'),
+                             'product_code': r.get('product_code'), 'series_code': code, 'gestiune_id': gestiune_id})
+                next_id += 1
+            _insert(Company, rows)
+            counts["companies"] += len(rows)
+
+    # 3. Vehicles
+    if src.table_exists("vehicle"):
+        cols = src.get_columns("vehicle")
+        select_cols = ["id", "plate_number"] + [c for c in ("company_id", "category_id") if c in cols]
+        next_id = _next_id(Vehicle)
+        for batch in src.rows("vehicle", select_cols, batch_size):
+            rows = []
+            for r in batch:
+                vehicle_map[r['id']] = next_id
+                rows.append({'id': next_id, 'plate_number': r['plate_number'],
+                             'company_id': company_map.get(r.get('company_id')),
+                             'category_id': category_map.get(r.get('category_id')),
+                             'gestiune_id': gestiune_id})
+                next_id += 1
+            _insert(Vehicle, rows)
+            counts["vehicles"] += len(rows)
+
+    # 4. Stock Operations (backups from before the centiliter migration store liters in 'quantity')
+    if src.table_exists("stock_operation"):
+        cols = src.get_columns("stock_operation")
+        qty_col = "quantity_cl" if "quantity_cl" in cols else "quantity"
+        select_cols = ["operation_type", qty_col, "date"] + [c for c in ("description", "company_id") if c in cols]
+        for batch in src.rows("stock_operation", select_cols, batch_size):
+            rows = [{'operation_type': r['operation_type'],
+                     'quantity_cl': r['quantity_cl'] if qty_col == "quantity_cl" else to_centiliters(r['quantity']),
+                     'date': parse_sqlite_date(r['date']),
+                     'description': r.get('description'),
+                     'company_id': company_map.get(r.get('company_id')),
+                     'gestiune_id': gestiune_id} for r in batch]
+            _insert(StockOperation, rows)
+            counts["stock"] += len(rows)
+
+    # 5. Transactions
+    if src.table_exists("transaction"):
+        cols = src.get_columns("transaction")
+        qty_col = "quantity_cl" if "quantity_cl" in cols else "quantity"
+        select_cols = ["date", "vehicle_id", "company_id", qty_col]
+        for batch in src.rows("transaction", select_cols, batch_size):
+            rows = [{'date': parse_sqlite_date(r['date']),
+                     'vehicle_id': vehicle_map[r['vehicle_id']],
+                     'company_id': company_map.get(r['company_id']),
+                     'quantity_cl': r['quantity_cl'] if qty_col == "quantity_cl" else to_centiliters(r['quantity']),
+                     'gestiune_id': gestiune_id}
+                    for r in batch if vehicle_map.get(r['vehicle_id'])]  # Skip orphaned transactions
+            _insert(Transaction, rows)
+            counts["trans"] += len(rows)
+
+    # 6. App Settings
+    if src.table_exists("app_settings"):
+        for batch in src.rows("app_settings", ["key", "value"], batch_size):
+            # Backups made before exports dropped them: no archive files come with the backup
+            rows = [{'key': r['key'], 'value': r['value'], 'gestiune_id': gestiune_id}
+                    for r in batch if r['key'] not in ARCHIVE_SETTING_KEYS]
+            _insert(AppSettings, rows)
+            counts["settings"] += len(rows)
+
+    return counts
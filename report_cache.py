@@ -0,0 +1,181 @@
+"""
+Content-addressed cache of generated report PDFs.
+
+A report is identified by a key hashed from its inputs: report type, gestiune,
+date range, filters (company, bon number, pump series) and a data version of
+the rows it reads. For the transactions / stock operations of the range the
+data version is a set of SQL aggregates computed by SQLite (count, MAX/SUM of
+id, SUM of quantity_cl, id-weighted sums of every printed column), so no row
+of the range is fetched into Python. The weighted sums tie each value to its
+row, so edits that keep plain sums equal (two quantities swapped) still move
+the key. Company and vehicle rows carry the printed names; these small master
+tables are hashed row by row. Any insert, edit, delete or undo in the range
+yields a new key while a closed month keeps its key.
+
+Cached files live in cache/reports next to the database (DATA_DIR) as
+<key>.pdf with a <key>.json sidecar (message); a hit is copied to the requested
+path. The least recently used entries are evicted once the folder exceeds
+MAX_CACHE_BYTES (env FUEL_PDF_CACHE_MB, default 200 MB).
+"""
+import hashlib
+import json
+import os
+import shutil
+
+from sqlalchemy import or_
+
+from metrics import inc, note_pdf_cache_hit
+
+CACHE_DIRNAME = os.path.join('cache', 'reports')
+MAX_CACHE_BYTES = int(os.environ.get('FUEL_PDF_CACHE_MB', 200)) * 1024 * 1024
+# Bump when the layout of a cached report changes, so older files are not served
+CACHE_FORMAT = 2
+
+def get_cache_dir():
+    """cache/reports next to the database file; None for in-memory databases"""
+    from models import db
+    db_path = db.engine.url.database
+    if not db_path or db_path == ':memory:':
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), CACHE_DIRNAME)
+
+
+def make_key(report, gestiune_id, **inputs):
+    payload = json.dumps([CACHE_FORMAT, report, gestiune_id, inputs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _rows_hash(query):
+    digest = hashlib.sha256()
+    for row in query:
+        digest.update(repr(tuple(row)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _aggregates(src, group_col, *columns):
+    """
+    Per `group_col` value: COUNT(*), MAX(id), SUM(id), then for each of
+    `columns` its sum and its id-weighted sum. TOTAL (a float) cannot
+    overflow on large tables the way an integer SUM would.
+    """
+    from sqlalchemy import func
+    fields = [group_col, func.count(), func.max(src.c.id), func.sum(src.c.id)]
+    for col in columns:
+        fields += [func.total(col), func.total(src.c.id * col)]
+    return fields
+
+
+def data_version(gestiune_id, start_date, end_date, company_id=None, stock=False):
+    """
+    Version of the rows a report over [start_date, end_date] reads:
+    aggregates of the transactions of the range (optionally one company), with
+    `stock` of the stock operations of the range plus every INITIAL one, and
+    digests of the company/vehicle rows whose names, CUI, address, series codes
+    and plates are printed.
+    """
+    from models import db, Company, Vehicle
+    from archive import transaction_source, stock_operation_source
+    from sqlalchemy import func
+
+    trans_src = transaction_source(gestiune_id, start_date, end_date)
+    criteria = [trans_src.c.gestiune_id == gestiune_id,
+                trans_src.c.date >= start_date, trans_src.c.date <= end_date]
+    if company_id:
+        criteria.append(trans_src.c.company_id == company_id)
+    version = {'transactions': [list(row) for row in db.session.query(
+        *_aggregates(trans_src, trans_src.c.company_id, trans_src.c.quantity_cl,
+                     trans_src.c.vehicle_id, func.julianday(trans_src.c.date)))
+        .filter(*criteria).group_by(trans_src.c.company_id).order_by(trans_src.c.company_id)]}
+
+    if stock:
+        ops_src = stock_operation_source(gestiune_id, start_date, end_date)
+        version['stock'] = [list(row) for row in db.session.query(
+            *_aggregates(ops_src, ops_src.c.operation_type, ops_src.c.quantity_cl,
+                         ops_src.c.company_id, func.julianday(ops_src.c.date)))
+            .filter(ops_src.c.gestiune_id == gestiune_id,
+                    or_(ops_src.c.operation_type == 'INITIAL',
+                        ops_src.c.date.between(start_date, end_date)))
+            .group_by(ops_src.c.operation_type).order_by(ops_src.c.operation_type)]
+
+    version['companies'] = _rows_hash(
+        db.session.query(Company.id, Company.name, Company.cui, Company.address, Company.series_code)
+        .filter(Company.gestiune_id == gestiune_id).order_by(Company.id))
+    version['vehicles'] = _rows_hash(db.session.query(Vehicle.id, Vehicle.plate_number)
+                                     .filter(Vehicle.gestiune_id == gestiune_id).order_by(Vehicle.id))
+    return version
+
+
+def _paths(key):
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None, None
+    return os.path.join(cache_dir, key + '.pdf'), os.path.join(cache_dir, key + '.json')
+
+
+def fetch(report, key, filepath):
+    """Cached (filepath, message) for `key`, or None. The cached file is copied to `filepath`."""
+    pdf_path, meta_path = _paths(key)
+    if pdf_path is None or not os.path.exists(pdf_path):
+        inc('fuel_pdf_cache_requests_total', 'PDF cache lookups', report=report, result='miss')
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        os.utime(pdf_path)  # LRU order for eviction
+        shutil.copyfile(pdf_path, filepath)
+    except (OSError, ValueError) as e:
+        print(f"[PDF] Cache entry {key[:12]} unusable, regenerating: {e}")
+        inc('fuel_pdf_cache_requests_total', 'PDF cache lookups', report=report, result='miss')
+        return None
+
+    inc('fuel_pdf_cache_requests_total', 'PDF cache lookups', report=report, result='hit')
+    note_pdf_cache_hit()
+    print(f"[PDF] Cache hit {report} {key[:12]} -> {filepath}")
+    return filepath, meta.get('message', '')
+
+
+def store(key, filepath, message):
+    """Copy a freshly generated PDF into the cache, then evict down to MAX_CACHE_BYTES"""
+    pdf_path, meta_path = _paths(key)
+    if pdf_path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        tmp_path = pdf_path + '.tmp'
+        shutil.copyfile(filepath, tmp_path)
+        os.replace(tmp_path, pdf_path)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'message': message}, f)
+        evict()
+    except OSError as e:
+        print(f"[PDF] Could not cache {filepath}: {e}")
+
+
+def evict(max_bytes=None):
+    """Remove least recently used entries until the cache fits in `max_bytes`"""
+    cache_dir = get_cache_dir()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return 0
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.pdf'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for p in (path, path[:-4] + '.json'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        total -= size
+        removed += 1
+    if removed:
+        print(f"[PDF] Cache eviction: removed {removed} file(s), {total} bytes kept")
+    return removed
@@ -0,0 +1,119 @@
+"""
+Background queue for report PDFs.
+
+The report routes submit the generator to a small thread pool and return a job
+id at once; the page polls /admin/report_jobs/<id> for the state, the pages
+written so far and, when done, the file path. Several reports can run side by
+side without holding a request (or the UI) open.
+
+Each job runs inside its own application context with its own database
+session. Generators report progress through set_progress(), which is a no-op
+outside a job (direct calls, process-pool workers).
+"""
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 2
+# Finished jobs are kept this long for late status polls
+FINISHED_JOB_TTL = 3600
+
+_executor = None
+_jobs = {}
+_lock = threading.Lock()
+_current = threading.local()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='report-job')
+        return _executor
+
+
+def _prune(now):
+    stale = [job_id for job_id, job in _jobs.items()
+             if job['finished'] and now - job['finished'] > FINISHED_JOB_TTL]
+    for job_id in stale:
+        del _jobs[job_id]
+
+
+def submit(app, report, gestiune_id, func, *args, **kwargs):
+    """Queue `func(*args, **kwargs)` (returning (filepath, message)); returns the job id"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _lock:
+        _prune(now)
+        _jobs[job_id] = {
+            'id': job_id,
+            'report': report,
+            'gestiune_id': gestiune_id,
+            'status': 'queued',
+            'pages': 0,
+            'total_pages': None,
+            'filepath': None,
+            'filename': None,
+            'message': '',
+            'created': now,
+            'finished': None,
+        }
+    _get_executor().submit(_run, app, job_id, func, args, kwargs)
+    return job_id
+
+
+def _update(job_id, **fields):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+
+def _run(app, job_id, func, args, kwargs):
+    import os
+    from extensions import db
+
+    _current.job_id = job_id
+    _update(job_id, status='running')
+    filepath, message = None, ''
+    try:
+        with app.app_context():
+            try:
+                filepath, message = func(*args, **kwargs)
+            finally:
+                db.session.remove()
+    except Exception as e:
+        traceback.print_exc()
+        message = f"Eroare la generarea raportului: {e}"
+    finally:
+        _current.job_id = None
+
+    if filepath:
+        _update(job_id, status='success', filepath=filepath, filename=os.path.basename(filepath),
+                message=message, finished=time.time())
+    else:
+        _update(job_id, status='error', message=message or "A apărut o eroare la generarea PDF-ului.",
+                finished=time.time())
+    print(f"[JOBS] {job_id[:8]} finished: {message}")
+
+
+def set_progress(pages=None, total_pages=None):
+    """Record progress of the job running in this thread, if any"""
+    job_id = getattr(_current, 'job_id', None)
+    if job_id is None:
+        return
+    fields = {}
+    if pages is not None:
+        fields['pages'] = pages
+    if total_pages is not None:
+        fields['total_pages'] = total_pages
+    _update(job_id, **fields)
+
+
+def get(job_id):
+    """Snapshot of a job, or None when unknown/expired"""
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
@@ -0,0 +1,119 @@
+"""
+On-demand cProfile of single requests.
+
+Profiling is switched on for one request with the `_profile=1` query flag, or
+for every request during a time window (start_window / stop_window). The
+profile covers the whole request: before_request hooks, the view, template
+rendering and SQL. Each profiled request is saved under logs/profiles as
+  - <stamp>_<endpoint>.html  pstats tables (cumulative and own time) plus the
+                             SQL count/time headers, readable in any browser
+  - <stamp>_<endpoint>.prof  raw stats for snakeviz / pstats
+"""
+import cProfile
+import html
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import g, request
+
+PROFILE_FLAG = '_profile'
+TOP_FUNCTIONS = 60
+SKIPPED_ENDPOINTS = ('static', 'user_content', 'heartbeat')
+
+_window_until = 0.0
+_lock = threading.Lock()
+
+
+def start_window(minutes):
+    """Profile every request for the next `minutes`; returns the end timestamp"""
+    global _window_until
+    with _lock:
+        _window_until = time.time() + minutes * 60
+        return _window_until
+
+
+def stop_window():
+    global _window_until
+    with _lock:
+        _window_until = 0.0
+
+
+def window_active():
+    return time.time() < _window_until
+
+
+def _stats_text(profiler, sort_key):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats(sort_key).print_stats(TOP_FUNCTIONS)
+    return stream.getvalue()
+
+
+def _write_report(profiler, profile_dir, elapsed, response):
+    os.makedirs(profile_dir, exist_ok=True)
+    endpoint = re.sub(r'[^A-Za-z0-9_]+', '_', request.endpoint or 'unknown')
+    base = os.path.join(profile_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{endpoint}")
+    profiler.dump_stats(base + '.prof')
+
+    sql_queries = response.headers.get('X-SQL-Queries', '-')
+    sql_timing = response.headers.get('Server-Timing', '-')
+    with open(base + '.html', 'w', encoding='utf-8') as f:
+        f.write(f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Profil {html.escape(request.path)}</title>
+<style>body {{ font-family: sans-serif; margin: 20px; }} pre {{ background: #f6f8fa; padding: 10px; overflow-x: auto; font-size: 12px; }}</style>
+</head><body>
+<h2>{html.escape(request.method)} {html.escape(request.full_path)}</h2>
+<p>Endpoint: <b>{html.escape(request.endpoint or '-')}</b> &middot; Status: {response.status_code}
+ &middot; Durată totală: <b>{elapsed * 1000:.1f} ms</b> &middot; SQL: {html.escape(sql_queries)} interogări ({html.escape(sql_timing)})</p>
+<h3>Timp cumulat (top {TOP_FUNCTIONS})</h3>
+<pre>{html.escape(_stats_text(profiler, 'cumulative'))}</pre>
+<h3>Timp propriu (top {TOP_FUNCTIONS})</h3>
+<pre>{html.escape(_stats_text(profiler, 'tottime'))}</pre>
+</body></html>
+""")
+    return base + '.html'
+
+
+def init_request_profiler(app, log_dir):
+    """Register the profiling hooks; call before other before_request hooks so they are profiled too"""
+    profile_dir = os.path.join(log_dir, 'profiles')
+
+    @app.before_request
+    def start_request_profile():
+        if request.endpoint in SKIPPED_ENDPOINTS:
+            return
+        if request.args.get(PROFILE_FLAG) != '1' and not window_active():
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return  # Another request is already being profiled (single active profiler on Python 3.12+)
+        g._profiler = (profiler, time.perf_counter())
+
+    @app.after_request
+    def save_request_profile(response):
+        started = g.pop('_profiler', None)
+        if started is None:
+            return response
+        profiler, t0 = started
+        profiler.disable()
+        try:
+            report = _write_report(profiler, profile_dir, time.perf_counter() - t0, response)
+            response.headers['X-Profile-Report'] = os.path.basename(report)
+            print(f"[PROFILE] {request.path} -> {report}")
+        except Exception as e:
+            print(f"[PROFILE] Could not save profile for {request.path}: {e}")
+        return response
+
+    @app.teardown_request
+    def discard_request_profile(exc):
+        # Requests that failed before after_request still have to release the profiler
+        started = g.pop('_profiler', None)
+        if started is not None:
+            started[0].disable()
@@ -0,0 +1,60 @@
+"""
+Three-letter series codes printed on the fuel slips.
+
+A company's code is derived from its name (first letter, one more letter,
+last letter) and must not collide with the code of any other company, in any
+gestiune. Codes are stored on the company row (company.series_code) and are
+recomputed only when a company is added or renamed, so report generation just
+reads them. Plain functions without Flask, so the schema migration can
+backfill existing databases with the same rules.
+"""
+import re
+
+
+def series_candidates(name):
+    """Candidate codes for `name`, in order of preference"""
+    # Option A: Standard (1st + 2nd + Last)
+    candidates = [f"{name[0]}{name[1]}{name[-1]}".upper()]
+
+    # Option B: Word initials
+    words = re.split(r'[\s\-]+', name)
+    for w in words[1:]:
+        if w:
+            s_word = f"{name[0]}{w[0]}{name[-1]}".upper()
+            if s_word not in candidates:
+                candidates.append(s_word)
+
+    # Option C: Sequential scan
+    for i in range(2, len(name) - 1):
+        s_scan = f"{name[0]}{name[i]}{name[-1]}".upper()
+        if s_scan not in candidates:
+            candidates.append(s_scan)
+    return candidates
+
+
+def pick_series_code(name, taken):
+    """
+    First candidate of `name` not in `taken`, falling back to <first>X<last>.
+    Names shorter than 3 characters get no code (their slips print "---").
+    """
+    name = name or "UNKNOWN"
+    if len(name) < 3:
+        return None
+    for cand in series_candidates(name):
+        if cand not in taken:
+            return cand
+    return f"{name[0]}X{name[-1]}".upper()
+
+
+def assign_missing(rows, taken):
+    """
+    Codes for the (id, name) `rows` without one, in id order; `taken` holds
+    the codes already in use and is updated. Returns {id: code}.
+    """
+    assigned = {}
+    for company_id, name in sorted(rows, key=lambda r: r[0]):
+        code = pick_series_code(name, taken)
+        if code:
+            taken.add(code)
+        assigned[company_id] = code
+    return assigned
@@ -1,8 +1,15 @@
 import pandas as pd
-from models import db, Transaction, Company, Vehicle
+from models import db, Transaction, Company, Vehicle, to_centiliters, to_liters
 from datetime import datetime
 import os
+import time
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
 from pathlib import Path
+from metrics import track_pdf, record_csv_import
+import report_cache
+from report_jobs import set_progress
 
 
 # Hardcoded rules for company assignment
@@ -11,6 +18,7 @@ def get_company_for_plate(plate, gestiune_id):
     return None
 
 def process_csv_import(file_path, gestiune_id):
+    t0 = time.perf_counter()
     try:
         # The specific CSV format has no proper header and uses latin-1 encoding.
         # Try default separator (comma) first
@@ -73,7 +81,7 @@ def process_csv_import(file_path, gestiune_id):
                     # Determine Plate and Qty based on structure
                     plate = ""
                     qty_raw = ""
-                    qty = 0.0
+                    qty_cl = 0  # Quantity in integer centiliters
                     
                     # CASE 1: Standard (Plate in 15, Qty in 14) -> Used for most cars
                     # CASE 2: Shifted (Plate in 15, Qty in 16?? No, user said 26005 is quantity 260.05)
@@ -116,25 +124,25 @@ def process_csv_import(file_path, gestiune_id):
                         # Issue: If Col 14 is "0" (Odometer) and Col 16 is "26005" (Qty), we want Col 16.
                         # If Col 14 is "50.0" (Qty) and Col 16 is "1" (Something else?), we want Col 14.
                         
-                        qty = 0.0
+                        qty_cl = 0
                         
                         # CSV format: the last 2 digits are ALWAYS decimals.
                         # So 801 -> 8.01, 4003 -> 40.03, 15012 -> 150.12
-                        # ALL col_16 values must be divided by 100.
+                        # ALL col_16 values are already centiliters.
                         
                         if val_16 > 0:
-                             qty = val_16 / 100.0
-                             log_file.write(f"Row {index}: Selected Shifted Qty from Col 16 ({val_16} -> {qty})\n")
+                             qty_cl = int(round(val_16))
+                             log_file.write(f"Row {index}: Selected Shifted Qty from Col 16 ({val_16} -> {to_liters(qty_cl):.2f})\n")
                         elif val_14 > 0:
-                             qty = val_14
+                             qty_cl = to_centiliters(val_14)
                              # log_file.write(f"Row {index}: Selected Standard Qty from Col 14 ({qty})\n")
                         else:
                              # Try Col 13 as last resort
                              try:
                                 val_13 = float(str(row[13]).replace(',', '.'))
                                 if val_13 > 0:
-                                    qty = val_13
-                                    log_file.write(f"Row {index}: Selected Fallback Qty from Col 13 ({qty})\n")
+                                    qty_cl = to_centiliters(val_13)
+                                    log_file.write(f"Row {index}: Selected Fallback Qty from Col 13 ({to_liters(qty_cl):.2f})\n")
                              except:
                                  pass
                     
@@ -165,9 +173,10 @@ def process_csv_import(file_path, gestiune_id):
                              log_file.write(f"Row {index}: Skipped - Invalid Date '{date_str}'\n")
                              continue
                     
-                    if qty <= 0:
-                         log_file.write(f"Row {index}: Skipped - Qty invalid ({qty}). Raw14={row[14]}\n")
+                    if qty_cl <= 0:
+                         log_file.write(f"Row {index}: Skipped - Qty invalid ({qty_cl} cl). Raw14={row[14]}\n")
                          continue
+                    qty = to_liters(qty_cl)
 
 
                     # Find or Create Vehicle
@@ -195,11 +204,11 @@ def process_csv_import(file_path, gestiune_id):
                         if not vehicle.company_id and company:
                             vehicle.company = company
 
-                    # Check for Duplicate
+                    # Check for Duplicate (exact integer comparison)
                     exists = Transaction.query.filter_by(
                         date=dt, 
                         vehicle_id=vehicle.id, 
-                        quantity=qty,
+                        quantity_cl=qty_cl,
                         gestiune_id=gestiune_id
                     ).first()
                     
@@ -208,7 +217,7 @@ def process_csv_import(file_path, gestiune_id):
                             date=dt,
                             vehicle_id=vehicle.id,
                             company_id=trans_company.id if trans_company else None,
-                            quantity=qty,
+                            quantity_cl=qty_cl,
                             gestiune_id=gestiune_id
                         )
                         db.session.add(new_trans)
@@ -241,6 +250,7 @@ def process_csv_import(file_path, gestiune_id):
 
                 
             db.session.commit()
+            record_csv_import(len(df), time.perf_counter() - t0)
             return True, f"Imported {imported_count} records. Found {len(duplicates_list)} duplicates.", imported_count, duplicates_list
         
         except Exception as e:
@@ -255,8 +265,71 @@ def process_csv_import(file_path, gestiune_id):
     except Exception as e:
         return False, f"Global error: {str(e)}", 0, []
 
+def assign_series_code(company):
+    """
+    (Re)compute company.series_code against the codes of every other company.
+    Call when a company is added or renamed; other companies keep their codes.
+    """
+    from series_codes import pick_series_code
+    taken = {code for (code,) in db.session.query(Company.series_code)
+             .filter(Company.series_code.isnot(None), Company.id != company.id)}
+    company.series_code = pick_series_code(company.name, taken)
+    return company.series_code
+
+
+def get_series_codes(gestiune_id):
+    """
+    {company_id: series code} for the companies of one gestiune. Companies
+    written without a code (e.g. restored by an undo) get one here.
+    """
+    companies = Company.query.filter_by(gestiune_id=gestiune_id).order_by(Company.id).all()
+    missing = [c for c in companies if c.series_code is None and c.name and len(c.name) >= 3]
+    if missing:
+        for c in missing:
+            assign_series_code(c)
+        db.session.commit()
+    return {c.id: c.series_code for c in companies if c.series_code}
+
+def build_slips(rows, series_map):
+    """
+    Slip dicts for pdf_slips from (company_id, company, plate, date, quantity)
+    rows ordered by company, then date. `company` is any object with name, cui
+    and address (or None); the anexa numbering restarts per company.
+    """
+    from pdf_slips import clean_to_ascii
+    slips = []
+    
+    # Per-company counter state
+    last_company_id = None
+    anexa_counter = 1
+    
+    for company_id, company, plate, date, quantity in rows:
+        # Check for company change to reset counter
+        if last_company_id != company_id:
+            anexa_counter = 1
+            last_company_id = company_id
+        else:
+            anexa_counter += 1
+            
+        slips.append({
+            'company_id': company_id,
+            'company_name': clean_to_ascii(company.name if company else "NECUNOSCUT"),
+            'cui': clean_to_ascii(company.cui if company and company.cui else "-"),
+            'address': clean_to_ascii(company.address if company and company.address else "-"),
+            # Get Series for current company
+            'series': series_map.get(company_id, "---"),
+            # Use our managed counter
+            'anexa_nr': f"{anexa_counter:03d}",
+            'date': date,
+            'plate': clean_to_ascii(plate if plate is not None else "NECUNOSCUT"),
+            'quantity': quantity,
+        })
+    return slips
+
+@track_pdf('bonuri')
 def generate_pdf_report(start_date, end_date, gestiune_id, company_id=None, bon_number=""):
-    from fpdf import FPDF
+    from archive import fetch_transactions
+    from pdf_slips import write_slips_pdf
     import os
     import sys
 
@@ -276,261 +349,218 @@ def generate_pdf_report(start_date, end_date, gestiune_id, company_id=None, bon_
             # Fallback to end of day if only date provided
             end_date = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
 
-    # Base query
-    query = Transaction.query.filter(
-        Transaction.gestiune_id == gestiune_id,
-        Transaction.date >= start_date,
-        Transaction.date <= end_date
-    )
+    from models import Gestiune
+    gest = Gestiune.query.get(gestiune_id)
+    gest_name = gest.name.replace(" ", "_") if gest else "Gestiune"
+
+    # PDF System v6.1: Save to Downloads
+    downloads_path = Path.home() / "Downloads"
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
     
-    # Optional company filter
+    filename = f"{timestamp}_Bonuri_{gest_name}.pdf"
     if company_id:
-        query = query.filter(Transaction.company_id == company_id)
-        
-    # Group by company first, then date
-    transactions = query.order_by(Transaction.company_id, Transaction.date).all()
+            filename = f"{timestamp}_Bonuri_{gest_name}_company_{company_id}.pdf"
+            
+    filepath = str(downloads_path / filename)
+
+    # Stored series codes of this gestiune (before the cache key, which hashes them)
+    series_map = get_series_codes(gestiune_id)
+
+    # Same inputs and unchanged rows: serve the previously generated PDF
+    cache_key = report_cache.make_key(
+        'bonuri', gestiune_id, start=start_date, end=end_date, company_id=company_id, bon_number=bon_number,
+        data=report_cache.data_version(gestiune_id, start_date, end_date, company_id=company_id))
+    cached = report_cache.fetch('bonuri', cache_key, filepath)
+    if cached:
+        return cached
+
+    # Group by company first, then date (archived years are included when the range reaches them)
+    transactions = fetch_transactions(gestiune_id, start_date, end_date, company_id=company_id, by_company=True)
 
     if not transactions:
         return None, "Nu s-au găsit tranzacții în perioada selectată."
         
-    def clean_to_ascii(text):
-        """Replaces Romanian diacritics with ASCII equivalents to prevent PDF errors."""
-        if text is None:
-            return ""
-        if not isinstance(text, str):
-            return str(text)
-        
-        replacements = {
-            'ă': 'a', 'Ă': 'A',
-            'â': 'a', 'Â': 'A',
-            'î': 'i', 'Î': 'I',
-            'ș': 's', 'Ș': 'S',
-            'ț': 't', 'Ț': 'T',
-            '–': '-', '”': '"', '„': '"'
-        }
-        for k, v in replacements.items():
-            text = text.replace(k, v)
-        
-        # Fallback for anything else
+    # Resolve every per-slip field here, so rendering needs no database access
+    # and can run in worker processes
+    slips = build_slips(((t.company_id, t.company, t.vehicle.plate_number if t.vehicle else None, t.date, t.quantity)
+                         for t in transactions), series_map)
+
+    # Save
+    write_slips_pdf(slips, bon_number, filepath)
+    
+    message = f"Generat {len(transactions)} bonuri."
+    report_cache.store(cache_key, filepath, message)
+    return filepath, message
+
+class SettingsService:
+    """
+    Cached access to AppSettings.
+
+    All settings of a gestiune are loaded with one query into an in-process
+    dict; writes go through set()/set_many(), which commit and then refresh the
+    cached entry. Code that changes app_settings rows directly (profile
+    import/delete, database restore) must call invalidate().
+    """
+    DEFAULT_TANK_CAPACITY = 27000.0
+
+    _cache = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _load(gestiune_id):
+        from models import AppSettings
+        with SettingsService._lock:
+            cached = SettingsService._cache.get(gestiune_id)
+        if cached is not None:
+            return cached
+
+        rows = db.session.query(AppSettings.key, AppSettings.value)\
+            .filter(AppSettings.gestiune_id == gestiune_id).all()
+        values = {key: value for key, value in rows}
+        with SettingsService._lock:
+            SettingsService._cache[gestiune_id] = values
+        return values
+
+    @staticmethod
+    def invalidate(gestiune_id=None):
+        """Drop the cached settings of one gestiune, or of all when gestiune_id is None"""
+        with SettingsService._lock:
+            if gestiune_id is None:
+                SettingsService._cache.clear()
+            else:
+                SettingsService._cache.pop(gestiune_id, None)
+
+    @staticmethod
+    def get_all(gestiune_id):
+        return dict(SettingsService._load(gestiune_id))
+
+    @staticmethod
+    def get(gestiune_id, key, default=None):
+        value = SettingsService._load(gestiune_id).get(key)
+        return default if value is None else value
+
+    @staticmethod
+    def get_float(gestiune_id, key, default=0.0):
         try:
-            return text.encode('latin-1', 'replace').decode('latin-1')
-        except:
-            return text
+            return float(SettingsService._load(gestiune_id)[key])
+        except (KeyError, TypeError, ValueError):
+            return default
 
-    class PDF(FPDF):
-        def header(self):
-            pass
+    @staticmethod
+    def get_bool(gestiune_id, key, default=False):
+        value = SettingsService._load(gestiune_id).get(key)
+        if value is None:
+            return default
+        return value.lower() in ('1', 'true', 'on', 'yes')
 
-        def footer(self):
-            self.set_y(-15)
-            self.set_font('Helvetica', 'I', 8)
-            self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
+    @staticmethod
+    def get_json(gestiune_id, key, default=None):
+        import json
+        value = SettingsService._load(gestiune_id).get(key)
+        if not value:
+            return default
+        try:
+            return json.loads(value)
+        except ValueError:
+            return default
 
-    pdf = PDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    
-    # Layout configuration
-    SLIPS_PER_PAGE = 2
-    
-    # Resolve Series Globaly to handle collisions
-    # 1. Fetch all companies to build the series map
-    from models import Company
-    all_companies = Company.query.order_by(Company.id).all()
-    series_map = {}
-    taken_series = set()
-
-    for c in all_companies:
-        c_name = c.name if c.name else "UNKNOWN"
-        if len(c_name) < 3:
-            s = c_name.upper().ljust(3, 'X')
-        else:
-            # Potential candidates generator
-            candidates = []
-            
-            # Option A: Standard (1st + 2nd + Last)
-            s_std = f"{c_name[0]}{c_name[1]}{c_name[-1]}".upper()
-            candidates.append(s_std)
-            
-            # Option B: Word initials
-            import re
-            words = re.split(r'[\s\-]+', c_name)
-            if len(words) > 1:
-                for w in words[1:]:
-                    if w:
-                        s_word = f"{c_name[0]}{w[0]}{c_name[-1]}".upper()
-                        if s_word not in candidates:
-                            candidates.append(s_word)
-
-            # Option C: Sequential scan
-            for i in range(2, len(c_name) - 1):
-                s_scan = f"{c_name[0]}{c_name[i]}{c_name[-1]}".upper()
-                if s_scan not in candidates:
-                    candidates.append(s_scan)
-
-            # Assign first available
-            assigned = None
-            for cand in candidates:
-                if cand not in taken_series:
-                    assigned = cand
-                    break
-            
-            # Fallback
-            if not assigned:
-                assigned = f"{c_name[0]}X{c_name[-1]}".upper() 
+    @staticmethod
+    def get_prefixed(gestiune_id, prefix):
+        """All settings whose key starts with `prefix`, keyed by the remaining suffix"""
+        return {key[len(prefix):]: value for key, value in SettingsService._load(gestiune_id).items()
+                if key.startswith(prefix)}
 
-            series_map[c.id] = assigned
-            taken_series.add(assigned)
+    @staticmethod
+    def set(gestiune_id, key, value):
+        SettingsService.set_many(gestiune_id, {key: value})
 
-    count = 0
-    
-    # Per-company counter state
-    last_company_id = None
-    anexa_counter = 1
-    
-    for t in transactions:
-        # Check for company change to reset counter
-        if last_company_id != t.company_id:
-            anexa_counter = 1
-            last_company_id = t.company_id
-        else:
-            anexa_counter += 1
-            
-        if count % SLIPS_PER_PAGE == 0:
-            pdf.add_page()
-            y_start = 10
-        else:
-            # Second slip starts at 148mm (approx half page)
-            y_start = 150
-            
-        # Draw Separator Line if it's the second slip
-        if count % SLIPS_PER_PAGE == 1:
-            pdf.set_draw_color(200, 200, 200)
-            pdf.line(10, 140, 200, 140)
-            pdf.set_draw_color(0, 0, 0) # Reset
-            
-    # --- Content Generation ---
-        # Get Series for current company
-        series = series_map.get(t.company_id, "---")
+    @staticmethod
+    def set_many(gestiune_id, values):
+        """
+        Upsert several settings in one commit. Values equal to the cached ones
+        are skipped, so re-saving an unchanged form does not touch the database.
+        """
+        from models import AppSettings
+        current = SettingsService._load(gestiune_id)
+        changed = {key: (None if value is None else str(value)) for key, value in values.items()
+                   if current.get(key) != (None if value is None else str(value))}
+        if not changed:
+            return
 
-        company_name = clean_to_ascii(t.company.name if t.company else "NECUNOSCUT")
-        cui = clean_to_ascii(t.company.cui if t.company and t.company.cui else "-")
-        address = clean_to_ascii(t.company.address if t.company and t.company.address else "-")
-        
-        # Use our managed counter
-        anexa_nr = f"{anexa_counter:03d}" 
-        
-        pdf.set_y(y_start)
-        
-        # --- Header Section ---
-        # Left Side: Company Details
-        pdf.set_font('Helvetica', 'B', 12)
-        pdf.cell(100, 6, company_name, 0, 1, 'L')
-        
-        pdf.set_font('Helvetica', '', 9)
-        pdf.cell(100, 5, f"CUI: {cui}", 0, 1, 'L')
-        pdf.cell(100, 5, f"Adresa: {address}", 0, 1, 'L')
-        
-        # Right Side: Date, Series, Number
-        pdf.set_y(y_start)
-        pdf.set_x(110)
-        
-        pdf.set_font('Helvetica', '', 10)
-        # Date
-        pdf.cell(80, 6, f"Data: {t.date.strftime('%d.%m.%Y')}", 0, 1, 'R')
-        
-        pdf.set_x(110)
-        seria_txt = clean_to_ascii(f"Seria {series}  |  Număr Anexă: {anexa_nr}")
-        pdf.cell(80, 6, seria_txt, 0, 1, 'R')
-        
-        if bon_number:
-            pdf.set_x(110)
-            bonus_txt = clean_to_ascii(f"Atașat la Bon Consum: {bon_number}")
-            pdf.cell(80, 6, bonus_txt, 0, 1, 'R')
+        try:
+            existing = {s.key: s for s in AppSettings.query.filter(
+                AppSettings.gestiune_id == gestiune_id, AppSettings.key.in_(list(changed))).all()}
+            for key, value in changed.items():
+                setting = existing.get(key)
+                if setting is None:
+                    db.session.add(AppSettings(key=key, value=value, gestiune_id=gestiune_id))
+                else:
+                    setting.value = value
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            SettingsService.invalidate(gestiune_id)
+            raise
 
-        pdf.ln(10)
-        
-        # Title of the Ticket
-        pdf.set_font('Helvetica', 'B', 14)
-        pdf.cell(0, 10, clean_to_ascii("BON DE ALIMENTARE COMBUSTIBIL"), 0, 1, 'C')
-        pdf.ln(5)
-        
-        # --- Transaction Data (Table) ---
-        pdf.set_font('Helvetica', '', 10)
-        
-        col_w = [35, 60, 45, 15, 35] 
-        col_h = [clean_to_ascii("Data"), clean_to_ascii("Vehicul"), clean_to_ascii("Produs"), "U.M.", clean_to_ascii("Cantitate")]
-        
-        # Header Row
-        pdf.set_x(10) # Margin
-        pdf.set_fill_color(240, 240, 240)
-        pdf.set_font('Helvetica', 'B', 10)
-        
-        for i in range(5):
-            pdf.cell(col_w[i], 8, col_h[i], 1, 0, 'C', fill=True)
-        pdf.ln()
-        
-        # Data Row
-        pdf.set_x(10)
-        pdf.set_font('Helvetica', '', 10)
-        
-        # Clean data
-        row_data = [
-            t.date.strftime('%d.%m.%Y'),
-            clean_to_ascii(t.vehicle.plate_number if t.vehicle else "NECUNOSCUT"),
-            clean_to_ascii("Motorina"), 
-            "L",
-            f"{t.quantity:.2f}"
-            ]
-            
-        pdf.cell(col_w[0], 8, row_data[0], 1, 0, 'C')
-        pdf.cell(col_w[1], 8, row_data[1], 1, 0, 'C')
-        pdf.cell(col_w[2], 8, row_data[2], 1, 0, 'C')
-        pdf.cell(col_w[3], 8, row_data[3], 1, 0, 'C')
-        pdf.set_font('Helvetica', 'B', 10)
-        pdf.cell(col_w[4], 8, row_data[4], 1, 1, 'C')
-        
-        # Signatures
-        pdf.ln(15)
-        
-        y_sig = pdf.get_y()
-        pdf.set_x(20)
-        pdf.cell(60, 5, clean_to_ascii("Semnătură Șofer:"), 0, 0, 'C')
-        pdf.cell(60, 5, clean_to_ascii("Semnătură Gestionar:"), 0, 0, 'C')
-        
-        pdf.set_y(y_sig + 10)
-        pdf.set_x(20)
-        pdf.cell(60, 5, "..........................", 0, 0, 'C')
-        pdf.cell(60, 5, "..........................", 0, 0, 'C')
-        
-        
-        # Footer of slip
-        pdf.ln(5)
-        pdf.set_font('Helvetica', '', 9)
-        pdf.cell(0, 5, 'Pret unitar: 0.00 RON | Valoare: 0.00 RON', 0, 1, 'L')
-        
-        count += 1
+        with SettingsService._lock:
+            cached = SettingsService._cache.get(gestiune_id)
+            if cached is not None:
+                # Copy-on-write: readers holding the previous dict never see a partial update
+                updated = dict(cached)
+                updated.update(changed)
+                SettingsService._cache[gestiune_id] = updated
 
-    # Save
-    
-    from models import Gestiune
-    gest = Gestiune.query.get(gestiune_id)
-    gest_name = gest.name.replace(" ", "_") if gest else "Gestiune"
+    @staticmethod
+    def get_tank_capacity(gestiune_id=None):
+        """Total tank capacity in liters for a gestiune (27000 L when unset or invalid)"""
+        return SettingsService.get_float(gestiune_id, 'tank_capacity', SettingsService.DEFAULT_TANK_CAPACITY)
+
+    @staticmethod
+    def set_tank_capacity(capacity, gestiune_id=None):
+        SettingsService.set(gestiune_id, 'tank_capacity', capacity)
 
-    # PDF System v6.1: Save to Downloads
-    downloads_path = Path.home() / "Downloads"
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-    
-    filename = f"{timestamp}_Bonuri_{gest_name}.pdf"
-    if company_id:
-            filename = f"{timestamp}_Bonuri_{gest_name}_company_{company_id}.pdf"
-            
-    filepath = str(downloads_path / filename)
-    
-    pdf.output(filepath)
-    
-    return filepath, f"Generat {len(transactions)} bonuri."
 
 class HistoryService:
+    """
+    Undo/redo log (HistoryLog). Bulk actions group their entries in a
+    changeset (see changeset()): the entries share a changeset_id, are
+    committed together by the caller, and undo/redo revert or re-apply the
+    whole group in one transaction.
+    """
+    _state = threading.local()
+
+    @staticmethod
+    @contextmanager
+    def changeset(gestiune_id):
+        """
+        Group the log_action() calls of one user action. Entries are not
+        committed by log_action inside the block; the caller commits the batch
+        (together with its own changes) once.
+        """
+        state = HistoryService._state
+        if getattr(state, 'changeset', None) is not None:
+            # Nested: join the outer changeset
+            yield
+            return
+        state.changeset = {'gestiune_id': gestiune_id, 'id': None}
+        try:
+            yield
+        finally:
+            state.changeset = None
+
+    @staticmethod
+    def _row_values(obj):
+        return {col.name: getattr(obj, col.name) for col in obj.__table__.columns}
+
+    @staticmethod
+    def _diff(pre, post):
+        """(pre, post) snapshots of the columns that differ, each with the primary key"""
+        changed = [k for k in post if k != 'id' and pre.get(k) != post[k]]
+        if not changed:
+            return None, None
+        return ({'id': post['id'], **{k: pre.get(k) for k in changed}},
+                {'id': post['id'], **{k: post[k] for k in changed}})
+
     @staticmethod
     def log_action(table_name, record_id, action_type, data_obj, pre_update_state=None, gestiune_id=None):
         """
@@ -542,53 +572,223 @@ class HistoryService:
             action_type: 'CREATE', 'UPDATE', or 'DELETE'
             data_obj: The SQLAlchemy object (post-state for UPDATE/CREATE, pre-state for DELETE)
             pre_update_state: For UPDATE actions, pass the state BEFORE update
+        
+        Snapshots are history_codec blobs: the non-null columns of a created
+        or deleted row, only the changed columns (plus id) of an update. An
+        UPDATE logged without pre_update_state, before the object is modified,
+        is not committed here: its diff is taken when the caller commits the
+        change (_finish_updates) and dropped when nothing changed.
         """
         from models import HistoryLog
-        import json
+        import history_codec
         
-        # When a new action occurs, clear ALL previously undone logs
-        # This prevents conflicts in redo stack
-        HistoryLog.query.filter_by(is_undone=True).delete()
+        changeset = getattr(HistoryService._state, 'changeset', None)
         
-        # Serialize data (avoiding relationships)
-        snapshot = {}
-        if data_obj:
-            for col in data_obj.__table__.columns:
-                val = getattr(data_obj, col.name)
-                # Handle datetime
-                if isinstance(val, datetime):
-                    val = val.isoformat()
-                snapshot[col.name] = val
-        
-        # For UPDATE, store BOTH pre and post state
-        pre_snapshot = None
-        if action_type == 'UPDATE' and pre_update_state:
-            pre_snapshot = {}
-            for col in pre_update_state.__table__.columns:
-                val = getattr(pre_update_state, col.name)
-                if isinstance(val, datetime):
-                    val = val.isoformat()
-                pre_snapshot[col.name] = val
-                
         log = HistoryLog(
             table_name=table_name,
             record_id=record_id,
             action_type=action_type,
-            data_snapshot=json.dumps(snapshot),
-            pre_update_snapshot=json.dumps(pre_snapshot) if pre_snapshot else None,
             is_undone=False,
             gestiune_id=gestiune_id
         )
+        pending = action_type == 'UPDATE' and pre_update_state is None and data_obj is not None
+        if action_type == 'UPDATE' and not pending:
+            pre, post = HistoryService._diff(HistoryService._row_values(pre_update_state) if pre_update_state else {},
+                                             HistoryService._row_values(data_obj) if data_obj else {'id': record_id})
+            if post is None:
+                return
+            log.pre_update_snapshot = history_codec.encode(pre)
+            log.data_snapshot = history_codec.encode(post)
+        elif pending:
+            # Placeholder until the caller commits its change
+            log.data_snapshot = history_codec.encode({'id': record_id})
+            db.session.info.setdefault('history_pending_updates', []).append(
+                (log, data_obj, HistoryService._row_values(data_obj), gestiune_id))
+        else:
+            values = HistoryService._row_values(data_obj) if data_obj else {'id': record_id}
+            log.data_snapshot = history_codec.encode({k: v for k, v in values.items() if v is not None or k == 'id'})
+        
+        # A new action clears the redo stack, once per changeset; a pending UPDATE
+        # only once its diff is stored (_finish_updates)
+        if not pending and (changeset is None or not changeset.get('redo_cleared')):
+            HistoryService._clear_redo(db.session, gestiune_id)
+            if changeset is not None:
+                changeset['redo_cleared'] = True
+        
         db.session.add(log)
-        db.session.commit()
+        if changeset is None:
+            if not pending:
+                db.session.commit()
+            return
+        
+        # The first entry's id identifies the changeset
+        if changeset['id'] is None:
+            db.session.flush()
+            changeset['id'] = log.id
+        log.changeset_id = changeset['id']
 
     @staticmethod
-    def undo(gestiune_id):
+    def _clear_redo(session, gestiune_id):
         """
-        Undo the last action in the history for a specific gestiune.
+        Delete the previously undone logs of this gestiune (its redo stack;
+        other profiles keep theirs). Served by ix_history_log_gestiune_undone.
         """
-        from models import HistoryLog, StockOperation, Transaction
+        from models import HistoryLog
+        session.query(HistoryLog).filter_by(gestiune_id=gestiune_id, is_undone=True).delete()
+
+    @staticmethod
+    def _finish_updates(session):
+        """before_commit: store the diffs of the UPDATE entries logged before their change"""
+        import history_codec
+        pending = session.info.pop('history_pending_updates', None)
+        cleared = set()
+        for log, obj, pre, gestiune_id in pending or ():
+            pre, post = HistoryService._diff(pre, HistoryService._row_values(obj))
+            if post is None:
+                # Nothing changed: no undo step
+                if log in session.new:
+                    session.expunge(log)
+                else:
+                    session.delete(log)
+                continue
+            log.pre_update_snapshot = history_codec.encode(pre)
+            log.data_snapshot = history_codec.encode(post)
+            if gestiune_id not in cleared:
+                HistoryService._clear_redo(session, gestiune_id)
+                cleared.add(gestiune_id)
+
+    @staticmethod
+    def _discard_updates(session):
+        session.info.pop('history_pending_updates', None)
+
+    @staticmethod
+    def _snapshot(value):
+        """{column: value} of a stored snapshot: history_codec blob, or JSON text of older entries"""
+        import history_codec
         import json
+        if not value:
+            return {}
+        if isinstance(value, bytes):
+            return history_codec.decode(value)
+        data = json.loads(value) or {}
+        if data.get('date'):
+            data['date'] = datetime.fromisoformat(data['date'])
+        return data
+
+    @staticmethod
+    def _step(log, undone):
+        """All entries of the undo/redo step `log` belongs to, in the order they are applied"""
+        from models import HistoryLog
+        if log.changeset_id is None:
+            return [log]
+        query = HistoryLog.query.filter_by(changeset_id=log.changeset_id, gestiune_id=log.gestiune_id, is_undone=undone)
+        # Undo walks the changeset backwards, redo forwards
+        return query.order_by(HistoryLog.id.asc() if undone else HistoryLog.id.desc()).all()
+
+    @staticmethod
+    def _step_message(verb, logs):
+        if len(logs) == 1:
+            return f"{verb} reușită: {logs[0].action_type} pentru {logs[0].table_name}."
+        actions = ', '.join(sorted({log.action_type for log in logs}))
+        return f"{verb} reușită: {actions} pentru {len(logs)} înregistrări."
+
+    @staticmethod
+    def _undo_entry(log, gestiune_id):
+        """Revert one entry; returns an error message or None"""
+        from models import StockOperation, Transaction
+        
+        model_cls = StockOperation if log.table_name == 'StockOperation' else Transaction
+        data = HistoryService._snapshot(log.data_snapshot)
+        record_id = log.record_id
+        
+        if log.action_type == 'CREATE':
+            # Inverse of CREATE: Delete the record
+            obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
+            if obj:
+                db.session.delete(obj)
+            else:
+                return "Obiectul nu mai există pentru a fi șters sau aparține altei gestiuni."
+                
+        elif log.action_type == 'UPDATE':
+            # Inverse of UPDATE: Restore the changed columns to their pre-update values
+            obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
+            if not obj:
+                return "Obiectul nu mai există pentru a fi restaurat sau aparține altei gestiuni."
+            
+            # Use pre_update_snapshot if available, otherwise use data_snapshot (legacy)
+            restore_data = HistoryService._snapshot(log.pre_update_snapshot) if log.pre_update_snapshot else data
+            
+            for k, v in restore_data.items():
+                # Skip relational fields and IDs
+                if k in ['id', 'company', 'vehicle']:
+                    continue
+                setattr(obj, k, v)
+                    
+        elif log.action_type == 'DELETE':
+            # Inverse of DELETE: Re-create the object
+            # We DON'T force the original ID (causes conflicts)
+            # Instead we create a new record and update the log to track new ID
+            restore_data = {k: v for k, v in data.items() if k not in ['id', 'company', 'vehicle']}
+            
+            obj = model_cls(**restore_data)
+            db.session.add(obj)
+            db.session.flush()  # Get new ID
+            
+            # Update log to track new ID for potential redo
+            log.record_id = obj.id
+            
+        # Mark as undone
+        log.is_undone = True
+        return None
+
+    @staticmethod
+    def _redo_entry(log, gestiune_id):
+        """Re-apply one undone entry; returns an error message or None"""
+        from models import StockOperation, Transaction
+        
+        model_cls = StockOperation if log.table_name == 'StockOperation' else Transaction
+        data = HistoryService._snapshot(log.data_snapshot)
+        record_id = log.record_id
+        
+        if log.action_type == 'CREATE':
+            # Redo CREATE: Re-create the object (it was deleted by undo)
+            # ID left to the database to avoid conflicts; the log follows the new row
+            restore_data = {k: v for k, v in data.items() if k not in ['id', 'company', 'vehicle']}
+            
+            obj = model_cls(**restore_data)
+            db.session.add(obj)
+            db.session.flush()
+            log.record_id = obj.id
+            
+        elif log.action_type == 'DELETE':
+            # Redo DELETE: Delete the re-created object
+            obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
+            if obj:
+                db.session.delete(obj)
+            else:
+                return "Obiectul nu mai există pentru a fi șters sau aparține altei gestiuni."
+                 
+        elif log.action_type == 'UPDATE':
+            # Redo UPDATE: Re-apply the post-update values of the changed columns
+            obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
+            if not obj:
+                return "Obiectul nu mai există pentru a fi actualizat sau aparține altei gestiuni."
+            
+            for k, v in data.items():
+                if k in ['id', 'company', 'vehicle']:
+                    continue
+                setattr(obj, k, v)
+
+        # Mark as no longer undone
+        log.is_undone = False
+        return None
+
+    @staticmethod
+    def undo(gestiune_id):
+        """
+        Undo the last action (or bulk changeset) in the history for a specific gestiune.
+        """
+        from models import HistoryLog
         
         # Find last active log FOR THIS GESTIUNE
         last_log = HistoryLog.query.filter_by(is_undone=False, gestiune_id=gestiune_id).order_by(HistoryLog.id.desc()).first()
@@ -597,62 +797,15 @@ class HistoryService:
             return False, "Nu există acțiuni de anulat."
             
         try:
-            model_cls = StockOperation if last_log.table_name == 'StockOperation' else Transaction
-            data = json.loads(last_log.data_snapshot) if last_log.data_snapshot else {}
-            record_id = last_log.record_id
-            
-            if last_log.action_type == 'CREATE':
-                # Inverse of CREATE: Delete the record
-                obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
-                if obj:
-                    db.session.delete(obj)
-                else:
-                    return False, "Obiectul nu mai există pentru a fi șters sau aparține altei gestiuni."
-                    
-            elif last_log.action_type == 'UPDATE':
-                # Inverse of UPDATE: Restore to pre-update state
-                obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
-                if not obj:
-                    return False, "Obiectul nu mai există pentru a fi restaurat sau aparține altei gestiuni."
-                
-                # Use pre_update_snapshot if available, otherwise use data_snapshot (legacy)
-                restore_data = json.loads(last_log.pre_update_snapshot) if last_log.pre_update_snapshot else data
-                
-                for k, v in restore_data.items():
-                    # Skip relational fields and IDs
-                    if k in ['id', 'company', 'vehicle']:
-                        continue
-                    # Convert datetime strings back
-                    if k == 'date' and v:
-                        v = datetime.fromisoformat(v)
-                    setattr(obj, k, v)
-                        
-            elif last_log.action_type == 'DELETE':
-                # Inverse of DELETE: Re-create the object
-                # We DON'T force the original ID (causes conflicts)
-                # Instead we create a new record and update the log to track new ID
-                
-                # Remove problematic fields
-                restore_data = {k: v for k, v in data.items() if k not in ['company', 'vehicle']}
-                
-                # Convert date string back to datetime
-                if 'date' in restore_data and restore_data['date']:
-                    restore_data['date'] = datetime.fromisoformat(restore_data['date'])
-                
-                # Remove the ID to let database auto-assign (prevents conflicts)
-                original_id = restore_data.pop('id', None)
-                
-                obj = model_cls(**restore_data)
-                db.session.add(obj)
-                db.session.flush()  # Get new ID
-                
-                # Update log to track new ID for potential redo
-                last_log.record_id = obj.id
-                
-            # Mark as undone
-            last_log.is_undone = True
+            logs = HistoryService._step(last_log, undone=False)
+            for log in logs:
+                error = HistoryService._undo_entry(log, gestiune_id)
+                if error:
+                    # All or nothing for a changeset
+                    db.session.rollback()
+                    return False, error
             db.session.commit()
-            return True, f"Anulare reușită: {last_log.action_type} pentru {last_log.table_name}."
+            return True, HistoryService._step_message("Anulare", logs)
             
         except Exception as e:
             db.session.rollback()
@@ -661,10 +814,9 @@ class HistoryService:
     @staticmethod
     def redo(gestiune_id):
         """
-        Redo the most recently undone action for a specific gestiune.
+        Redo the most recently undone action (or bulk changeset) for a specific gestiune.
         """
-        from models import HistoryLog, StockOperation, Transaction
-        import json
+        from models import HistoryLog
         
         # Find most recent undone log FOR THIS GESTIUNE
         retry_log = HistoryLog.query.filter_by(is_undone=True, gestiune_id=gestiune_id).order_by(HistoryLog.id.desc()).first()
@@ -673,93 +825,73 @@ class HistoryService:
             return False, "Nu există acțiuni de refăcut."
               
         try:
-            model_cls = StockOperation if retry_log.table_name == 'StockOperation' else Transaction
-            data = json.loads(retry_log.data_snapshot) if retry_log.data_snapshot else {}
-            record_id = retry_log.record_id
-            
-            if retry_log.action_type == 'CREATE':
-                # Redo CREATE: Re-create the object (it was deleted by undo)
-                restore_data = {k: v for k, v in data.items() if k not in ['company', 'vehicle']}
-                
-                if 'date' in restore_data and restore_data['date']:
-                    restore_data['date'] = datetime.fromisoformat(restore_data['date'])
-                
-                # Remove ID to avoid conflicts
-                restore_data.pop('id', None)
-                
-                obj = model_cls(**restore_data)
-                db.session.add(obj)
-                db.session.flush()
-                
-            elif retry_log.action_type == 'DELETE':
-                # Redo DELETE: Delete the re-created object
-                obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
-                if obj:
-                    db.session.delete(obj)
-                else:
-                    return False, "Obiectul nu mai există pentru a fi șters sau aparține altei gestiuni."
-                     
-            elif retry_log.action_type == 'UPDATE':
-                # Redo UPDATE: Restore to post-update state
-                obj = model_cls.query.filter_by(id=record_id, gestiune_id=gestiune_id).first()
-                if not obj:
-                    return False, "Obiectul nu mai există pentru a fi actualizat sau aparține altei gestiuni."
-                
-                # Use the main data_snapshot for post-update state
-                for k, v in data.items():
-                    if k in ['id', 'company', 'vehicle']:
-                        continue
-                    if k == 'date' and v:
-                        v = datetime.fromisoformat(v)
-                    setattr(obj, k, v)
-
-            # Mark as no longer undone
-            retry_log.is_undone = False
+            logs = HistoryService._step(retry_log, undone=True)
+            for log in logs:
+                error = HistoryService._redo_entry(log, gestiune_id)
+                if error:
+                    db.session.rollback()
+                    return False, error
             db.session.commit()
-            return True, f"Refacere reușită: {retry_log.action_type} pentru {retry_log.table_name}."
+            return True, HistoryService._step_message("Refacere", logs)
             
         except Exception as e:
             db.session.rollback()
             return False, f"Eroare la refacere: {str(e)}"
 
 
+# UPDATE entries logged before their change get their diff when the change is committed
+if not event.contains(db.session, 'before_commit', HistoryService._finish_updates):
+    event.listen(db.session, 'before_commit', HistoryService._finish_updates)
+    event.listen(db.session, 'after_rollback', HistoryService._discard_updates)
+
+
+def monthly_company_stats(companies, sums):
+    """
+    Summary rows of the monthly report. `sums` maps company id to the
+    (initial, in, out, consumed) centiliter totals of the period; returns
+    (company_stats, total_in, total_out) in liters.
+    """
+    from pdf_slips import clean_to_ascii
+    company_stats = []
+    total_in_general = 0
+    total_out_general = 0
+
+    for c in companies:
+        stock_initial, in_period, out_manual, consumed = sums.get(c.id, (0, 0, 0, 0))
+
+        # Total Iesit = consumption + manual OUT during period
+        out_period = out_manual + consumed
+
+        stock_final = stock_initial + in_period - out_period
+
+        company_stats.append({
+            'name': clean_to_ascii(c.name),
+            'stock_initial': to_liters(stock_initial),
+            'total_in': to_liters(in_period),
+            'total_out': to_liters(out_period),
+            'stock_final': to_liters(stock_final)
+        })
+
+        total_in_general += in_period
+        total_out_general += out_period
+
+    return company_stats, to_liters(total_in_general), to_liters(total_out_general)
+
+@track_pdf('lunar')
 def generate_monthly_report_pdf(start_date, end_date, gestiune_id, initial_series=None, final_series=None):
     """
     Generate comprehensive monthly fuel report with:
     1. Summary statistics (per company and overall)
     2. Chronological transaction listing (all companies)
     """
-    import sys
-    import traceback
-    
-    from fpdf import FPDF
     from models import Company, StockOperation, Transaction, Gestiune
+    from archive import transaction_source, stock_operation_source
+    from pdf_monthly import render_monthly_pdf
     from extensions import db
-    from sqlalchemy import func
+    from sqlalchemy import func, select, union_all, literal, case, and_
     import os
     from datetime import datetime
     
-    # Helper function for ASCII conversion
-    def clean_to_ascii(text):
-        if text is None:
-            return ""
-        if not isinstance(text, str):
-            return str(text)
-        
-        replacements = {
-            'ă': 'a', 'â': 'a', 'î': 'i', 'ș': 's', 'ț': 't',
-            'Ă': 'A', 'Â': 'A', 'Î': 'I', 'Ș': 'S', 'Ț': 'T',
-            '–': '-', '”': '"', '„': '"'
-        }
-        for k, v in replacements.items():
-            text = text.replace(k, v)
-        
-        # Fallback for anything else
-        try:
-            return text.encode('latin-1', 'replace').decode('latin-1')
-        except:
-            return text
-    
     # Parse date inputs
     if isinstance(start_date, str):
         try:
@@ -773,226 +905,148 @@ def generate_monthly_report_pdf(start_date, end_date, gestiune_id, initial_serie
         except ValueError:
             end_date = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
     
-    # Get all companies for this gestiune
-    companies = Company.query.filter_by(gestiune_id=gestiune_id).order_by(Company.id).all()
-    
-    # Calculate statistics per company
-    company_stats = []
-    total_in_general = 0
-    total_out_general = 0
-    total_initial_stock = 0
-    total_final_stock = 0
+    # Output path (PDF System v6.1: Save to Downloads)
+    downloads_path = Path.home() / "Downloads"
     
-    for c in companies:
-        # Stoc Initial = only INITIAL entries (snapshot at start of month)
-        stock_initial = db.session.query(func.sum(StockOperation.quantity)).filter(
-            StockOperation.gestiune_id == gestiune_id,
-            StockOperation.company_id == c.id,
-            StockOperation.operation_type == 'INITIAL'
-        ).scalar() or 0
-        
-        # IN during period
-        in_period = db.session.query(func.sum(StockOperation.quantity)).filter(
-            StockOperation.gestiune_id == gestiune_id,
-            StockOperation.company_id == c.id,
-            StockOperation.operation_type == 'IN',
-            StockOperation.date >= start_date,
-            StockOperation.date <= end_date
-        ).scalar() or 0
-        
-        # Total Iesit = consumption + manual OUT during period
-        out_manual = db.session.query(func.sum(StockOperation.quantity)).filter(
-            StockOperation.gestiune_id == gestiune_id,
-            StockOperation.company_id == c.id,
-            StockOperation.operation_type == 'OUT',
-            StockOperation.date >= start_date,
-            StockOperation.date <= end_date
-        ).scalar() or 0
-        
-        consumed_period = db.session.query(func.sum(Transaction.quantity)).filter(
-            Transaction.gestiune_id == gestiune_id,
-            Transaction.company_id == c.id,
-            Transaction.date >= start_date,
-            Transaction.date <= end_date
-        ).scalar() or 0
-        
-        out_period = out_manual + consumed_period
-        
-        stock_final = stock_initial + in_period - out_period
-        
-        company_stats.append({
-            'name': clean_to_ascii(c.name),
-            'stock_initial': stock_initial,
-            'total_in': in_period,
-            'total_out': out_period,
-            'stock_final': stock_final
-        })
+    gest_name = f"Gestiune_{gestiune_id}"
+    gest = Gestiune.query.get(gestiune_id)
+    if gest: gest_name = gest.name.replace(" ", "_")
         
-        total_in_general += in_period
-        total_out_general += out_period
-        total_initial_stock += stock_initial
-        total_final_stock += stock_final
-    
-    from fpdf import FPDF
-    
-    # Istoric Cronologic: ONLY consumption transactions
-    all_transactions = db.session.query(Transaction).filter(
-        Transaction.gestiune_id == gestiune_id,
-        Transaction.date >= start_date,
-        Transaction.date <= end_date
-    ).order_by(Transaction.date).all()
+    start_str = start_date.strftime('%Y%m%d')
+    end_str = end_date.strftime('%Y%m%d')
     
-    # Build chronological list from transactions only
-    combined = []
-    for trans in all_transactions:
-        vehicle = trans.vehicle.plate_number if trans.vehicle else 'N/A'
-        comp_name = 'N/A'
-        if trans.company_id:
-            comp = Company.query.filter_by(id=trans.company_id, gestiune_id=gestiune_id).first()
-            if comp: comp_name = comp.name
-            
-        combined.append({
-            'date': trans.date,
-            'type': 'CONSUM',
-            'vehicle': vehicle,
-            'quantity': trans.quantity,
-            'company': comp_name
-        })
+    filename = f"Raport_Lunar_{gest_name}_{start_str}_{end_str}.pdf"
+    filepath = str(downloads_path / filename)
     
-    combined.sort(key=lambda x: x['date'])
+    # Same inputs and unchanged rows: serve the previously generated PDF
+    cache_key = report_cache.make_key(
+        'lunar', gestiune_id, start=start_date, end=end_date,
+        initial_series=initial_series, final_series=final_series,
+        data=report_cache.data_version(gestiune_id, start_date, end_date, stock=True))
+    cached = report_cache.fetch('lunar', cache_key, filepath)
+    if cached:
+        return cached
     
-    class PDF(FPDF):
-       def header(self):
-           pass
-       def footer(self):
-           self.set_y(-15)
-           self.set_font('Helvetica', 'I', 8)
-           self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
-
-    # Generate PDF
-    pdf = PDF()
-    pdf.add_page()
-    pdf.set_font('Helvetica', 'B', 16)
+    # Get all companies for this gestiune
+    companies = Company.query.filter_by(gestiune_id=gestiune_id).order_by(Company.id).all()
     
-    # Title
-    pdf.cell(0, 10, clean_to_ascii('Raport Lunar - Gestiune Motorina'), 0, 1, 'C')
-    pdf.set_font('Helvetica', '', 10)
-    pdf.cell(0, 6, f"Perioada: {start_date.strftime('%d.%m.%Y %H:%M')} - {end_date.strftime('%d.%m.%Y %H:%M')}", 0, 1, 'C')
-    pdf.ln(5)
+    # Period movements come from the hot tables plus any archived years in range
+    ops_src = stock_operation_source(gestiune_id, start_date, end_date)
+    trans_src = transaction_source(gestiune_id, start_date, end_date)
     
-    # Summary Table
-    pdf.set_font('Helvetica', 'B', 12)
-    pdf.cell(0, 8, clean_to_ascii('Sumar Statistic'), 0, 1, 'L')
-    pdf.set_font('Helvetica', 'B', 8)
+    # All company figures in one grouped query over the three kinds of movement:
+    #  - Stoc Initial = only INITIAL entries (snapshot at start of month)
+    #  - IN / OUT (manual correction) stock operations during the period
+    #  - consumption (transactions) during the period
+    movements = union_all(
+        select(StockOperation.company_id, StockOperation.operation_type.label('kind'), StockOperation.quantity_cl).where(
+            StockOperation.gestiune_id == gestiune_id,
+            StockOperation.operation_type == 'INITIAL'
+        ),
+        select(ops_src.c.company_id, ops_src.c.operation_type.label('kind'), ops_src.c.quantity_cl).where(
+            ops_src.c.gestiune_id == gestiune_id,
+            ops_src.c.operation_type.in_(('IN', 'OUT')),
+            ops_src.c.date >= start_date,
+            ops_src.c.date <= end_date
+        ),
+        select(trans_src.c.company_id, literal('CONSUM').label('kind'), trans_src.c.quantity_cl).where(
+            trans_src.c.gestiune_id == gestiune_id,
+            trans_src.c.date >= start_date,
+            trans_src.c.date <= end_date
+        )
+    ).subquery('movements')
     
-    # Table header
-    pdf.cell(60, 6, 'Firma', 1, 0, 'C')
-    pdf.cell(30, 6, 'Stoc Initial', 1, 0, 'C')
-    pdf.cell(30, 6, 'Total Intrat', 1, 0, 'C')
-    pdf.cell(30, 6, 'Total Iesit', 1, 0, 'C')
-    pdf.cell(30, 6, 'Stoc Final', 1, 1, 'C')
+    def kind_sum(kind):
+        return func.coalesce(func.sum(case((movements.c.kind == kind, movements.c.quantity_cl), else_=0)), 0)
     
-    pdf.set_font('Helvetica', '', 8)
-    for stat in company_stats:
-        pdf.cell(60, 6, stat['name'], 1, 0, 'L')
-        pdf.cell(30, 6, f"{stat['stock_initial']:.2f} L", 1, 0, 'R')
-        pdf.cell(30, 6, f"{stat['total_in']:.2f} L", 1, 0, 'R')
-        pdf.cell(30, 6, f"{stat['total_out']:.2f} L", 1, 0, 'R')
-        pdf.cell(30, 6, f"{stat['stock_final']:.2f} L", 1, 1, 'R')
+    sums = {
+        row.company_id: row for row in db.session.query(
+            movements.c.company_id,
+            kind_sum('INITIAL').label('initial'),
+            kind_sum('IN').label('in_'),
+            kind_sum('OUT').label('out'),
+            kind_sum('CONSUM').label('consumed')
+        ).group_by(movements.c.company_id)
+    }
     
-    # Overall totals
-    pdf.set_font('Helvetica', 'B', 8)
-    pdf.cell(60, 6, 'TOTAL GENERAL', 1, 0, 'L')
-    # pdf.cell(30, 6, f"{total_initial_stock:.2f} L", 1, 0, 'R') # Removed to fit
-    pdf.cell(30, 6, f"{total_in_general:.2f} L", 1, 0, 'R')
-    pdf.cell(60, 6, f"{total_out_general:.2f} L", 1, 0, 'R')
-    # pdf.cell(30, 6, f"{total_final_stock:.2f} L", 1, 1, 'R')
-    pdf.ln(10)
-
-    # PUMP SERIES SECTION
-    if initial_series is not None and final_series is not None:
-        pdf.set_font('Helvetica', 'B', 10)
-        pdf.cell(0, 8, clean_to_ascii('Verificare Contoare Pompa'), 0, 1, 'L')
-        pdf.set_font('Helvetica', '', 9)
-        
-        series_diff = final_series - initial_series
-        
-        # Simple grid
-        pdf.cell(50, 6, 'Serie Initiala:', 0, 0, 'L')
-        pdf.cell(40, 6, f"{initial_series:.2f}", 0, 1, 'L')
-        
-        pdf.cell(50, 6, 'Serie Finala:', 0, 0, 'L')
-        pdf.cell(40, 6, f"{final_series:.2f}", 0, 1, 'L')
-        
-        pdf.set_font('Helvetica', 'B', 9)
-        pdf.cell(50, 6, 'Diferenta Serii:', 0, 0, 'L')
-        pdf.cell(40, 6, f"{series_diff:.2f} L", 0, 1, 'L')
-        
-        pdf.cell(50, 6, 'Total Iesit (Calculat):', 0, 0, 'L')
-        pdf.cell(40, 6, f"{total_out_general:.2f} L", 0, 1, 'L')
-        
-        # Match Check
-        match_diff = abs(series_diff - total_out_general)
-        if match_diff < 1.0: # Tolerance of 1 liter
-            pdf.set_text_color(0, 128, 0)
-            pdf.cell(0, 6, clean_to_ascii(f"OK (Diferenta: {match_diff:.2f} L)"), 0, 1, 'L')
-        else:
-            pdf.set_text_color(255, 0, 0)
-            pdf.cell(0, 6, clean_to_ascii(f"DISCREPANTA (Diferenta: {match_diff:.2f} L)"), 0, 1, 'L')
-        
-        pdf.set_text_color(0, 0, 0) # Reset
-        pdf.ln(5)
-
-    pdf.ln(5)
+    company_stats, total_in_general, total_out_general = monthly_company_stats(
+        companies, {cid: (row.initial, row.in_, row.out, row.consumed) for cid, row in sums.items()})
     
-    # Detailed Transactions
-    pdf.set_font('Helvetica', 'B', 12)
-    pdf.cell(0, 8, clean_to_ascii('Istoric Cronologic'), 0, 1, 'L')
-    pdf.set_font('Helvetica', 'B', 8)
+    # Istoric Cronologic: ONLY consumption transactions, with plate and company name joined in
+    chronological = db.session.query(
+        trans_src.c.date,
+        Vehicle.plate_number,
+        Company.name,
+        trans_src.c.quantity_cl
+    ).select_from(trans_src)\
+     .outerjoin(Vehicle, Vehicle.id == trans_src.c.vehicle_id)\
+     .outerjoin(Company, and_(Company.id == trans_src.c.company_id, Company.gestiune_id == gestiune_id))\
+     .filter(trans_src.c.gestiune_id == gestiune_id, trans_src.c.date >= start_date, trans_src.c.date <= end_date)\
+     .order_by(trans_src.c.date, trans_src.c.id)
     
-    # Table header
-    pdf.cell(35, 6, 'Data/Ora', 1, 0, 'C')
-    pdf.cell(50, 6, 'Firma', 1, 0, 'C')
-    pdf.cell(25, 6, 'Tip', 1, 0, 'C')
-    pdf.cell(50, 6, 'Vehicul/Detalii', 1, 0, 'C')
-    pdf.cell(30, 6, 'Cantitate', 1, 1, 'C')
+    combined = [{
+        'date': date,
+        'type': 'CONSUM',
+        'vehicle': plate or 'N/A',
+        'quantity': to_liters(quantity_cl),
+        'company': comp_name or 'N/A'
+    } for date, plate, comp_name, quantity_cl in chronological]
     
-    pdf.set_font('Helvetica', '', 7)
-    for item in combined:
-        pdf.cell(35, 5, item['date'].strftime('%d.%m.%Y %H:%M'), 1, 0, 'L')
-        pdf.cell(50, 5, clean_to_ascii(item['company'][:20]), 1, 0, 'L')
-        pdf.cell(25, 5, item['type'], 1, 0, 'C')
-        pdf.cell(50, 5, clean_to_ascii(item['vehicle'][:25]), 1, 0, 'L')
-        pdf.cell(30, 5, f"{item['quantity']:.2f} L", 1, 1, 'R')
+    render_monthly_pdf(start_date, end_date, company_stats, total_in_general, total_out_general, combined,
+                       initial_series, final_series, filepath)
     
-    # Save PDF
-    # PDF System v6.1: Save to Downloads
+    report_cache.store(cache_key, filepath, "PDF generat cu succes")
+    return filepath, "PDF generat cu succes"
+
+
+@track_pdf('analiza')
+def generate_analysis_report_pdf(html_content, gestiune_id, report_data=None):
+    """
+    Generate professional analysis report.
+    With `report_data` (the analysis_pdf.html template values) the report is
+    drawn natively with FPDF (pdf_analysis); xhtml2pdf renders `html_content`
+    when that fails, when FUEL_ANALYSIS_PDF_ENGINE=xhtml2pdf, or without data.
+    The template values, without the generation time, key the report cache;
+    without them the HTML itself is the key.
+    """
+    import os
+    import sys
+    import hashlib
+    from datetime import datetime
+
+    # v6.2 Desktop Rebuild: Target Downloads folder
     downloads_path = Path.home() / "Downloads"
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-    
-    gest_name = f"Gestiune_{gestiune_id}"
+
+    from models import Gestiune
     gest = Gestiune.query.get(gestiune_id)
-    if gest: gest_name = gest.name.replace(" ", "_")
-        
-    start_str = start_date.strftime('%Y%m%d')
-    end_str = end_date.strftime('%Y%m%d')
+    gest_name = gest.name.replace(" ", "_") if gest else "Gestiune"
     
-    filename = f"Raport_Lunar_{gest_name}_{start_str}_{end_str}.pdf"
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+    filename = f"{timestamp}_Analiza_{gest_name}.pdf"
     filepath = str(downloads_path / filename)
-    
-    pdf.output(filepath)
-    
-    return filepath, "PDF generat cu succes"
 
+    if report_data is not None:
+        cache_inputs = {k: v for k, v in report_data.items() if k != 'generated_at'}
+    else:
+        cache_inputs = {'html': hashlib.sha256(html_content.encode('utf-8')).hexdigest()}
+    cache_key = report_cache.make_key('analiza', gestiune_id, **cache_inputs)
+    cached = report_cache.fetch('analiza', cache_key, filepath)
+    if cached:
+        return cached
+
+    if report_data is not None and os.environ.get('FUEL_ANALYSIS_PDF_ENGINE', 'native') != 'xhtml2pdf':
+        from pdf_analysis import render_analysis_pdf
+        try:
+            render_analysis_pdf(report_data, filepath)
+        except Exception as e:
+            print(f"[PDF] Native analysis renderer failed, falling back to xhtml2pdf: {e}")
+        else:
+            report_cache.store(cache_key, filepath, "PDF generat cu succes")
+            return filepath, "PDF generat cu succes"
 
-def generate_analysis_report_pdf(html_content, gestiune_id):
-    """
-    Generate professional analysis report using xhtml2pdf.
-    """
     try:
         from xhtml2pdf import pisa
     except (ImportError, OSError):
-        import sys
         from unittest.mock import MagicMock
         # Mock Cairo-related modules to bypass library checks on Windows
         mock = MagicMock()
@@ -1000,12 +1054,6 @@ def generate_analysis_report_pdf(html_content, gestiune_id):
         sys.modules["cairo"] = mock
         sys.modules["rlpycairo"] = mock
         from xhtml2pdf import pisa
-    import os
-    import sys
-    import base64
-    from datetime import datetime
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
 
     def link_callback(uri, rel):
         """
@@ -1019,28 +1067,6 @@ def generate_analysis_report_pdf(html_content, gestiune_id):
             return uri
         return uri
 
-    
-    # v6.2 Desktop Rebuild: Target Downloads folder
-    downloads_path = Path.home() / "Downloads"
-
-    # 1. Base64 Logo support (By-pass path issues)
-    def get_base64_image(image_path):
-        if image_path and os.path.exists(image_path):
-            try:
-                with open(image_path, "rb") as img_file:
-                    ext = os.path.splitext(image_path)[1][1:]
-                    return f"data:image/{ext};base64,{base64.b64encode(img_file.read()).decode()}"
-            except: return None
-        return None
-
-    from models import Gestiune
-    gest = Gestiune.query.get(gestiune_id)
-    gest_name = gest.name.replace(" ", "_") if gest else "Gestiune"
-    
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-    filename = f"{timestamp}_Analiza_{gest_name}.pdf"
-    filepath = str(downloads_path / filename)
-
     with open(filepath, "wb") as f:
         pisa_status = pisa.CreatePDF(
             html_content, 
@@ -1052,4 +1078,105 @@ def generate_analysis_report_pdf(html_content, gestiune_id):
     if pisa_status.err:
         return None, "A apărut o eroare la generarea PDF-ului."
     
+    report_cache.store(cache_key, filepath, "PDF generat cu succes")
     return filepath, "PDF generat cu succes"
+
+
+# --- Tabular export of transactions (/export/transactions) ---
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = ['Data', 'Nr. Inmatriculare', 'Firma', 'Categorie', 'Cantitate (L)']
+
+
+def iter_transaction_rows(gestiune_id, start_date=None, end_date=None, company_id=None, category_id=None,
+                          batch_size=None):
+    """
+    Yield (date, plate, company, category, liters) for the transactions of a
+    range, archived years included, ordered by date. Rows are read in keyset
+    batches of EXPORT_BATCH_SIZE ((date, id) after the last row sent), each in
+    its own short read transaction, so a long download never holds the
+    database lock and the range is never loaded at once.
+    """
+    from sqlalchemy import and_, or_, select
+    from models import VehicleCategory
+    from archive import transaction_source
+
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    last = None
+    while True:
+        # Rebuilt per batch: the next transaction may run on another pooled
+        # connection, which needs the archive years attached again
+        src = transaction_source(gestiune_id, start_date, end_date)
+        stmt = select(
+            src.c.date, Vehicle.plate_number, Company.name, VehicleCategory.name, src.c.quantity_cl, src.c.id
+        ).select_from(src)\
+         .outerjoin(Vehicle, Vehicle.id == src.c.vehicle_id)\
+         .outerjoin(Company, Company.id == src.c.company_id)\
+         .outerjoin(VehicleCategory, VehicleCategory.id == Vehicle.category_id)\
+         .where(src.c.gestiune_id == gestiune_id)
+        if start_date:
+            stmt = stmt.where(src.c.date >= start_date)
+        if end_date:
+            stmt = stmt.where(src.c.date <= end_date)
+        if company_id:
+            stmt = stmt.where(src.c.company_id == company_id)
+        if category_id:
+            stmt = stmt.where(Vehicle.category_id == category_id)
+        if last is not None:
+            last_date, last_id = last
+            stmt = stmt.where(or_(src.c.date > last_date, and_(src.c.date == last_date, src.c.id > last_id)))
+        stmt = stmt.order_by(src.c.date, src.c.id).limit(batch_size)
+
+        batch = db.session.execute(stmt).all()
+        # Read-only: ends the transaction, releasing the SHARED lock until the next batch
+        db.session.commit()
+        for date, plate, company, category, quantity_cl, _ in batch:
+            yield date, plate or '', company or '', category or '', to_liters(quantity_cl)
+        if len(batch) < batch_size:
+            return
+        last = (batch[-1][0], batch[-1][5])
+
+
+def stream_transactions_csv(rows):
+    """CSV text chunks (UTF-8 with BOM so Excel shows diacritics), one per batch of rows"""
+    import csv
+    import io
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for date, plate, company, category, liters in rows:
+        writer.writerow([date.strftime('%Y-%m-%d %H:%M'), plate, company, category, f"{liters:.2f}"])
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_transactions_xlsx(rows):
+    """
+    XLSX bytes chunks. openpyxl's write-only workbook spools rows to a temporary
+    file instead of keeping cells in memory; the zip can only be read once it
+    is complete, so the file is streamed after the last row is written.
+    """
+    import tempfile
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Tranzactii')
+    ws.append(EXPORT_COLUMNS)
+    for date, plate, company, category, liters in rows:
+        ws.append([date, plate, company, category, liters])
+
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,131 @@
+"""
+Per-request SQL instrumentation.
+
+SQLAlchemy before/after_cursor_execute hooks time every statement executed
+while a Flask request is active and collect, per request:
+  - statement count and total DB time (response headers X-SQL-Queries and
+    Server-Timing, visible in the browser dev tools)
+  - the slowest statements; those over SQL_SLOW_QUERY_MS are written to
+    logs/slow_queries.log (rotating, next to app.log)
+  - optionally (SQL_DETECT_N_PLUS_ONE), statement shapes repeated at least
+    SQL_N_PLUS_ONE_THRESHOLD times, the usual sign of a query inside a loop
+
+Statements executed outside a request (startup, background threads) are not
+recorded.
+"""
+import logging
+import os
+import re
+import time
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOWEST_KEPT = 5
+
+slow_query_logger = logging.getLogger('fuel_manager.sql')
+
+
+def _shape(statement):
+    """Normalise a statement so executions differing only in literals/IN-list length compare equal"""
+    shape = re.sub(r'\s+', ' ', statement).strip()
+    shape = re.sub(r"'(?:[^']|'')*'", '?', shape)
+    shape = re.sub(r'\b\d+(?:\.\d+)?\b', '?', shape)
+    return re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', shape)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault('_sql_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+    starts = conn.info.get('_sql_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+
+    stats = g.get('_sql_stats')
+    if stats is None:
+        return
+    stats['count'] += 1
+    stats['time'] += elapsed
+    slowest = stats['slowest']
+    if len(slowest) < SLOWEST_KEPT or elapsed > slowest[-1][0]:
+        slowest.append((elapsed, statement, parameters))
+        slowest.sort(key=lambda item: item[0], reverse=True)
+        del slowest[SLOWEST_KEPT:]
+    if stats['shapes'] is not None:
+        stats['shapes'][_shape(statement)] += 1
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time
+    conn = exception_context.connection
+    if conn is not None and has_request_context():
+        starts = conn.info.get('_sql_start')
+        if starts:
+            starts.pop()
+
+
+def _format_params(parameters, limit=200):
+    text = repr(parameters)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+def init_sql_instrumentation(app, log_dir):
+    """Register the cursor hooks and the request hooks on `app`"""
+    app.config.setdefault('SQL_SLOW_QUERY_MS', float(os.environ.get('FUEL_SQL_SLOW_QUERY_MS', 100)))
+    app.config.setdefault('SQL_DETECT_N_PLUS_ONE', os.environ.get('FUEL_SQL_N_PLUS_ONE') == '1')
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 10)
+
+    if not slow_query_logger.handlers:
+        handler = RotatingFileHandler(os.path.join(log_dir, 'slow_queries.log'), maxBytes=1024*1024, backupCount=3)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        slow_query_logger.addHandler(handler)
+        slow_query_logger.setLevel(logging.INFO)
+        slow_query_logger.propagate = False
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    @app.before_request
+    def start_sql_stats():
+        g._sql_stats = {
+            'count': 0,
+            'time': 0.0,
+            'slowest': [],
+            'shapes': Counter() if app.config['SQL_DETECT_N_PLUS_ONE'] else None,
+        }
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.pop('_sql_stats', None)
+        if stats is None:
+            return response
+        total_ms = stats['time'] * 1000
+        response.headers['X-SQL-Queries'] = str(stats['count'])
+        response.headers['Server-Timing'] = f'db;dur={total_ms:.1f};desc="{stats["count"]} queries"'
+
+        where = f"{request.method} {request.path}"
+        threshold = app.config['SQL_SLOW_QUERY_MS']
+        for elapsed, statement, parameters in stats['slowest']:
+            if elapsed * 1000 >= threshold:
+                slow_query_logger.warning(f"SLOW {elapsed * 1000:.1f} ms [{where}] "
+                                          f"{' '.join(statement.split())} -- params: {_format_params(parameters)}")
+
+        if stats['shapes'] is not None:
+            repeated = [(shape, n) for shape, n in stats['shapes'].most_common()
+                        if n >= app.config['SQL_N_PLUS_ONE_THRESHOLD']]
+            if repeated:
+                response.headers['X-SQL-N-Plus-One'] = str(len(repeated))
+                for shape, n in repeated:
+                    slow_query_logger.warning(f"N+1 {n}x [{where}] {shape}")
+        return response
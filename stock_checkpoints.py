@@ -0,0 +1,229 @@
+"""
+Point-in-time company stock: "what was each company's stock at <moment>".
+
+The balance of a company is the dashboard formula (INITIAL + IN - OUT -
+consumption of categorised vehicles) over every row dated up to the moment.
+Instead of summing from the beginning, balances_as_of() starts from the
+nearest stock_checkpoint row at or before the moment and adds the rows dated
+between the checkpoint and the moment.
+
+A checkpoint (gestiune, company, at, balance_cl) is the balance of the rows
+dated strictly before `at`, a midnight. build_checkpoints() writes one after
+every day that has movements, so any moment is answered from at most one
+day's rows. SQLite triggers (CHECKPOINT_TRIGGERS) delete the checkpoints of a
+gestiune dated after any row that is inserted, edited or deleted, and after
+the transactions of a vehicle whose category changes; the next build
+recomputes them from the last valid one. A background thread
+(start_checkpoint_worker) builds the missing checkpoints every night.
+
+Checkpoints count the hot tables only, so after an archive close (see
+archive.py) those dated after the cutoff start from its carried-forward
+INITIAL entries; moments before the cutoff add the archived rows.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+CHECKPOINT_DELAY = 90
+CHECKPOINT_INTERVAL = 3600
+
+_worker = None
+_lock = threading.Lock()
+# One build at a time: the worker and the as-of route both catch up on missing days
+_build_lock = threading.Lock()
+
+
+def _checkpoint_triggers():
+    """
+    Any write to a transaction/stock operation drops the checkpoints of its
+    gestiune dated after it; a vehicle category change or delete those after
+    the vehicle's first transaction.
+    """
+    statements = []
+    for table in ('transaction', 'stock_operation'):
+        statements.append(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_checkpoint_insert AFTER INSERT ON [{table}] BEGIN
+                DELETE FROM stock_checkpoint WHERE gestiune_id = NEW.gestiune_id AND at > NEW.date;
+            END""")
+        statements.append(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_checkpoint_update AFTER UPDATE ON [{table}] BEGIN
+                DELETE FROM stock_checkpoint WHERE (gestiune_id = OLD.gestiune_id AND at > OLD.date)
+                                                OR (gestiune_id = NEW.gestiune_id AND at > NEW.date);
+            END""")
+        statements.append(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_checkpoint_delete AFTER DELETE ON [{table}] BEGIN
+                DELETE FROM stock_checkpoint WHERE gestiune_id = OLD.gestiune_id AND at > OLD.date;
+            END""")
+    vehicle_scope = "gestiune_id = OLD.gestiune_id AND at > (SELECT MIN(date) FROM [transaction] WHERE vehicle_id = OLD.id)"
+    statements.append(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_vehicle_checkpoint_category AFTER UPDATE OF category_id ON vehicle
+        WHEN OLD.category_id IS NOT NEW.category_id BEGIN
+            DELETE FROM stock_checkpoint WHERE {vehicle_scope};
+        END""")
+    statements.append(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_vehicle_checkpoint_delete AFTER DELETE ON vehicle BEGIN
+            DELETE FROM stock_checkpoint WHERE {vehicle_scope};
+        END""")
+    return statements
+
+
+# Created by migration v7 and, for databases already at the current schema
+# version that create_all rebuilds (e.g. tests), by models.py
+CHECKPOINT_TRIGGERS = _checkpoint_triggers()
+
+
+def _today():
+    return datetime.combine(datetime.now().date(), datetime.min.time())
+
+
+def _movements(gestiune_id, ops_src, trans_src, *date_criteria):
+    """
+    (ops, consumption) queries of signed centiliter sums per (company_id, day)
+    over the rows of `ops_src` / `trans_src` matching `date_criteria(col)`.
+    """
+    from models import db, Vehicle
+    from sqlalchemy import case, func
+
+    signed = case((ops_src.c.operation_type == 'OUT', -ops_src.c.quantity_cl), else_=ops_src.c.quantity_cl)
+    ops_day = func.date(ops_src.c.date)
+    ops = db.session.query(ops_src.c.company_id, ops_day, func.sum(signed))\
+        .filter(ops_src.c.gestiune_id == gestiune_id,
+                ops_src.c.company_id.isnot(None),
+                ops_src.c.operation_type.in_(('INITIAL', 'IN', 'OUT')),
+                *[criterion(ops_src.c.date) for criterion in date_criteria])\
+        .group_by(ops_src.c.company_id, ops_day)
+
+    trans_day = func.date(trans_src.c.date)
+    consumed = db.session.query(trans_src.c.company_id, trans_day, -func.sum(trans_src.c.quantity_cl))\
+        .join(Vehicle, trans_src.c.vehicle_id == Vehicle.id)\
+        .filter(trans_src.c.gestiune_id == gestiune_id,
+                trans_src.c.company_id.isnot(None),
+                Vehicle.category_id.isnot(None),
+                *[criterion(trans_src.c.date) for criterion in date_criteria])\
+        .group_by(trans_src.c.company_id, trans_day)
+    return ops, consumed
+
+
+def _checkpoint(gestiune_id, as_of, cutoff):
+    """(at, {company_id: balance_cl}) of the nearest usable checkpoint at or before `as_of`"""
+    from models import db, StockCheckpoint
+    from sqlalchemy import func
+
+    query = db.session.query(func.max(StockCheckpoint.at))\
+        .filter(StockCheckpoint.gestiune_id == gestiune_id, StockCheckpoint.at <= as_of)
+    if cutoff is not None and as_of >= cutoff:
+        # Only checkpoints built on the carried-forward balances
+        query = query.filter(StockCheckpoint.at >= cutoff)
+    at = query.scalar()
+    if at is None:
+        return None, {}
+    rows = db.session.query(StockCheckpoint.company_id, StockCheckpoint.balance_cl)\
+        .filter_by(gestiune_id=gestiune_id, at=at).all()
+    return at, dict(rows)
+
+
+def balances_as_of(gestiune_id, as_of):
+    """
+    ({company_id: balance_cl}, checkpoint at or None) of every company with
+    movements, at the moment `as_of` (rows dated up to and including it).
+    """
+    from archive import get_archive_cutoff, stock_operation_source, transaction_source
+
+    cutoff = get_archive_cutoff(gestiune_id)
+    at, balances = _checkpoint(gestiune_id, as_of, cutoff)
+
+    start = at
+    if start is None and cutoff is not None and as_of >= cutoff:
+        start = cutoff  # hot rows only: the cutoff's INITIAL entries carry the archive
+    criteria = [lambda col: col <= as_of]
+    if at is not None:
+        criteria.append(lambda col: col >= at)
+
+    ops, consumed = _movements(gestiune_id,
+                               stock_operation_source(gestiune_id, start, as_of),
+                               transaction_source(gestiune_id, start, as_of),
+                               *criteria)
+    for company_id, _, delta in list(ops) + list(consumed):
+        balances[company_id] = balances.get(company_id, 0) + (delta or 0)
+    return balances, at
+
+
+def build_checkpoints(gestiune_id, until=None):
+    """
+    Write the missing checkpoints of `gestiune_id` up to midnight `until`
+    (default: today's): one at the end of every day with movements, continuing
+    from the last valid checkpoint. Returns the number of days checkpointed.
+    """
+    with _build_lock:
+        return _build_checkpoints(gestiune_id, until or _today())
+
+
+def _build_checkpoints(gestiune_id, until):
+    from models import db, StockCheckpoint, StockOperation, Transaction
+    from archive import get_archive_cutoff
+    from sqlalchemy import func
+    from sqlalchemy.dialects.sqlite import insert
+
+    cutoff = get_archive_cutoff(gestiune_id)
+    query = db.session.query(func.max(StockCheckpoint.at)).filter(StockCheckpoint.gestiune_id == gestiune_id)
+    if cutoff is not None:
+        query = query.filter(StockCheckpoint.at >= cutoff)
+    last_at = query.scalar()
+    if last_at is not None and last_at >= until:
+        return 0
+
+    running = {}
+    criteria = [lambda col: col < until]
+    if last_at is not None:
+        running = _checkpoint(gestiune_id, last_at, cutoff)[1]
+        criteria.append(lambda col: col >= last_at)
+
+    days = {}
+    ops, consumed = _movements(gestiune_id, StockOperation.__table__, Transaction.__table__, *criteria)
+    for company_id, day, delta in list(ops) + list(consumed):
+        days.setdefault(day, []).append((company_id, delta or 0))
+
+    rows = []
+    for day in sorted(days):
+        for company_id, delta in days[day]:
+            running[company_id] = running.get(company_id, 0) + delta
+        at = datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)
+        rows.extend({'gestiune_id': gestiune_id, 'company_id': company_id, 'at': at, 'balance_cl': balance}
+                    for company_id, balance in running.items())
+    if rows:
+        # Rows another connection wrote meanwhile hold the same balances
+        db.session.execute(insert(StockCheckpoint).on_conflict_do_nothing(), rows)
+    db.session.commit()
+    if days:
+        print(f"[STOCK] Gestiune {gestiune_id}: {len(days)} daily checkpoints built up to {until:%d.%m.%Y}")
+    return len(days)
+
+
+def start_checkpoint_worker(app, delay=CHECKPOINT_DELAY, interval=CHECKPOINT_INTERVAL):
+    """
+    Build the missing checkpoints of every gestiune in a daemon thread: `delay`
+    s after start, then once per new day (checked every `interval` s).
+    """
+    global _worker
+
+    def loop():
+        time.sleep(delay)
+        built_for = None
+        while True:
+            if built_for != _today():
+                try:
+                    with app.app_context():
+                        from models import db, Gestiune
+                        for (gid,) in db.session.query(Gestiune.id).all():
+                            build_checkpoints(gid)
+                        db.session.remove()
+                    built_for = _today()
+                except Exception as e:
+                    print(f"[STOCK] Checkpoint build failed: {e}")
+            time.sleep(interval)
+
+    with _lock:
+        if _worker is None:
+            _worker = threading.Thread(target=loop, name='stock-checkpoints', daemon=True)
+            _worker.start()
+    return _worker